@@ -0,0 +1,331 @@
+"""
+検知パイプラインのオフラインベンチマーク。
+カメラの代わりに録画ファイルまたは合成フレームを一定レートで供給し、
+検知 (HumanDetector) → 描画 → 録画キュー投入 (Recorder) → MJPEG エンコード を実行して
+処理 FPS・段階ごとのレイテンシ分位点・ピーク RSS・取りこぼしフレーム数を JSON で出力する。
+
+例:
+  python Tools/benchmark.py --synthetic --fps 15 --duration 30 --output bench.json
+  python Tools/benchmark.py --input clip.mp4 --fps 0 --frames 500 --compare bench.json
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# プロジェクトルートをパスに追加して各モジュールをロードできるようにする
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+from detector import HumanDetector
+from recorder import Recorder
+from metrics import metrics, STAGES, cpu_temperature
+
+SAMPLE_WINDOW = 1_000_000  # ベンチマーク中は全サンプルから分位点を求める
+CLIP_FINALIZE_TIMEOUT = 60.0  # 録画の確定（FFmpeg の終了）を待つ最大秒数
+
+
+class _PacedSource:
+    """
+    Camera 互換（start / get_frame / stop / frame_seq）のフレーム供給元。
+    fps > 0 の場合はスレッドで一定間隔ごとに最新フレームを更新し、
+    fps = 0 の場合は get_frame のたびに次のフレームを生成する（最大速度）。
+    produce は次のフレームを返す callable。
+    """
+    def __init__(self, fps, produce):
+        self.fps = fps
+        self._produce = produce
+        self.frame = None
+        self.frame_seq = 0
+        self.is_running = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.is_running = True
+        if self.fps > 0:
+            self.thread = threading.Thread(target=self._update, daemon=True)
+            self.thread.start()
+
+    def _update(self):
+        interval = 1.0 / self.fps
+        next_t = time.perf_counter()
+        while self.is_running:
+            frame = self._produce()
+            with self.lock:
+                self.frame = frame
+                self.frame_seq += 1
+            next_t += interval
+            time.sleep(max(0.0, next_t - time.perf_counter()))
+
+    def get_frame(self):
+        if self.fps <= 0:
+            frame = self._produce()
+            with self.lock:
+                self.frame = frame
+                self.frame_seq += 1
+        with self.lock:
+            return self.frame.copy() if self.frame is not None else None
+
+    def stop(self):
+        self.is_running = False
+        if hasattr(self, 'thread'):
+            self.thread.join(timeout=3)
+
+
+class SyntheticSource(_PacedSource):
+    """ノイズ背景の上を矩形が移動する合成フレーム。"""
+    def __init__(self, resolution=(1280, 720), fps=15):
+        super().__init__(fps, self._next)
+        self.resolution = tuple(resolution)
+        w, h = self.resolution
+        rng = np.random.default_rng(0)
+        self._background = rng.integers(0, 255, (h, w, 3), dtype=np.uint8)
+        self._index = 0
+
+    def _next(self):
+        w, h = self.resolution
+        frame = self._background.copy()
+        x = (self._index * 8) % max(1, w - w // 6)
+        cv2.rectangle(frame, (x, h // 4), (x + w // 6, h // 4 + h // 2), (40, 40, 200), -1)
+        self._index += 1
+        return frame
+
+
+class VideoFileSource(_PacedSource):
+    """録画ファイルを先頭から繰り返し再生する。"""
+    def __init__(self, path, fps=None):
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise RuntimeError(f"Could not open video {path}")
+        native = self.cap.get(cv2.CAP_PROP_FPS) or 15.0
+        super().__init__(native if fps is None else fps, self._next)
+        self.resolution = (int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                           int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    def _next(self):
+        ret, frame = self.cap.read()
+        if not ret:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.cap.read()
+        return frame if ret else None
+
+    def stop(self):
+        super().stop()
+        self.cap.release()
+
+
+def run_pipeline(source, detector, recorder, encode, duration, max_frames, target_classes):
+    """main.py のループと同じ順序で処理し、(処理フレーム数, 経過秒数, 取りこぼし数) を返す。"""
+    processed = dropped = 0
+    last_seq = None
+    start = time.perf_counter()
+    deadline = start + duration if duration else None
+    while True:
+        if deadline and time.perf_counter() >= deadline:
+            break
+        if max_frames and processed >= max_frames:
+            break
+
+        frame = source.get_frame()
+        seq = source.frame_seq
+        if frame is None or seq == last_seq:
+            time.sleep(0.001)  # 新しいフレームを待つ（同一フレームは処理しない）
+            continue
+        if last_seq is not None and seq - last_seq > 1:
+            dropped += seq - last_seq - 1
+        last_seq = seq
+
+        detections = detector.detect(frame)
+        targets = [d for d in detections if d[5] in target_classes]
+        with metrics.timer('draw'):
+            frame = detector.draw_detections(frame, detections)
+        if recorder is not None:
+            with metrics.timer('recorder_enqueue'):
+                recorder.update_buffer(frame)
+                recorder.write(frame)
+            if targets or processed == 0:
+                recorder.start_recording(frame)
+        with metrics.timer('encode'):
+            encode(frame)
+        processed += 1
+    return processed, time.perf_counter() - start, dropped
+
+
+def finalize_recording(recorder):
+    """録画中のクリップを停止し、ファイルが確定するまで待つ。戻り値: クリップ情報（確定できなければ None）"""
+    clip = recorder.current_clip
+    if clip is None:
+        return None
+    recorder.schedule_stop(0)
+    try:
+        return clip.result(timeout=CLIP_FINALIZE_TIMEOUT)
+    except Exception as e:
+        print(f"[Benchmark] Recording was not finalized: {e}", file=sys.stderr)
+        return None
+
+
+def latency_report():
+    """段階ごとの分位点・平均（ミリ秒）と件数。"""
+    report = {}
+    for stage in STAGES:
+        _, count, total, quantiles = metrics.histogram(stage).snapshot()
+        if not count:
+            continue
+        entry = {f"p{int(q * 100)}": round(v * 1000, 3) for q, v in quantiles.items()}
+        entry["mean"] = round(total / count * 1000, 3)
+        entry["count"] = count
+        report[stage] = entry
+    return report
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, timeout=5,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              check=True).stdout.decode().strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(result, baseline):
+    """ベースラインとの差分を表形式で返す（値が大きいほど悪化する指標は + が悪化）。"""
+    rows = [("fps", baseline.get("fps"), result.get("fps"))]
+    for stage, entry in result.get("latency_ms", {}).items():
+        base = baseline.get("latency_ms", {}).get(stage, {})
+        for key in ("p50", "p95", "p99"):
+            rows.append((f"{stage}.{key}", base.get(key), entry.get(key)))
+    rows.append(("peak_rss_mb", baseline.get("peak_rss_mb"), result.get("peak_rss_mb")))
+    for stage, n in result.get("dropped_frames", {}).items():
+        rows.append((f"dropped.{stage}", baseline.get("dropped_frames", {}).get(stage), n))
+
+    lines = [f"{'metric':<28}{'baseline':>12}{'current':>12}{'change':>10}"]
+    for name, old, new in rows:
+        if old is None or new is None:
+            change = ""
+        elif old:
+            change = f"{(new - old) / old * 100:+.1f}%"
+        else:
+            change = f"{new - old:+g}"
+        lines.append(f"{name:<28}{'' if old is None else old:>12}{'' if new is None else new:>12}{change:>10}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the detection pipeline")
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument("--input", type=str, help="Video file to replay")
+    src.add_argument("--synthetic", action="store_true", help="Use synthetic frames")
+    parser.add_argument("--fps", type=float, default=None,
+                        help="Source frame rate (0 = as fast as possible; default: native / 15)")
+    parser.add_argument("--resolution", type=str, default="1280x720", help="Synthetic frame size WxH")
+    parser.add_argument("--duration", type=float, default=30.0, help="Run time in seconds (0 = unlimited)")
+    parser.add_argument("--frames", type=int, default=0, help="Stop after N processed frames")
+    parser.add_argument("--warmup", type=int, default=10, help="Frames excluded from the statistics")
+    parser.add_argument("--model", type=str, default=os.path.join(ROOT, "model.tflite"))
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--no-record", action="store_true", help="Skip the Recorder / FFmpeg stage")
+    parser.add_argument("--stream-size", type=str, default="640x480", help="MJPEG encode size WxH")
+    parser.add_argument("--quality", type=int, default=95, help="MJPEG JPEG quality")
+    parser.add_argument("--output", type=str, help="Write the JSON report to this file")
+    parser.add_argument("--compare", type=str, help="Baseline JSON report to compare against")
+    args = parser.parse_args()
+
+    if not args.duration and not args.frames:
+        parser.error("--duration 0 requires --frames")
+
+    record = not args.no_record and shutil.which('ffmpeg') is not None
+    stream_size = tuple(int(v) for v in args.stream_size.lower().split('x'))
+    record_dir = tempfile.mkdtemp(prefix='cam_bench_')
+
+    # 各モジュールの print は標準エラーへ（標準出力は JSON のみ）
+    with contextlib.redirect_stdout(sys.stderr):
+        import web_stream  # MJPEG エンコーダー（リサイズ + OSD + JPEG）
+
+        if args.synthetic:
+            resolution = tuple(int(v) for v in args.resolution.lower().split('x'))
+            source = SyntheticSource(resolution, 15 if args.fps is None else args.fps)
+        else:
+            source = VideoFileSource(args.input, args.fps)
+
+        detector = HumanDetector(model_path=args.model, threshold=args.threshold)
+        recorder = Recorder(save_directory=record_dir, resolution=source.resolution) if record else None
+
+        def encode(frame):
+            return web_stream.render_stream_frame(frame, stream_size, args.quality)
+
+        try:
+            source.start()
+            if args.warmup:
+                run_pipeline(source, detector, recorder, encode, 0, args.warmup, [1])
+            metrics.reset(window=SAMPLE_WINDOW)
+            processed, elapsed, dropped = run_pipeline(
+                source, detector, recorder, encode, args.duration, args.frames, [1])
+            # 計測の区切りで録画を確定させ、書き出し待ちのフレームの取りこぼしも集計に含める
+            clip = finalize_recording(recorder) if recorder is not None else None
+        finally:
+            source.stop()
+            if recorder is not None:
+                recorder.release()
+            shutil.rmtree(record_dir, ignore_errors=True)
+
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # Linux は KiB 単位
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    result = {
+        "version": git_revision(),
+        "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.machine(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+        },
+        "config": {
+            "source": "synthetic" if args.synthetic else os.path.basename(args.input),
+            "resolution": list(source.resolution),
+            "source_fps": source.fps,
+            "model": os.path.basename(args.model),
+            "detector": "tflite" if detector.interpreter is not None else "mock",
+            "record": record,
+            "stream_size": list(stream_size),
+            "quality": args.quality,
+        },
+        "frames": processed,
+        "elapsed_s": round(elapsed, 3),
+        "fps": round(processed / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": latency_report(),
+        "dropped_frames": {
+            "pipeline": dropped,
+            "recorder": metrics.counter('frames_dropped_total', stage='recorder'),
+        },
+        "recording": {k: clip[k] for k in ("frames", "duration", "size")} if clip else None,
+        "peak_rss_mb": round(self_rss, 1),
+        "peak_rss_children_mb": round(child_rss, 1),
+        "cpu_temperature_c": cpu_temperature(),
+    }
+
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+        print(f"Report saved to: {args.output}", file=sys.stderr)
+    print(text)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            print(compare(result, json.load(f)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
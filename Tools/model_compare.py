@@ -0,0 +1,332 @@
+"""
+複数の TFLite モデルの精度・速度比較。
+同じラベル付き画像セット（COCO 形式のアノテーション JSON）に対して各モデルを HumanDetector で実行し、
+推論レイテンシの分位点・メモリ使用量・IoU 0.5 での precision / recall / mAP を 1 つの表にまとめる。
+各モデルは別プロセス (spawn) で評価するため、メモリ使用量とレイテンシが互いに影響しない。
+
+例:
+  python Tools/model_compare.py --models models/*.tflite --images val2017 \\
+      --annotations instances_val2017.json --classes person --min-map 0.5 --output compare.json
+"""
+import argparse
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import cv2
+import numpy as np
+
+# プロジェクトルートをパスに追加して各モジュールをロードできるようにする
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+EVAL_THRESHOLD = 0.05  # mAP 計算用に低スコアの検知まで取得する（表示用の閾値は --threshold）
+
+
+def load_ground_truth(path, class_filter=None):
+    """
+    COCO 形式のアノテーションを読み込み、(画像一覧, {image_id: [(x, y, w, h, label, crowd)]}, 評価クラス) を返す。
+    クラスはカテゴリ名で扱う（モデルのクラス ID と COCO の category_id のずれを吸収するため）。
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    names = {c["id"]: c.get("name", str(c["id"])) for c in data.get("categories", [])}
+
+    ground_truth = {img["id"]: [] for img in data["images"]}
+    for ann in data.get("annotations", []):
+        if ann["image_id"] not in ground_truth:
+            continue
+        label = names.get(ann["category_id"], str(ann["category_id"]))
+        if class_filter and label not in class_filter:
+            continue
+        x, y, w, h = ann["bbox"]
+        ground_truth[ann["image_id"]].append((x, y, w, h, label, bool(ann.get("iscrowd", 0))))
+
+    labels = set(class_filter) if class_filter else {
+        g[4] for boxes in ground_truth.values() for g in boxes}
+    images = [(img["id"], img["file_name"]) for img in data["images"]]
+    return images, ground_truth, labels
+
+
+def _iou(a, b):
+    ax2, ay2 = a[0] + a[2], a[1] + a[3]
+    bx2, by2 = b[0] + b[2], b[1] + b[3]
+    iw = max(0.0, min(ax2, bx2) - max(a[0], b[0]))
+    ih = max(0.0, min(ay2, by2) - max(a[1], b[1]))
+    inter = iw * ih
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _average_precision(scores, tp, n_gt):
+    """全点補間の AP（precision を recall 方向に単調化して面積を求める）。"""
+    if n_gt == 0:
+        return None
+    if not scores:
+        return 0.0
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    hits = np.asarray(tp, dtype=np.float64)[order]
+    tp_cum = np.cumsum(hits)
+    fp_cum = np.cumsum(1.0 - hits)
+    recall = np.concatenate(([0.0], tp_cum / n_gt, [1.0]))
+    precision = np.concatenate(([1.0], tp_cum / np.maximum(tp_cum + fp_cum, 1e-9), [0.0]))
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    changed = np.where(recall[1:] != recall[:-1])[0]
+    return float(np.sum((recall[changed + 1] - recall[changed]) * precision[changed + 1]))
+
+
+def evaluate(predictions, ground_truth, labels, iou_threshold=0.5, score_threshold=0.5):
+    """
+    predictions: {image_id: [(x, y, w, h, score, label)]}
+    スコアの高い順に同じクラスの未対応の正解と照合する（COCO と同じ貪欲マッチング）。
+    crowd 領域に一致した検知は TP / FP のどちらにも数えない。
+    """
+    per_class = {label: {"scores": [], "tp": [], "n_gt": 0} for label in labels}
+    for image_id, gts in ground_truth.items():
+        for label in labels:
+            boxes = [g for g in gts if g[4] == label and not g[5]]
+            crowds = [g for g in gts if g[4] == label and g[5]]
+            dets = sorted((d for d in predictions.get(image_id, []) if d[5] == label),
+                          key=lambda d: -d[4])
+            entry = per_class[label]
+            entry["n_gt"] += len(boxes)
+            matched = [False] * len(boxes)
+            for d in dets:
+                best, best_iou = -1, iou_threshold
+                for i, g in enumerate(boxes):
+                    if matched[i]:
+                        continue
+                    iou = _iou(d, g)
+                    if iou >= best_iou:
+                        best, best_iou = i, iou
+                if best >= 0:
+                    matched[best] = True
+                    hit = True
+                elif any(_iou(d, c) >= iou_threshold for c in crowds):
+                    continue
+                else:
+                    hit = False
+                entry["scores"].append(d[4])
+                entry["tp"].append(hit)
+
+    ap = {}
+    tp = fp = n_gt = 0
+    for label, entry in per_class.items():
+        value = _average_precision(entry["scores"], entry["tp"], entry["n_gt"])
+        if value is not None:
+            ap[label] = round(value, 4)
+        n_gt += entry["n_gt"]
+        for score, hit in zip(entry["scores"], entry["tp"]):
+            if score >= score_threshold:
+                tp += hit
+                fp += not hit
+    return {
+        "precision": round(tp / (tp + fp), 4) if tp + fp else 0.0,
+        "recall": round(tp / n_gt, 4) if n_gt else 0.0,
+        "map50": round(sum(ap.values()) / len(ap), 4) if ap else 0.0,
+        "ap50": ap,
+        "ground_truth": n_gt,
+    }
+
+
+def _rss_mb():
+    """現在の RSS（MB）。/proc がない環境では None。"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def _run_model(conn, model_path, image_dir, images, warmup):
+    """
+    子プロセスで 1 モデルを評価し、検知結果とレイテンシ・メモリを conn に返す。
+    画像のデコード時間はレイテンシに含めない。
+    """
+    sys.path.append(ROOT)
+    with contextlib.redirect_stdout(sys.stderr):
+        from detector import HumanDetector
+        rss_before = _rss_mb()
+        detector = HumanDetector(model_path=model_path, threshold=EVAL_THRESHOLD)
+        rss_loaded = _rss_mb()
+        if detector.interpreter is None:
+            conn.send({"error": "Could not load model"})
+            return
+
+        latencies = []
+        predictions = {}
+        missing = 0
+        for n, (image_id, file_name) in enumerate(images):
+            frame = cv2.imread(os.path.join(image_dir, file_name))
+            if frame is None:
+                missing += 1
+                continue
+            if n == 0:
+                for _ in range(warmup):
+                    detector.detect(frame)
+            start = time.perf_counter()
+            detections = detector.detect(frame)
+            latencies.append(time.perf_counter() - start)
+            predictions[image_id] = [
+                (x, y, w, h, score, detector.classes.get(cid, str(cid)))
+                for x, y, w, h, score, cid in detections]
+            if (n + 1) % 100 == 0:
+                print(f"[Compare] {os.path.basename(model_path)}: {n + 1}/{len(images)} images")
+
+    conn.send({
+        "input_type": np.dtype(detector.input_details[0]['dtype']).name,
+        "input_size": [int(detector.input_width), int(detector.input_height)],
+        "latencies": latencies,
+        "predictions": predictions,
+        "missing_images": missing,
+        "rss_load_mb": round(rss_loaded - rss_before, 1) if rss_before is not None else None,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),  # Linux は KiB 単位
+    })
+
+
+def run_model(model_path, image_dir, images, warmup):
+    """モデルごとに新しいプロセスを起動して評価する（前のモデルのメモリが残らないように spawn を使う）。"""
+    ctx = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_run_model, args=(child_conn, model_path, image_dir, images, warmup),
+                       daemon=True)
+    proc.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = {"error": f"Worker exited with code {proc.exitcode}"}
+    proc.join()
+    return result
+
+
+def summarize(model_path, raw, ground_truth, labels, iou_threshold, score_threshold):
+    entry = {
+        "model": os.path.basename(model_path),
+        "path": model_path,
+        "size_mb": round(os.path.getsize(model_path) / (1024 * 1024), 2),
+    }
+    if "error" in raw:
+        entry["error"] = raw["error"]
+        return entry
+    latencies = np.asarray(raw["latencies"]) * 1000
+    entry.update({
+        "input_type": raw["input_type"],
+        "input_size": raw["input_size"],
+        "images": len(raw["latencies"]),
+        "missing_images": raw["missing_images"],
+        "latency_ms": {
+            "p50": round(float(np.percentile(latencies, 50)), 2),
+            "p95": round(float(np.percentile(latencies, 95)), 2),
+            "p99": round(float(np.percentile(latencies, 99)), 2),
+            "mean": round(float(latencies.mean()), 2),
+        } if latencies.size else {},
+        "rss_load_mb": raw["rss_load_mb"],
+        "peak_rss_mb": raw["peak_rss_mb"],
+    })
+    entry.update(evaluate(raw["predictions"], ground_truth, labels, iou_threshold, score_threshold))
+    return entry
+
+
+def pick(results, min_map, min_recall):
+    """基準を満たすモデルのうち p50 レイテンシが最小のものを返す。"""
+    candidates = [r for r in results
+                  if "error" not in r and r.get("latency_ms")
+                  and r["map50"] >= min_map and r["recall"] >= min_recall]
+    return min(candidates, key=lambda r: r["latency_ms"]["p50"]) if candidates else None
+
+
+def format_table(results, best):
+    lines = [f"{'model':<32}{'type':>8}{'size MB':>9}{'load MB':>9}{'p50 ms':>9}{'p95 ms':>9}"
+             f"{'p99 ms':>9}{'prec':>7}{'recall':>8}{'mAP50':>7}"]
+    for r in results:
+        name = ("* " if r is best else "  ") + r["model"]
+        if "error" in r:
+            lines.append(f"{name:<32}  {r['error']}")
+            continue
+        lat = r.get("latency_ms", {})
+        load = "" if r["rss_load_mb"] is None else r["rss_load_mb"]
+        lines.append(f"{name:<32}{r['input_type']:>8}{r['size_mb']:>9}{load:>9}"
+                     f"{lat.get('p50', ''):>9}{lat.get('p95', ''):>9}{lat.get('p99', ''):>9}"
+                     f"{r['precision']:>7}{r['recall']:>8}{r['map50']:>7}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare accuracy and speed of TFLite models")
+    parser.add_argument("--models", type=str, nargs='+', required=True,
+                        help="Model files or glob patterns")
+    parser.add_argument("--images", type=str, required=True, help="Directory containing the labeled images")
+    parser.add_argument("--annotations", type=str, required=True, help="COCO-style ground truth JSON")
+    parser.add_argument("--classes", type=str, nargs='*',
+                        help="Category names to evaluate (default: all categories in the ground truth)")
+    parser.add_argument("--threshold", type=float, default=0.5,
+                        help="Score threshold for precision / recall")
+    parser.add_argument("--iou", type=float, default=0.5, help="IoU threshold for a true positive")
+    parser.add_argument("--limit", type=int, default=0, help="Evaluate only the first N images")
+    parser.add_argument("--warmup", type=int, default=5, help="Inferences excluded from the latency")
+    parser.add_argument("--min-map", type=float, default=0.0, help="Accuracy bar: minimum mAP@IoU")
+    parser.add_argument("--min-recall", type=float, default=0.0, help="Accuracy bar: minimum recall")
+    parser.add_argument("--output", type=str, help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    model_paths = []
+    for pattern in args.models:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        model_paths.extend(os.path.abspath(p) for p in matches if p.lower().endswith('.tflite'))
+    missing = [p for p in model_paths if not os.path.exists(p)]
+    if not model_paths or missing:
+        print(f"Error: Model not found: {', '.join(missing) or ' '.join(args.models)}")
+        return
+
+    images, ground_truth, labels = load_ground_truth(args.annotations, args.classes)
+    if args.limit:
+        images = images[:args.limit]
+        ground_truth = {image_id: ground_truth[image_id] for image_id, _ in images}
+    print(f"Comparing {len(model_paths)} models on {len(images)} images "
+          f"(classes: {', '.join(sorted(labels)) or '-'}, IoU {args.iou}, threshold {args.threshold})")
+
+    results = []
+    for model_path in model_paths:
+        print(f"Evaluating {os.path.basename(model_path)}...")
+        raw = run_model(model_path, os.path.abspath(args.images), images, args.warmup)
+        # 読めなかった画像は正解からも除外する（検知なしとして扱うと recall が不当に下がるため）
+        evaluated = {image_id: ground_truth[image_id]
+                     for image_id in raw.get("predictions", {})}
+        results.append(summarize(model_path, raw, evaluated, labels, args.iou, args.threshold))
+
+    best = pick(results, args.min_map, args.min_recall)
+    print()
+    print(format_table(results, best))
+    if best:
+        print(f"\n* Fastest model meeting the bar (mAP50 >= {args.min_map}, recall >= {args.min_recall}): "
+              f"{best['model']} ({best['latency_ms']['p50']} ms p50)")
+    else:
+        print(f"\nNo model meets the bar (mAP50 >= {args.min_map}, recall >= {args.min_recall})")
+
+    if args.output:
+        report = {
+            "annotations": os.path.abspath(args.annotations),
+            "images": len(images),
+            "classes": sorted(labels),
+            "iou": args.iou,
+            "threshold": args.threshold,
+            "bar": {"min_map50": args.min_map, "min_recall": args.min_recall},
+            "best": best["model"] if best else None,
+            "models": results,
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Report saved to: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
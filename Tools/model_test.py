@@ -3,11 +3,21 @@ import numpy as np
 import sys
 import os
 import argparse
+import csv
+import glob
+import json
+import queue
+import threading
 import time
 
 # プロジェクトルートをパスに追加して detector をロードできるようにする
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from detector import HumanDetector
+from inference import ProcessDetector
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+VIDEO_EXTS = ('.mp4', '.avi', '.mov', '.mkv')
+QUEUE_PER_WORKER = 4  # バッチモードでデコード済みフレームを先読みする数（ワーカーあたり）
 
 def test_image(detector, image_path, output_path):
     print(f"\n[Image Test] Processing: {image_path}")
@@ -84,11 +94,219 @@ def test_video(detector, video_path, output_path):
     for name, c in class_counts.items():
         print(f"  {name}: {c}")
 
+def collect_inputs(pattern):
+    """
+    ディレクトリ（直下のファイル）または glob パターンに一致する画像・動画を返す。
+    戻り値: (入力ルート, パスのリスト)。入力ルートはディレクトリ自身、または glob のワイルドカードより前の部分。
+    """
+    if os.path.isdir(pattern):
+        root = pattern
+        paths = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+    else:
+        parts = []
+        for part in os.path.normpath(pattern).split(os.sep):
+            if glob.has_magic(part):
+                break
+            parts.append(part)
+        root = os.sep.join(parts) or os.curdir
+        if not os.path.isdir(root):
+            root = os.curdir
+        paths = glob.glob(pattern, recursive=True)
+    return os.path.abspath(root), sorted(
+        os.path.abspath(p) for p in paths
+        if os.path.isfile(p) and os.path.splitext(p)[1].lower() in IMAGE_EXTS + VIDEO_EXTS)
+
+def _read_media(paths, enqueue, deliver):
+    """
+    デコードスレッド。ファイルを順に読み、フレームを推論キューへ (enqueue)、開始・終了の通知を書き出し側へ (deliver) 渡す。
+    すべての項目に通し番号を付け、書き出し側はその順に処理する。
+    """
+    seq = 0
+    for index, path in enumerate(paths):
+        if os.path.splitext(path)[1].lower() in IMAGE_EXTS:
+            frame = cv2.imread(path)
+            if frame is None:
+                deliver(seq, ('error', index, "Could not read image")); seq += 1
+                continue
+            h, w = frame.shape[:2]
+            deliver(seq, ('start', index, {"type": "image", "width": w, "height": h, "fps": 0})); seq += 1
+            enqueue(seq, ('frame', index, frame)); seq += 1
+        else:
+            cap = cv2.VideoCapture(path)
+            if not cap.isOpened():
+                deliver(seq, ('error', index, "Could not open video")); seq += 1
+                continue
+            deliver(seq, ('start', index, {
+                "type": "video",
+                "width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                "fps": cap.get(cv2.CAP_PROP_FPS) or 20.0,
+            })); seq += 1
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                enqueue(seq, ('frame', index, frame)); seq += 1
+            cap.release()
+        deliver(seq, ('end', index, None)); seq += 1
+    deliver(seq, ('done', None, None))
+
+def _infer_worker(detector, work, deliver):
+    """推論スレッド。推論プロセス (ProcessDetector) の応答を待つ間は GIL を解放する。"""
+    while True:
+        item = work.get()
+        if item is None:
+            break
+        seq, (_, index, frame) = item
+        failures = detector.failures
+        start_t = time.time()
+        detections = detector.detect(frame)
+        failed = detector.failures != failures  # 推論プロセスの障害（検知なしとは区別する）
+        deliver(seq, ('frame', index, (frame, detections, time.time() - start_t, failed)))
+
+def _output_path(output_dir, input_root, path):
+    """入力ルートからの相対パスを output_dir 以下に再現する（別フォルダの同名ファイルを上書きしない）。"""
+    rel_dir = os.path.relpath(os.path.dirname(path), input_root)
+    base, ext = os.path.splitext(os.path.basename(path))
+    out_dir = os.path.normpath(os.path.join(output_dir, rel_dir))
+    os.makedirs(out_dir, exist_ok=True)
+    return os.path.join(out_dir, f"{base}_result{ext}")
+
+def run_batch(paths, model_path, threshold, output_dir, workers, input_root):
+    """
+    デコード（1 スレッド）→ 推論（ワーカーごとに 1 インタープリターを持つプロセス）→ 描画・書き出し（メインスレッド）
+    のパイプラインで複数ファイルを処理し、ファイルごとの集計を返す。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    drawer = HumanDetector(model_path=model_path, threshold=threshold)  # クラス名・検知枠の描画用
+    detectors = [ProcessDetector(model_path, threshold, index=i) for i in range(workers)]
+
+    work = queue.Queue(maxsize=workers * QUEUE_PER_WORKER)
+    ready = {}  # 通し番号 -> 項目（推論の完了順は前後するため、書き出し側で並べ直す）
+    cond = threading.Condition()
+    # デコード済みで書き出し前の項目数の上限。書き出しが推論より遅くても ready にフレームが溜まり続けないようにする
+    in_flight = threading.Semaphore(workers * (QUEUE_PER_WORKER + 1) + 2)
+
+    def deliver(seq, item):
+        with cond:
+            ready[seq] = item
+            cond.notify_all()
+
+    def reader_deliver(seq, item):
+        in_flight.acquire()
+        deliver(seq, item)
+
+    def reader_enqueue(seq, item):
+        in_flight.acquire()
+        work.put((seq, item))
+
+    reader = threading.Thread(target=_read_media, args=(paths, reader_enqueue, reader_deliver), daemon=True)
+    infer_threads = [threading.Thread(target=_infer_worker, args=(d, work, deliver), daemon=True)
+                     for d in detectors]
+    for t in [reader] + infer_threads:
+        t.start()
+
+    results = []
+    current = out = None
+    next_seq = 0
+    start_all = time.time()
+    try:
+        while True:
+            with cond:
+                while next_seq not in ready:
+                    cond.wait()
+                kind, index, payload = ready.pop(next_seq)
+            in_flight.release()
+            next_seq += 1
+
+            if kind == 'done':
+                break
+            path = paths[index]
+            if kind == 'error':
+                print(f"[{index + 1}/{len(paths)}] {path}: {payload}")
+                results.append({"file": path, "error": payload})
+            elif kind == 'start':
+                current = dict(payload, file=path, output=_output_path(output_dir, input_root, path), frames=0,
+                               failed_frames=0, frames_with_detections=0, detections=0, classes={}, inference_s=0.0,
+                               started=time.time())
+                if payload["type"] == "video":
+                    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+                    out = cv2.VideoWriter(current["output"], fourcc, payload["fps"],
+                                          (payload["width"], payload["height"]))
+            elif kind == 'frame':
+                frame, detections, inf_time, failed = payload
+                current["frames"] += 1
+                if failed:
+                    current["failed_frames"] += 1
+                else:
+                    current["inference_s"] += inf_time
+                current["detections"] += len(detections)
+                current["frames_with_detections"] += 1 if detections else 0
+                for d in detections:
+                    name = drawer.classes.get(d[5], f"ID:{d[5]}")
+                    current["classes"][name] = current["classes"].get(name, 0) + 1
+                result_frame = drawer.draw_detections(frame, detections)
+                if out is not None:
+                    out.write(result_frame)
+                else:
+                    cv2.imwrite(current["output"], result_frame)
+            elif kind == 'end':
+                if out is not None:
+                    out.release()
+                    out = None
+                entry = current
+                inferred = entry["frames"] - entry["failed_frames"]
+                entry["avg_inference_ms"] = round(entry.pop("inference_s") / max(1, inferred) * 1000, 2)
+                entry["elapsed_s"] = round(time.time() - entry.pop("started"), 2)
+                results.append(entry)
+                classes = ", ".join(f"{k}: {v}" for k, v in entry["classes"].items()) or "-"
+                failed = f", {entry['failed_frames']} failed" if entry["failed_frames"] else ""
+                print(f"[{index + 1}/{len(paths)}] {path}: {entry['frames']} frames{failed}, "
+                      f"{entry['avg_inference_ms']:.1f} ms/frame, {classes}")
+    finally:
+        for _ in infer_threads:
+            work.put(None)
+        for t in infer_threads:
+            t.join(timeout=5)
+        for d in detectors:
+            d.stop()
+        if out is not None:
+            out.release()
+
+    elapsed = time.time() - start_all
+    total_frames = sum(r.get("frames", 0) for r in results)
+    print(f"\nDone! {len(paths)} files, {total_frames} frames in {elapsed:.1f}s "
+          f"({total_frames / max(elapsed, 1e-6):.1f} FPS with {workers} workers)")
+    return results
+
+def write_summary(results, output_dir):
+    """ファイルごとの集計を summary.json / summary.csv に書き出す。"""
+    json_path = os.path.join(output_dir, "summary.json")
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+    csv_path = os.path.join(output_dir, "summary.csv")
+    fields = ["file", "type", "width", "height", "fps", "frames", "failed_frames", "frames_with_detections",
+              "detections", "avg_inference_ms", "elapsed_s", "classes", "output", "error"]
+    with open(csv_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        for r in results:
+            row = dict(r)
+            row["classes"] = ";".join(f"{k}:{v}" for k, v in r.get("classes", {}).items())
+            writer.writerow(row)
+    print(f"Summary saved to: {json_path}, {csv_path}")
+
 def main():
     parser = argparse.ArgumentParser(description="TFLite Model Testing Tool")
     parser.add_argument("--model", type=str, default="model.tflite", help="Path to .tflite model")
-    parser.add_argument("--input", type=str, required=True, help="Path to input image or video")
+    parser.add_argument("--input", type=str, required=True,
+                        help="Path to input image or video, or a directory / glob pattern for batch mode")
     parser.add_argument("--output", type=str, help="Path to output result (default: auto)")
+    parser.add_argument("--output-dir", type=str, default="model_test_results",
+                        help="Batch mode: directory for annotated outputs and summary.json / summary.csv")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Batch mode: number of inference processes (one interpreter each)")
     parser.add_argument("--threshold", type=float, default=0.4, help="Confidence threshold (0.0 - 1.0)")
     args = parser.parse_args()
 
@@ -99,6 +317,19 @@ def main():
     if not os.path.exists(model_path):
         print(f"Error: Model not found at {model_path}")
         return
+
+    # ディレクトリまたは glob パターンの場合はバッチモード
+    if os.path.isdir(input_path) or glob.has_magic(args.input):
+        input_root, paths = collect_inputs(input_path if os.path.isdir(input_path) else args.input)
+        if not paths:
+            print(f"Error: No images or videos match {args.input}")
+            return
+        workers = max(1, args.workers)
+        print(f"Batch: {len(paths)} files, {workers} workers (Threshold: {args.threshold})")
+        results = run_batch(paths, model_path, args.threshold, args.output_dir, workers, input_root)
+        write_summary(results, args.output_dir)
+        return
+
     if not os.path.exists(input_path):
         print(f"Error: Input not found at {input_path}")
         return
@@ -116,12 +347,10 @@ def main():
     
     # 入力ファイル形式の判定
     ext = os.path.splitext(input_path)[1].lower()
-    image_exts = ['.jpg', '.jpeg', '.png', '.bmp', '.webp']
-    video_exts = ['.mp4', '.avi', '.mov', '.mkv']
 
-    if ext in image_exts:
+    if ext in IMAGE_EXTS:
         test_image(detector, input_path, output_path)
-    elif ext in video_exts:
+    elif ext in VIDEO_EXTS:
         test_video(detector, input_path, output_path)
     else:
         print(f"Error: Unsupported file format {ext}")
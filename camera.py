@@ -1,95 +1,361 @@
 import cv2
+import numpy as np
+import os
+import random
 import threading
 import time
 
-MAX_RETRY = 5        # デバイスビジー時の最大リトライ回数
-RETRY_INTERVAL = 2.0 # リトライ間隔（秒）
+from metrics import metrics
+
+RECONNECT_BASE = 1.0    # 再接続の初回待ち時間（秒）。失敗するたびに倍にする
+RECONNECT_MAX = 60.0    # 再接続の待ち時間の上限（秒）
+RECONNECT_JITTER = 0.2  # 待ち時間のゆらぎ（同じ USB ハブの複数カメラが一斉に再接続しないよう分散）
+STABLE_SECONDS = 30.0   # この秒数以上フレームを取得できた後の切断では待ち時間を初期値に戻す
+MAX_FAILURES = 10       # 切断とみなす連続取得失敗回数
+FAILURE_WAIT = 0.5      # 取得失敗後の待ち時間（秒）
+
+# カメラの状態（ステータスの camera_state）
+STATE_CONNECTING = 'connecting'      # 初回接続中
+STATE_ONLINE = 'online'              # フレーム取得中
+STATE_RECONNECTING = 'reconnecting'  # 切断され、再接続を待機・試行中
+STATE_FINISHED = 'finished'          # リプレイが末尾に達した
+
+REPLAY_MODES = ('realtime', 'fast')  # realtime: 元の FPS で再生 / fast: 待機せず最大速度で再生
+
+# MJPEG パススルー時のデコード縮小率 → imdecode フラグ（JPEG の DCT 段階で縮小するため高速）
+DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+DRAIN_LIMIT = 8          # 低遅延モードで 1 回に読み捨てるバッファ済みフレームの上限
+STALE_FRAMES = 1.5       # 撮像からこのフレーム数分以上経過したフレームは読み捨てる
+DRAIN_FRESH_RATIO = 0.25 # タイムスタンプがない場合、grab() がフレーム間隔のこの割合以上待てば新しく届いたフレームとみなす
+LATENCY_ALPHA = 0.1      # 取得遅延の移動平均の重み
+DRIVER_TS_MAX_AGE = 2.0  # ドライバーのタイムスタンプを採用する最大経過秒数（範囲外は時計が異なるとみなす）
+
+def _fourcc_str(value):
+    code = int(value)
+    return ''.join(chr((code >> (8 * i)) & 0xFF) for i in range(4)).strip('\x00 ')
 
 class Camera:
-    def __init__(self, source=0):
+    """
+    カメラデバイスまたは動画ファイルから最新フレームを取得する。
+    source が既存のファイルの場合はリプレイモードとなり、replay で再生ペース、loop で繰り返しを指定する。
+    capture はデバイスのキャプチャ設定
+    {"fourcc", "width", "height", "fps", "buffer_size", "mjpeg_passthrough", "decode_scale", "low_latency"}
+    （0 / 空はドライバー既定）。low_latency では grab() でバッファ済みの古いフレームを読み捨て、最新フレームのみデコードする。
+    mjpeg_passthrough が有効な場合、フレームは JPEG のまま保持し（get_jpeg で配信に利用）、
+    get_frame では decode_scale 分の 1 に縮小デコードしたフレームを返す。
+    """
+    def __init__(self, source=0, replay='realtime', loop=False, capture=None):
         self.source = source
+        self.is_file = isinstance(source, str) and os.path.isfile(source)
+        self.replay = replay if replay in REPLAY_MODES else 'realtime'
+        self.loop = loop
+        self.capture = capture or {}
+        self.passthrough = False  # デバイスが MJPEG を未デコードで返している
+        self.jpeg = None          # パススルー時の最新フレーム（JPEG バイト列）
+        self._decoded = None      # パススルー時に縮小デコードしたフレーム（frame_seq ごとに 1 回）
+        self._decoded_seq = None
+        self._decode_lock = threading.Lock()
+        self.finished = False  # リプレイが末尾に達した（loop=False の場合）
         self.frame = None
+        self.frame_seq = 0  # 取得したフレームの通し番号（取りこぼし数の算出用）
+        self.frame_timestamp = None  # フレームのタイムスタンプ（秒）。ファイルはコンテナの PTS、デバイスは取得時刻
+        self.frame_captured_at = None  # フレームが撮像された時刻 (time.monotonic)。表示までの遅延の算出用
+        self.capture_latency = 0.0     # 撮像からデコード完了までの秒数（移動平均）
         self.is_running = False
         self.lock = threading.Lock()
         self.cap = None
-        self._open()
+
+        # 接続状態（デバイスの再接続はキャプチャスレッドが指数バックオフで行う）
+        self.state = STATE_CONNECTING
+        self.reconnects = 0     # 切断後に再接続できた回数
+        self.retry_at = None    # 次の再接続試行の時刻 (time.monotonic)
+        self._stop_event = threading.Event()
+
+        if self._open():
+            self.state = STATE_ONLINE
+        else:
+            if self.is_file:
+                raise RuntimeError(f"[Camera] ファイル {self.source} を開けませんでした。")
+            print(f"[Camera] カメラデバイス {self.source} を開けませんでした。バックグラウンドで再接続を試みます。"
+                  " 他のプロセスがカメラを使用中の場合は `sudo fuser /dev/video0` で確認してください。")
 
     def _open(self):
-        """カメラデバイスをオープンする。失敗した場合はリトライする。"""
+        """カメラデバイス（またはファイル）を 1 回だけオープンする。成功した場合は True。"""
+        self._release()
+        cap = cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            cap.release()
+            return False
+        self.cap = cap
+        if self.is_file:
+            fps = self.cap.get(cv2.CAP_PROP_FPS)
+            print(f"[Camera] ファイル {self.source} を再生します "
+                  f"({self.replay}, {fps:.1f}fps{', loop' if self.loop else ''})")
+        else:
+            print(f"[Camera] デバイス {self.source} をオープンしました")
+            self._configure()
+        return True
+
+    def _release(self):
         if self.cap is not None:
             self.cap.release()
             self.cap = None
 
-        for attempt in range(1, MAX_RETRY + 1):
-            self.cap = cv2.VideoCapture(self.source)
-            if self.cap.isOpened():
-                print(f"[Camera] デバイス {self.source} をオープンしました (試行 {attempt}回目)")
-                return
-            print(f"[Camera] デバイスビジー: device busy (試行 {attempt}/{MAX_RETRY}). "
-                  f"{RETRY_INTERVAL}秒後にリトライします...")
-            self.cap.release()
-            self.cap = None
-            time.sleep(RETRY_INTERVAL)
+    def _configure(self):
+        """キャプチャ形式（FOURCC・解像度・FPS・バッファ数）を要求し、実際に選択された値を表示する。"""
+        c = self.capture
+        fourcc = str(c.get('fourcc') or '').strip()
+        # V4L2 では形式を先に設定しないと解像度・FPS の候補が YUYV のものになる
+        if fourcc:
+            self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc.upper().ljust(4)[:4]))
+        if c.get('width') and c.get('height'):
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, int(c['width']))
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, int(c['height']))
+        if c.get('fps'):
+            self.cap.set(cv2.CAP_PROP_FPS, float(c['fps']))
+        # 低遅延モードではドライバー側に古いフレームを溜めない
+        buffer_size = c.get('buffer_size') or (1 if c.get('low_latency') else 0)
+        if buffer_size:
+            self.cap.set(cv2.CAP_PROP_BUFFERSIZE, int(buffer_size))
 
-        raise RuntimeError(
-            f"[Camera] カメラデバイス {self.source} を開けませんでした。"
-            " 他のプロセスがカメラを使用中の可能性があります。\n"
-            " → `sudo fuser /dev/video0` で確認後、プロセスを終了してください。")
+        actual = _fourcc_str(self.cap.get(cv2.CAP_PROP_FOURCC))
+        self.passthrough = False
+        if c.get('mjpeg_passthrough'):
+            if actual == 'MJPG' and self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0):
+                self.passthrough = True
+            else:
+                print(f"[Camera] MJPEG パススルーは利用できません (形式: {actual or '不明'})。通常のデコードを使用します。")
+        print(f"[Camera] キャプチャ形式: {actual or '不明'} "
+              f"{int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))}x{int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))} "
+              f"@ {self.cap.get(cv2.CAP_PROP_FPS):.1f}fps"
+              f"{' (MJPEG パススルー)' if self.passthrough else ''}")
 
-    def _reset(self):
-        """フレーム取得エラー時にデバイスをリセットする。"""
-        print("[Camera] デバイスをリセット中...")
-        with self.lock:
-            self.frame = None
-        self._open()
+    def health(self):
+        """ステータスに載せる接続状態。"""
+        retry_in = None
+        if self.state == STATE_RECONNECTING and self.retry_at is not None:
+            retry_in = round(max(0.0, self.retry_at - time.monotonic()), 1)
+        return {
+            "camera_state": self.state,
+            "camera_reconnects": self.reconnects,
+            "camera_retry_in": retry_in,
+        }
 
     def start(self):
         if self.is_running:
             return
         self.is_running = True
+        self._stop_event.clear()
         self.thread = threading.Thread(target=self._update, daemon=True)
         self.thread.start()
 
+    def _replay(self):
+        """動画ファイルをコンテナのタイムスタンプに合わせて（または最大速度で）再生する。"""
+        base_ts = None     # 再生開始（ループ先頭）時点の PTS
+        base_clock = None  # 上記に対応する実時間
+        frames_read = 0    # 先頭（ループ後の先頭を含む）から読めたフレーム数
+        self.state = STATE_ONLINE
+        while self.is_running:
+            with metrics.timer('capture'):
+                ret, frame = self.cap.read()
+            if not ret:
+                # 先頭から 1 フレームも読めない場合は、ループしても CPU を空回りさせるだけなので終了する
+                if self.loop and frames_read > 0:
+                    self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    base_ts = None
+                    frames_read = 0
+                    continue
+                if frames_read == 0:
+                    print(f"[Camera] ファイル {self.source} からフレームを読み込めません。")
+                print(f"[Camera] ファイル {self.source} の再生が終了しました。")
+                self.finished = True
+                self.state = STATE_FINISHED
+                break
+
+            frames_read += 1
+            ts = self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            if self.replay == 'realtime':
+                if base_ts is None:
+                    base_ts, base_clock = ts, time.monotonic()
+                delay = base_clock + (ts - base_ts) - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            with self.lock:
+                self.frame = frame
+                self.frame_seq += 1
+                self.frame_timestamp = ts
+                self.frame_captured_at = time.monotonic()
+
+    def _read_latest(self):
+        """
+        バッファ済みの古いフレームを grab() で読み捨て（デコードしない）、最新フレームのみ retrieve する。
+        ドライバーのタイムスタンプが 1.5 フレーム以上前なら、より新しいフレームが届いているとみなす。
+        タイムスタンプがない場合は、grab() が待たずに返ったフレームをバッファ済みとみなす。
+        戻り値: (ret, frame, 到着時刻)
+        """
+        interval = 1.0 / (self.cap.get(cv2.CAP_PROP_FPS) or 30.0)
+        discarded = 0
+        for _ in range(DRAIN_LIMIT):
+            start = time.monotonic()
+            if not self.cap.grab():
+                return False, None, None
+            arrived = time.monotonic()
+            ts = self._driver_timestamp()
+            if ts is not None:
+                stale = arrived - ts > interval * STALE_FRAMES
+            else:
+                stale = arrived - start < interval * DRAIN_FRESH_RATIO
+            if not stale:
+                break
+            discarded += 1
+        else:
+            discarded -= 1  # 上限に達した場合は最後に grab したフレームを使う
+        if discarded:
+            metrics.inc('frames_drained_total', discarded, stage='capture')
+        ret, frame = self.cap.retrieve()
+        return ret, frame, arrived
+
+    def _driver_timestamp(self):
+        """V4L2 のバッファタイムスタンプ（CLOCK_MONOTONIC）を time.monotonic の値で返す。取得できない場合は None。"""
+        ts = self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        age = time.monotonic() - ts
+        return ts if 0.0 <= age < DRIVER_TS_MAX_AGE else None
+
     def _update(self):
-        consecutive_failures = 0
-        MAX_FAILURES = 10  # 連続失敗許容回数
+        if self.is_file:
+            self._replay()
+        else:
+            self._supervise()
+
+    def _wait_backoff(self, backoff):
+        """再接続まで待機する（stop() で中断）。次回の待ち時間を返す。"""
+        delay = backoff * random.uniform(1.0 - RECONNECT_JITTER, 1.0 + RECONNECT_JITTER)
+        self.retry_at = time.monotonic() + delay
+        print(f"[Camera] デバイス {self.source}: {delay:.1f}秒後に再接続します...")
+        self._stop_event.wait(delay)
+        self.retry_at = None
+        return min(RECONNECT_MAX, backoff * 2)
 
+    def _supervise(self):
+        """
+        デバイスの接続を維持する。切断・オープン失敗時は指数バックオフで再接続を繰り返し、
+        短時間で切断を繰り返すデバイス（不安定な USB ハブなど）でも再接続の頻度が上がらないようにする。
+        """
+        backoff = RECONNECT_BASE
+        connected_before = False
         while self.is_running:
             if self.cap is None or not self.cap.isOpened():
-                try:
-                    self._reset()
-                    consecutive_failures = 0
-                except RuntimeError as e:
-                    print(e)
-                    break
-
-            ret, frame = self.cap.read()
+                if self.state != STATE_CONNECTING:
+                    self.state = STATE_RECONNECTING
+                if not self._open():
+                    # 初回接続の失敗も再接続待ちとして扱い、次の試行までの秒数をステータスに出す
+                    self.state = STATE_RECONNECTING
+                    backoff = self._wait_backoff(backoff)
+                    continue
+                if connected_before:
+                    self.reconnects += 1
+            connected_before = True
+            self.state = STATE_ONLINE
+            online_since = time.monotonic()
+
+            self._capture_loop()
+            if not self.is_running:
+                break
+
+            # 切断: 古いフレームを破棄し、安定していた場合はすぐに、そうでなければ待ってから再接続する
+            print(f"[Camera] デバイス {self.source} との接続が切れました。")
+            self.state = STATE_RECONNECTING
+            with self.lock:
+                self.frame = None
+                self.jpeg = None
+            self._release()
+            if time.monotonic() - online_since >= STABLE_SECONDS:
+                backoff = RECONNECT_BASE
+            else:
+                backoff = self._wait_backoff(backoff)
+
+    def _capture_loop(self):
+        """フレームを取得し続ける。連続して取得に失敗した（切断された）場合に戻る。"""
+        consecutive_failures = 0
+        while self.is_running:
+            low_latency = bool(self.capture.get('low_latency'))
+            try:
+                with metrics.timer('capture'):
+                    if low_latency:
+                        ret, frame, arrived = self._read_latest()
+                    else:
+                        ret, frame = self.cap.read()
+                        arrived = time.monotonic()
+            except cv2.error as e:
+                print(f"[Camera] {e}")
+                ret = False  # デバイスが取り外された場合など
             if not ret:
                 consecutive_failures += 1
                 print(f"[Camera] フレーム取得失敗 ({consecutive_failures}/{MAX_FAILURES})")
                 if consecutive_failures >= MAX_FAILURES:
-                    print("[Camera] 連続失敗のためデバイスをリセットします。")
-                    try:
-                        self._reset()
-                        consecutive_failures = 0
-                    except RuntimeError as e:
-                        print(e)
-                        break
-                time.sleep(0.5)
+                    return
+                self._stop_event.wait(FAILURE_WAIT)
                 continue
 
             consecutive_failures = 0
+            if self.passthrough and frame.ndim == 3:
+                # バックエンドが CONVERT_RGB=0 を無視してデコード済みの画像を返した
+                print("[Camera] デバイスがデコード済みのフレームを返したため、MJPEG パススルーを無効にします。")
+                self.passthrough = False
+            captured_at = self._driver_timestamp() or arrived
+            self.capture_latency += LATENCY_ALPHA * (time.monotonic() - captured_at - self.capture_latency)
             with self.lock:
-                self.frame = frame
-            time.sleep(0.01)  # CPU負荷軽減
+                if self.passthrough:
+                    self.jpeg = frame.tobytes()  # 1xN の JPEG データ（デコードは get_frame で必要時のみ）
+                else:
+                    self.frame = frame
+                self.frame_seq += 1
+                self.frame_timestamp = time.time()
+                self.frame_captured_at = captured_at
+            if not low_latency:
+                time.sleep(0.01)  # CPU負荷軽減（低遅延モードでは grab() が次のフレームまで待機する）
+
+    def get_frame(self, meta=False):
+        """
+        最新フレームのコピーを返す。
+        meta=True の場合は (フレーム, 通し番号, 撮像時刻) を返す（遅延の算出用）。
+        """
+        if not self.passthrough:
+            with self.lock:
+                frame = self.frame.copy() if self.frame is not None else None
+                seq, captured_at = self.frame_seq, self.frame_captured_at
+            return (frame, seq, captured_at) if meta else frame
+
+        with self.lock:
+            jpeg, seq, captured_at = self.jpeg, self.frame_seq, self.frame_captured_at
+        frame = None
+        if jpeg is not None:
+            with self._decode_lock:
+                if self._decoded_seq != seq:
+                    flag = DECODE_FLAGS.get(int(self.capture.get('decode_scale') or 1), cv2.IMREAD_COLOR)
+                    with metrics.timer('decode'):
+                        self._decoded = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), flag)
+                    self._decoded_seq = seq
+                frame = self._decoded.copy() if self._decoded is not None else None
+        return (frame, seq, captured_at) if meta else frame
 
-    def get_frame(self):
+    def get_jpeg(self):
+        """パススルー時の最新フレームを (通し番号, JPEG バイト列) で返す（それ以外は None）。"""
+        if not self.passthrough:
+            return None
         with self.lock:
-            return self.frame.copy() if self.frame is not None else None
+            return (self.frame_seq, self.jpeg) if self.jpeg is not None else None
 
     def stop(self):
         self.is_running = False
+        self._stop_event.set()
         if hasattr(self, 'thread'):
             self.thread.join(timeout=3)
-        if self.cap:
-            self.cap.release()
+        self._release()
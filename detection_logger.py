@@ -12,6 +12,7 @@ class DetectionLogger:
     def __init__(self, log_path=LOG_FILE):
         self.log_path = log_path
         self._lock = threading.Lock()
+        self._listeners = []
         # ヘッダーが存在しなければ初期化
         if not os.path.exists(self.log_path):
             with open(self.log_path, 'w', newline='', encoding='utf-8') as f:
@@ -31,6 +32,15 @@ class DetectionLogger:
             with open(self.log_path, 'a', newline='', encoding='utf-8') as f:
                 writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
                 writer.writerow(row)
+        for callback in self._listeners:
+            try:
+                callback(dict(row))
+            except Exception as e:
+                print(f"[Logger] Listener error: {e}")
+
+    def add_listener(self, callback):
+        """記録のたびに追加された行 (dict) を受け取るコールバックを登録する。"""
+        self._listeners.append(callback)
 
     def read_recent(self, n=50):
         """直近 n 件のログを新しい順に返す。"""
@@ -54,3 +64,26 @@ class DetectionLogger:
                     if row['timestamp'].startswith(date_str):
                         results.append(row)
             return list(reversed(results))
+
+    def forget_paths(self, paths):
+        """削除されたファイルへの参照 (snapshot_path / video_path) をログから取り除く。"""
+        removed = {os.path.abspath(p) for p in paths}
+        with self._lock:
+            if not os.path.exists(self.log_path):
+                return
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                rows = list(csv.DictReader(f))
+            changed = False
+            for row in rows:
+                for key in ('snapshot_path', 'video_path'):
+                    if row.get(key) and os.path.abspath(row[key]) in removed:
+                        row[key] = ''
+                        changed = True
+            if not changed:
+                return
+            tmp_path = self.log_path + '.tmp'
+            with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+                writer.writeheader()
+                writer.writerows(rows)
+            os.replace(tmp_path, self.log_path)
@@ -2,6 +2,9 @@ import cv2
 import numpy as np
 import json
 import os
+import time
+
+from metrics import metrics
 
 # TFLite ランタイムを動的にインポート（tflite_runtime または tensorflow.lite を使用）
 try:
@@ -106,19 +109,33 @@ class HumanDetector:
             resized = (np.float32(resized) - 127.5) / 127.5
         return np.expand_dims(resized, axis=0)
 
-    def detect(self, frame):
+    def detect(self, frame, timings=None):
         """
         フレームを解析してオブジェクトを検知する。
+        timings に dict を渡すと、段階ごとの所要秒数を 'preprocess' / 'invoke' / 'postprocess' キーに格納する。
         戻り値: list of (x, y, w, h, score, class_id) — フレーム内の絶対座標
         """
         if self.interpreter is None:
             return []
 
         h, w = frame.shape[:2]
+        t0 = time.perf_counter()
         input_data = self._preprocess(frame)
+        t1 = time.perf_counter()
         self.interpreter.set_tensor(self.input_details[0]['index'], input_data)
         self.interpreter.invoke()
+        t2 = time.perf_counter()
+        detections = self._postprocess(w, h)
+        t3 = time.perf_counter()
+
+        for stage, seconds in (('preprocess', t1 - t0), ('invoke', t2 - t1), ('postprocess', t3 - t2)):
+            metrics.observe(stage, seconds)
+            if timings is not None:
+                timings[stage] = seconds
+        return detections
 
+    def _postprocess(self, w, h):
+        """出力テンソルから閾値以上の検知結果を取り出す。"""
         try:
             # 範囲チェック付きでテンソル取得
             num_ops = len(self.output_details)
@@ -0,0 +1,327 @@
+"""
+複数カメラで共有する推論スケジューラー。
+HumanDetector（TFLite インタープリター）をワーカー数だけ用意して各ワーカースレッドが専有し、
+カメラごとに差し出された最新フレームを、動き・検知状況に応じた重みで公平に割り当てる（ストライドスケジューリング）。
+processes=True の場合、インタープリターは別プロセスで動作し、フレームは共有メモリで受け渡す
+（Web サーバー・描画・録画と GIL を取り合わず、推論に専用のコアを使える）。
+"""
+import multiprocessing
+import threading
+import time
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from detector import HumanDetector
+from metrics import metrics
+
+MOTION_SIZE = (64, 48)   # 動き量の算出に使う縮小画像サイズ
+MOTION_FULL = 20.0       # この平均輝度差 (0-255) で動きによる重みが最大になる
+MOTION_WEIGHT = 3.0      # 動きによる重みの最大値
+ACTIVE_WEIGHT = 4.0      # 直近に検知があったカメラへの追加の重み
+ACTIVE_HOLD = 10.0       # 検知後に ACTIVE_WEIGHT を維持する秒数
+BASE_WEIGHT = 1.0        # 静止しているカメラにも最低限割り当てる重み
+REOFFER_GRACE = 0.01     # 推論結果を返した直後のカメラが次のフレームを差し出すまで待つ秒数
+
+PROCESS_START_TIMEOUT = 60.0  # 推論プロセスのモデル読み込みを待つ最大秒数
+PROCESS_TIMEOUT = 10.0        # 1 フレームの推論結果を待つ最大秒数（超えた場合はプロセスを再起動）
+PROCESS_RESTART_INTERVAL = 5.0  # 推論プロセスが停止した後、再起動を試みるまでの秒数
+
+
+def _process_main(conn, model_path, threshold):
+    """
+    推論プロセスの本体。
+    要求 (共有メモリ名, フレーム形状, 閾値, クラス名の再読み込み) を受け取り、共有メモリ上のフレームを推論して
+    [前処理秒, 推論秒, 後処理秒, x, y, w, h, score, class_id, ...] の float32 配列を返す。
+    """
+    detector = HumanDetector(model_path=model_path, threshold=threshold)
+    conn.send(detector.interpreter is not None)  # 準備完了
+    shm = None
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break
+        if request is None:
+            break
+        name, shape, threshold, refresh = request
+        if refresh:
+            detector.refresh_classes()
+        if shm is None or shm.name != name:
+            # 親プロセスがより大きいフレーム用に領域を作り直した
+            if shm is not None:
+                shm.close()
+            shm = shared_memory.SharedMemory(name=name)
+        detector.threshold = threshold
+        frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        timings = {}
+        detections = detector.detect(frame, timings=timings)
+        del frame  # 共有メモリを close する前にビューを解放する
+        reply = np.empty(3 + 6 * len(detections), dtype=np.float32)
+        reply[:3] = [timings.get(stage, 0.0) for stage in ('preprocess', 'invoke', 'postprocess')]
+        if detections:
+            reply[3:] = np.asarray(detections, dtype=np.float32).ravel()
+        conn.send_bytes(reply.tobytes())
+    if shm is not None:
+        shm.close()
+
+
+class ProcessDetector:
+    """
+    別プロセスの HumanDetector を呼び出す代理オブジェクト（detect のみ）。
+    フレームは pickle せずに共有メモリへコピーし、検知結果は小さな float32 配列で受け取る。
+    推論プロセスが応答しない・終了した場合は再起動し、そのフレームは検知なしとして扱う。
+    """
+    def __init__(self, model_path, threshold=0.5, index=0):
+        self.model_path = model_path
+        self.threshold = float(threshold)
+        self.index = index
+        # fork ではカメラ・Web サーバーのスレッドやロックの状態まで複製されるため spawn を使う
+        self._ctx = multiprocessing.get_context('spawn')
+        self._shm = None
+        self._conn = None
+        self._proc = None
+        self._next_start = 0.0
+        self.failures = 0  # 推論プロセスの停止・応答なし・再起動待ちのため検知できなかったフレーム数
+        self._refresh = False  # 次の要求で推論プロセスにクラス名の再読み込みを指示する
+        self._start()
+
+    def _start(self):
+        self._next_start = time.monotonic() + PROCESS_RESTART_INTERVAL
+        parent_conn, child_conn = self._ctx.Pipe()
+        self._proc = self._ctx.Process(
+            target=_process_main, args=(child_conn, self.model_path, self.threshold),
+            daemon=True, name=f'infer-proc-{self.index}')
+        self._proc.start()
+        child_conn.close()
+        self._conn = parent_conn
+        if parent_conn.poll(PROCESS_START_TIMEOUT):
+            try:
+                loaded = parent_conn.recv()
+                print(f"[Inference] Process {self.index} ready (pid {self._proc.pid}, "
+                      f"{'tflite' if loaded else 'mock'}).")
+                return
+            except (EOFError, OSError):
+                pass
+        print(f"[Inference] Process {self.index} failed to start.")
+        self._kill()
+
+    def _kill(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._proc is not None:
+            self._proc.join(timeout=1)
+            if self._proc.is_alive():
+                self._proc.kill()
+                self._proc.join(timeout=1)
+            self._proc = None
+
+    def _buffer(self, nbytes):
+        """フレームを書き込む共有メモリ（足りない場合は作り直す）。"""
+        if self._shm is None or self._shm.size < nbytes:
+            if self._shm is not None:
+                self._shm.close()
+                self._shm.unlink()  # 推論プロセス側のマッピングは次の要求で切り替わるまで有効
+            self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        return self._shm
+
+    def refresh_classes(self):
+        """推論プロセス側の HumanDetector にクラス名を再読み込みさせる（次の detect 要求と一緒に送る）。"""
+        self._refresh = True
+
+    def detect(self, frame):
+        """HumanDetector.detect と同じ形式 [(x, y, w, h, score, class_id), ...] を返す。"""
+        if self._conn is None:
+            if time.monotonic() < self._next_start:
+                self.failures += 1
+                return []
+            self._start()
+            if self._conn is None:
+                self.failures += 1
+                return []
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        shm = self._buffer(frame.nbytes)
+        np.ndarray(frame.shape, dtype=np.uint8, buffer=shm.buf)[...] = frame
+        try:
+            refresh, self._refresh = self._refresh, False
+            self._conn.send((shm.name, frame.shape, self.threshold, refresh))
+            if not self._conn.poll(PROCESS_TIMEOUT):
+                raise TimeoutError(f"no reply in {PROCESS_TIMEOUT}s")
+            reply = np.frombuffer(self._conn.recv_bytes(), dtype=np.float32)
+        except (EOFError, OSError, TimeoutError) as e:
+            print(f"[Inference] Process {self.index} lost ({e}). Restarting...")
+            self._kill()
+            self.failures += 1
+            return []
+
+        for stage, seconds in zip(('preprocess', 'invoke', 'postprocess'), reply[:3]):
+            metrics.observe(stage, float(seconds))
+        return [(int(x), int(y), int(w), int(h), float(score), int(class_id))
+                for x, y, w, h, score, class_id in reply[3:].reshape(-1, 6)]
+
+    def stop(self):
+        if self._conn is not None:
+            try:
+                self._conn.send(None)
+            except (OSError, ValueError):
+                pass
+        self._kill()
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+class _Slot:
+    """カメラごとの推論待ちフレームとスケジューリング状態。"""
+    def __init__(self, cam_id, callback):
+        self.cam_id = cam_id
+        self.callback = callback  # callback(detections) — ワーカースレッドから呼ばれる
+        self.frame = None         # 推論待ちの最新フレーム（新しいフレームで上書き）
+        self.pass_value = 0.0     # 仮想時間。小さいカメラから順に推論する
+        self.weight = BASE_WEIGHT
+        self.motion = 0.0
+        self.last_active = 0.0
+        self.prev_thumb = None
+        self.served = 0
+        self.returned_at = 0.0    # 直近の推論結果を返した時刻
+        self.in_flight = False
+
+
+class InferenceScheduler:
+    """
+    インタープリタープールと、カメラ間で推論時間を配分するスケジューラー。
+    重み = 基本値 + 動き量 + 直近の検知。重みの比率で推論回数が配分される。
+    processes=True の場合、各ワーカースレッドは専用の推論プロセス（ProcessDetector）に処理を委ねる。
+    """
+    def __init__(self, model_path, threshold=0.5, workers=1, processes=False):
+        workers = max(1, int(workers))
+        if processes:
+            # 描画・クラス名・モデル情報の参照用（推論には使わない）
+            self._local = HumanDetector(model_path=model_path, threshold=threshold)
+            self.detectors = [ProcessDetector(model_path, threshold, index=i) for i in range(workers)]
+        else:
+            self.detectors = [HumanDetector(model_path=model_path, threshold=threshold)
+                              for _ in range(workers)]
+            self._local = self.detectors[0]
+        self._slots = {}
+        self._vtime = 0.0  # 直近に推論したカメラの仮想時間
+        self._cond = threading.Condition()
+        self._running = True
+        self._threads = []
+        for i, detector in enumerate(self.detectors):
+            t = threading.Thread(target=self._worker, args=(detector,), daemon=True, name=f'infer-{i}')
+            t.start()
+            self._threads.append(t)
+        print(f"[Inference] {len(self.detectors)} interpreter worker(s) started"
+              f"{' (separate processes)' if processes else ''}.")
+
+    @property
+    def detector(self):
+        """クラス名の参照・検知枠の描画・モデル情報に使う代表の検出器。"""
+        return self._local
+
+    @property
+    def threshold(self):
+        return self._local.threshold
+
+    @threshold.setter
+    def threshold(self, value):
+        self._local.threshold = float(value)
+        for detector in self.detectors:
+            detector.threshold = float(value)
+
+    def refresh_classes(self):
+        """coco_classes.json の変更を代表の検出器と全ワーカー（推論プロセスを含む）に反映する。"""
+        for detector in {id(d): d for d in [self._local] + self.detectors}.values():
+            detector.refresh_classes()
+
+    def register(self, cam_id, callback):
+        with self._cond:
+            self._slots[cam_id] = _Slot(cam_id, callback)
+
+    def _motion(self, slot, frame):
+        """直前に差し出されたフレームとの平均輝度差。"""
+        thumb = cv2.cvtColor(cv2.resize(frame, MOTION_SIZE, interpolation=cv2.INTER_AREA),
+                             cv2.COLOR_BGR2GRAY)
+        prev, slot.prev_thumb = slot.prev_thumb, thumb
+        return float(cv2.absdiff(thumb, prev).mean()) if prev is not None else 0.0
+
+    def offer(self, cam_id, frame):
+        """カメラの最新フレームを推論待ちにする（未処理のフレームがあれば置き換える）。"""
+        slot = self._slots[cam_id]
+        motion = self._motion(slot, frame)
+        with self._cond:
+            slot.motion = motion
+            active = time.time() - slot.last_active < ACTIVE_HOLD
+            slot.weight = (BASE_WEIGHT + MOTION_WEIGHT * min(1.0, motion / MOTION_FULL)
+                           + (ACTIVE_WEIGHT if active else 0.0))
+            if slot.frame is None:
+                # 待機していたカメラが溜めた分を一度に消費しないよう、仮想時間を現在に揃える
+                slot.pass_value = max(slot.pass_value, self._vtime)
+            slot.frame = frame
+            self._cond.notify()
+
+    def mark_active(self, cam_id):
+        """検知対象が映っていることを通知する（一定時間、推論の割り当てを増やす）。"""
+        slot = self._slots.get(cam_id)
+        if slot is not None:
+            slot.last_active = time.time()
+
+    def _worker(self, detector):
+        while True:
+            with self._cond:
+                slot = self._pick()
+                while self._running and slot is None:
+                    has_pending = any(s.frame is not None for s in self._slots.values())
+                    self._cond.wait(REOFFER_GRACE if has_pending else None)
+                    slot = self._pick()
+                if not self._running:
+                    return
+                frame, slot.frame = slot.frame, None
+                self._vtime = slot.pass_value
+                slot.pass_value += 1.0 / slot.weight
+                slot.served += 1
+                slot.in_flight = True
+            try:
+                detections = detector.detect(frame)
+            except Exception as e:
+                print(f"[Inference] {slot.cam_id}: {e}")
+                detections = []
+            slot.callback(detections)
+            with self._cond:
+                slot.in_flight = False
+                slot.returned_at = time.monotonic()
+
+    def _pick(self):
+        """
+        仮想時間が最小のカメラを選ぶ（ロック取得済みで呼ぶ）。
+        各カメラは結果を受け取ってから次のフレームを差し出すため、順番が来ているカメラが
+        結果を返した直後であれば、他のカメラに割り当てる前に少しだけ待つ。
+        """
+        pending = [s for s in self._slots.values() if s.frame is not None]
+        if not pending:
+            return None
+        waiting = [s for s in self._slots.values() if s.frame is None and not s.in_flight
+                   and time.monotonic() - s.returned_at < REOFFER_GRACE]
+        best = min(pending + waiting, key=lambda s: s.pass_value)
+        return best if best.frame is not None else None
+
+    def stats(self):
+        """カメラごとの重み・動き量・推論回数（ステータス表示用）。"""
+        with self._cond:
+            return {s.cam_id: {"weight": round(s.weight, 2), "motion": round(s.motion, 1),
+                               "inferences": s.served}
+                    for s in self._slots.values()}
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout=2)
+        for detector in self.detectors:
+            if isinstance(detector, ProcessDetector):
+                detector.stop()
@@ -0,0 +1,143 @@
+import os
+import time
+import tempfile
+import threading
+import subprocess
+
+import cv2
+from werkzeug.security import safe_join
+
+PLAYLIST = 'index.m3u8'
+IDLE_TIMEOUT = 30.0  # プレイリストの取得が途絶えてから FFmpeg を停止するまでの秒数
+
+# エンコーダーごとの FFmpeg 引数。Raspberry Pi 4 ではハードウェアエンコーダー (h264_v4l2m2m) を推奨
+ENCODER_ARGS = {
+    'libx264': ['-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency'],
+    'h264_v4l2m2m': ['-c:v', 'h264_v4l2m2m'],
+}
+
+
+def default_output_dir():
+    """セグメントの書き出し先。SD カードへの書き込みを避けるため tmpfs (/dev/shm) を優先する。"""
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'cam_live')
+
+
+class LiveStreamer:
+    """
+    H.264 / fMP4 セグメントの HLS による低帯域ライブ配信モジュール。
+    視聴者がプレイリストを取得している間だけ FFmpeg を起動し、一定時間アクセスがなければ停止する。
+    """
+    def __init__(self, frame_source, output_dir=None, resolution=(640, 480), fps=10,
+                 bitrate_kbps=600, encoder='libx264', idle_timeout=IDLE_TIMEOUT):
+        self.frame_source = frame_source  # 配信用 BGR フレームを返す callable
+        self.output_dir = output_dir or default_output_dir()
+        self.resolution = tuple(resolution)
+        self.fps = fps
+        self.bitrate_kbps = bitrate_kbps
+        self.encoder = encoder if encoder in ENCODER_ARGS else 'libx264'
+        self.idle_timeout = idle_timeout
+
+        self._process = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._last_access = 0.0
+
+    def _command(self):
+        w, h = self.resolution
+        rate = int(self.bitrate_kbps) * 1000
+        gop = str(int(self.fps))  # 1 秒ごとにキーフレーム（= セグメント境界）
+        return ([
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f"{w}x{h}", '-r', str(self.fps), '-i', '-',
+        ] + ENCODER_ARGS[self.encoder] + [
+            '-pix_fmt', 'yuv420p', '-b:v', str(rate), '-maxrate', str(rate), '-bufsize', str(rate * 2),
+            '-g', gop, '-keyint_min', gop, '-sc_threshold', '0',
+            '-f', 'hls', '-hls_time', '1', '-hls_list_size', '6',
+            '-hls_flags', 'delete_segments+independent_segments+omit_endlist',
+            '-hls_segment_type', 'fmp4', '-hls_fmp4_init_filename', 'init.mp4',
+            '-hls_segment_filename', os.path.join(self.output_dir, 'seg_%05d.m4s'),
+            os.path.join(self.output_dir, PLAYLIST),
+        ])
+
+    def touch(self):
+        """視聴者のアクセスを記録し、停止中であれば配信を開始する。"""
+        self._last_access = time.time()
+        with self._lock:
+            if self._process is not None and self._process.poll() is None:
+                return
+            self._start()
+
+    def _start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        for name in os.listdir(self.output_dir):  # 前回のセグメントを破棄
+            try:
+                os.remove(os.path.join(self.output_dir, name))
+            except OSError:
+                pass
+        try:
+            self._process = subprocess.Popen(self._command(), stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except Exception as e:
+            print(f"[Live] Failed to launch FFmpeg: {e}")
+            self._process = None
+            return
+        print(f"[Live] HLS stream started ({self.encoder}, {self.resolution[0]}x{self.resolution[1]} @ {self.fps}fps)")
+        self._thread = threading.Thread(target=self._feeder, args=(self._process,), daemon=True)
+        self._thread.start()
+
+    def _feeder(self, proc):
+        """一定のフレームレートで最新フレームを FFmpeg へ送る（新しいフレームがなければ直前のフレームを再送）。"""
+        interval = 1.0 / self.fps
+        next_t = time.time()
+        last = None
+        while proc.poll() is None:
+            if time.time() - self._last_access > self.idle_timeout:
+                break
+            frame = self.frame_source()
+            if frame is not None:
+                if frame.shape[1::-1] != self.resolution:
+                    frame = cv2.resize(frame, self.resolution)
+                last = frame
+            if last is not None:
+                try:
+                    proc.stdin.write(last.tobytes())
+                except (BrokenPipeError, ValueError, OSError) as e:
+                    print(f"[Live] FFmpeg pipe error: {e}")
+                    break
+            next_t += interval
+            time.sleep(max(0.0, next_t - time.time()))
+        self._stop(proc)
+
+    def _stop(self, proc):
+        try:
+            proc.stdin.close()
+            proc.wait(timeout=5)
+        except Exception:
+            proc.kill()
+        with self._lock:
+            if self._process is proc:
+                self._process = None
+        print("[Live] HLS stream stopped (idle).")
+
+    def wait_ready(self, timeout=10.0):
+        """最初のセグメントを含むプレイリストが書き出されるまで待つ。"""
+        path = os.path.join(self.output_dir, PLAYLIST)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if os.path.exists(path):
+                return True
+            if self._process is None:
+                return False
+            time.sleep(0.1)
+        return False
+
+    def resolve(self, filename):
+        """配信ディレクトリ内のファイルパスを返す（範囲外・存在しない場合は None）。"""
+        path = safe_join(self.output_dir, filename)
+        return path if path and os.path.isfile(path) else None
+
+    def stop(self):
+        with self._lock:
+            proc = self._process
+        if proc is not None:
+            self._last_access = 0.0  # フィーダーに停止させる
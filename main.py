@@ -4,18 +4,53 @@ import threading
 import datetime
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from camera import Camera
-from detector import HumanDetector
-from notifier import TelegramNotifier
+from inference import InferenceScheduler
+from pipeline import CameraPipeline, new_status
+from notifier import TelegramNotifier, NotificationScheduler
 from recorder import Recorder
 from detection_logger import DetectionLogger
-import web_stream
+from storage import StorageManager
+from metrics import metrics
 from web_stream import run_server, system_status
 
 def load_config():
     with open('config.json', 'r', encoding='utf-8') as f:
         return json.load(f)
 
+def storage_policy(config):
+    """config.json の保持設定を StorageManager.configure の引数に変換する。"""
+    return {
+        "retention_days": config.get('storage_retention_days', 0),
+        "max_bytes": int(float(config.get('storage_max_gb', 0)) * 1024 ** 3),
+        "min_free_bytes": int(float(config.get('storage_min_free_mb', 0)) * 1024 ** 2),
+    }
+
+CAPTURE_KEYS = ('fourcc', 'width', 'height', 'fps', 'buffer_size', 'mjpeg_passthrough', 'decode_scale',
+                'low_latency')
+
+def camera_specs(config):
+    """
+    config.json の cameras（未指定時は video_source の 1 台）を
+    [{"id", "name", "video_source", "replay_mode", "replay_loop", "capture"}] に正規化する。
+    capture は capture_* 設定（カメラごとに上書き可）。
+    """
+    specs = config.get('cameras') or [{"id": "cam0", "video_source": config['video_source']}]
+    result = []
+    for i, spec in enumerate(specs):
+        cam_id = str(spec.get('id', f"cam{i}"))
+        result.append({
+            "id": cam_id,
+            "name": spec.get('name', cam_id),
+            "video_source": spec.get('video_source', i),
+            "replay_mode": spec.get('replay_mode', config.get('replay_mode', 'realtime')),
+            "replay_loop": spec.get('replay_loop', config.get('replay_loop', False)),
+            "capture": {key: spec.get(f'capture_{key}', config.get(f'capture_{key}'))
+                        for key in CAPTURE_KEYS},
+        })
+    return result
+
 def main():
     print("Starting Monitoring Camera System...")
     config = load_config()
@@ -23,177 +58,193 @@ def main():
     # 保存ディレクトリの作成
     os.makedirs(config['save_directory'], exist_ok=True)
 
-    # モジュールの初期化
-    cam      = Camera(source=config['video_source'])
-    detector = HumanDetector(
+    # 保存先 (YYYY/MM/DD 分割) と保持ポリシー
+    storage  = StorageManager(
+        root=config['save_directory'],
+        **storage_policy(config))
+
+    # モジュールの初期化（推論用インタープリターは全カメラで共有）
+    inference = InferenceScheduler(
         model_path=config['model_path'],
-        threshold=config['detection_threshold'])
+        threshold=config['detection_threshold'],
+        workers=config.get('inference_workers', 1),
+        processes=config.get('inference_process', False))
     notifier = TelegramNotifier(
         config['telegram_token'],
-        config['telegram_chat_id'])
-    recorder = Recorder(
-        save_directory=config['save_directory'],
-        resolution=(config.get('recorder_width', 1280), config.get('recorder_height', 720)),
-        pre_frames=config.get('recorder_pre_frames', 60))
-    logger   = DetectionLogger()
-
-    # Webサーバーを別スレッドで起動
-    web_thread = threading.Thread(
-        target=run_server, args=(cam, logger, detector, notifier), daemon=True)
-    web_thread.start()
-
-    cam.start()
-    print("System is running. Press 'q' to quit.")
-    print("Web UI: http://0.0.0.0:5000")
-
-    detection_session_start = None
-    last_target_time = 0
-    session_notified = False 
-    
-    # 遅延通知用バッファ
-    pending_notification = {
-        "frame": None,
-        "summary": "",
-        "max_score": 0.0,
-        "human_count": 0,
-        "video_path": None
-    }
-
-    def process_deferred_notification(notif_data, current_config):
-        """録画終了後に別スレッドで実行される通知処理"""
+        config['telegram_chat_id'],
+        api_base=config.get('telegram_api_base', 'https://api.telegram.org'),
+        video_max_bytes=int(float(config.get('telegram_video_max_mb', 20)) * 1024 ** 2),
+        video_max_height=config.get('telegram_video_max_height', 480))
+    scheduler = NotificationScheduler(notifier, interval=config.get('notify_interval', 60))
+    # 通知処理用のワーカープール（スレッド数を制限）
+    notify_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='notify')
+    notify_backlog = {"submitted": 0, "completed": 0}  # /api/metrics 用（プール内部のキューは参照しない）
+    notify_backlog_lock = threading.Lock()
+
+    def on_notification_done(_future):
+        with notify_backlog_lock:
+            notify_backlog["completed"] += 1
+
+    def submit_notification(*args):
+        with notify_backlog_lock:
+            notify_backlog["submitted"] += 1
         try:
+            future = notify_pool.submit(process_deferred_notification, *args)
+        except RuntimeError:  # 終了処理中（プール停止後）
+            on_notification_done(None)
+            raise
+        future.add_done_callback(on_notification_done)
+
+    def notification_backlog():
+        with notify_backlog_lock:
+            return notify_backlog["submitted"] - notify_backlog["completed"]
+
+    def process_deferred_notification(pipeline, notif_data, current_config, clip=None):
+        """録画ファイル確定後にワーカープールで実行される通知処理"""
+        try:
+            clip_info = None
+            if clip is not None:
+                try:
+                    clip_info = clip.result()  # 完了済み（done callback から呼ばれる）
+                except Exception as e:
+                    print(f"[Main] Recording failed, notifying without video: {e}")
+            video_path = clip_info["path"] if clip_info else None
+
             mode = current_config.get('telegram_notify_mode', 'photo')
-            save_dir = current_config['save_directory']
             
             # 1. 静止画の保存
             snap_w = current_config.get('snapshot_width', 1280)
             snap_h = current_config.get('snapshot_height', 720)
             snap_frame = cv2.resize(notif_data["frame"], (snap_w, snap_h))
             
+            # 保存した JPEG をそのまま送信にも使う（送信キュー用に再度書き込まない）
+            ok, jpeg = cv2.imencode('.jpg', snap_frame)
+            if not ok:
+                raise RuntimeError("snapshot encode failed")
+
             snap_ts = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-            snap_path = os.path.join(save_dir, f"snap_{snap_ts}.jpg")
-            cv2.imwrite(snap_path, snap_frame)
+            snap_path = storage.path_for(f"{pipeline.recorder.prefix}snap_{snap_ts}.jpg")
+            with open(snap_path, 'wb') as f:
+                f.write(jpeg.tobytes())
+            storage.mark_finalized(snap_path)
+
+            summary = notif_data["summary"]
+            if len(pipelines) > 1:
+                summary = f"[{pipeline.name}] {summary}"
             
-            # 2. Telegram送信
-            if mode != "none":
-                caption = f"⚠️ 検知通知\n対象: {notif_data['summary']}\n数: {notif_data['human_count']}\n時刻: {datetime.datetime.now().strftime('%H:%M:%S')}"
-                
-                if mode in ["photo", "both"]:
-                    notifier.send_photo(snap_frame, caption=caption)
-                
-                if mode in ["video", "both"]:
-                    # 録画ファイルが確定するまで少し待機（FFmpegの書き出し完了待ち）
-                    time.sleep(1.0) 
-                    if notif_data["video_path"] and os.path.exists(notif_data["video_path"]):
-                        notifier.send_video(notif_data["video_path"], caption=f"📹 録画ファイル: {notif_data['summary']}")
+            # 2. Telegram送信 (notify_interval 内のイベントはスケジューラーがダイジェストにまとめる)
+            scheduler.submit({
+                "photo": snap_path,
+                "summary": summary,
+                "human_count": notif_data["human_count"],
+                "max_score": notif_data["max_score"],
+                "video_path": video_path if mode in ["video", "both"] else None,
+                "time": datetime.datetime.now(),
+            }, mode=mode)
             
             # 3. ログ記録 (動画パスを含める)
-            logger.log(
+            pipeline.logger.log(
                 human_count=notif_data["human_count"],
                 confidence_max=notif_data["max_score"],
                 snapshot_path=snap_path,
-                video_path=notif_data["video_path"])
+                video_path=video_path or '')
                 
-            print(f"[Main] Deferred notification processed successfully (Mode: {mode})")
+            print(f"[Main] Deferred notification processed successfully ({pipeline.id}, Mode: {mode})")
         except Exception as e:
             print(f"[Error] process_deferred_notification: {e}")
 
-    try:
-        while True:
-            current_config = load_config()
-            detector.threshold = float(current_config.get('detection_threshold', 0.5))
-            post_seconds = float(current_config.get('recorder_post_seconds', 5))
-            
-            frame = cam.get_frame()
-            if frame is None:
-                time.sleep(0.01)
-                continue
-
-            all_detections = detector.detect(frame)
-            target_classes = current_config.get('target_classes', [1])
-            target_detections = [d for d in all_detections if d[5] in target_classes]
-
-            if target_detections:
-                frame = detector.draw_detections(frame, all_detections if current_config.get('show_all_detections', True) else target_detections)
+    def on_session_end(pipeline, notif_data, clip, current_config):
+        # 録画ファイルが確定した時点でワーカープールから通知処理を実行
+        if clip is not None:
+            clip.add_done_callback(
+                lambda f, p=pipeline, d=notif_data, c=current_config:
+                    submit_notification(p, d, c, f))
+        else:
+            submit_notification(pipeline, notif_data, current_config)
+
+    # カメラごとのパイプライン（録画・ログ・ステータスはカメラ単位）
+    pipelines = {}
+    for i, spec in enumerate(camera_specs(config)):
+        cam_id = spec["id"]
+        primary = i == 0  # 1 台目は従来のファイル名・ログ・ステータスを使う
+        cam = Camera(
+            source=spec['video_source'],
+            replay=spec['replay_mode'],
+            loop=spec['replay_loop'],
+            capture=spec['capture'])
+        recorder = Recorder(
+            save_directory=config['save_directory'],
+            resolution=(config.get('recorder_width', 1280), config.get('recorder_height', 720)),
+            pre_frames=config.get('recorder_pre_frames', 60),
+            storage=storage,
+            prefix='' if primary else f"{cam_id}_")
+        logger = DetectionLogger() if primary else DetectionLogger(f"detection_log_{cam_id}.csv")
+        storage.add_listener(logger.forget_paths)
+        pipelines[cam_id] = CameraPipeline(
+            cam_id, spec['name'], cam, recorder, logger, inference,
+            status=system_status if primary else new_status(config.get('stream_width', 640),
+                                                               config.get('stream_height', 480)),
+            on_session_end=on_session_end)
+        metrics.register_gauge('recorder_queue_depth', 'Frames waiting to be written to FFmpeg.',
+                               lambda r=recorder: r.queue_depth, camera=cam_id)
+    storage.start()
+    primary = next(iter(pipelines.values()))
+
+    # /api/metrics で出力するキュー長
+    metrics.register_gauge('notify_queue_depth', 'Telegram requests waiting for delivery.',
+                           notifier.queue.pending)
+    metrics.register_gauge('notify_digest_pending', 'Detection events waiting for the next digest.',
+                           scheduler.pending)
+    metrics.register_gauge('notify_pool_backlog', 'Deferred notifications queued or in progress.',
+                           notification_backlog)
 
-            recorder.update_buffer(frame)
-            recorder.write(frame)
+    # Webサーバーを別スレッドで起動
+    web_thread = threading.Thread(
+        target=run_server,
+        args=(primary.camera, primary.logger, inference.detector, notifier, storage, pipelines),
+        daemon=True)
+    web_thread.start()
 
-            if target_detections:
-                last_target_time = time.time()
-                max_score = max((d[4] for d in target_detections), default=0.0)
+    for pipeline in pipelines.values():
+        pipeline.config = config
+        pipeline.start()
+    print(f"System is running with {len(pipelines)} camera(s). Press 'q' to quit.")
+    print("Web UI: http://0.0.0.0:5000")
 
-                system_status['human_count'] = len(target_detections) 
-                if len(target_detections) > system_status.get('human_count_max', 0):
-                    system_status['human_count_max'] = len(target_detections)
-                
-                system_status['detections_total'] += 1
-                system_status['last_detected'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        while True:
+            current_config = load_config()
+            inference.threshold = float(current_config.get('detection_threshold', 0.5))
+            storage.configure(**storage_policy(current_config))
+            scheduler.interval = float(current_config.get('notify_interval', 60))
+            for pipeline in pipelines.values():
+                pipeline.config = current_config
 
-                if detection_session_start is None:
-                    detection_session_start = time.time()
-                
-                elapsed_ms = (time.time() - detection_session_start) * 1000
-                delay_ms = current_config.get('recorder_start_delay_ms', 0)
-                
-                if elapsed_ms >= delay_ms:
-                    recorder.start_recording(frame)
-
-                # 通知データの保持（セッション内で一度だけ、最良の瞬間のフレームを確保）
-                if not session_notified and elapsed_ms >= delay_ms:
-                    label_names = [detector.classes.get(d[5], f"ID:{d[5]}") for d in target_detections]
-                    target_summary = ", ".join(list(set(label_names)))
-                    
-                    # メモリにバッファリング
-                    pending_notification["frame"] = frame.copy() # コピーして保持
-                    pending_notification["summary"] = target_summary
-                    pending_notification["max_score"] = max_score
-                    pending_notification["human_count"] = len(target_detections)
-                    pending_notification["video_path"] = recorder.current_video_path # パスを保持
-                    
-                    session_notified = True
-                    print(f"[Main] Detection Buffered. Will notify after recording ends.")
-            else:
-                system_status['human_count'] = 0
-                if recorder.is_recording:
-                    recorder.schedule_stop(post_seconds)
-                
-                # セッション終了（ポスト録画分が経過）
-                if session_notified and (time.time() - last_target_time > post_seconds):
-                    # 録画が終了し、かつ通知待ちデータがある場合
-                    # バックグラウンドスレッドで通知処理を実行
-                    notif_thread = threading.Thread(
-                        target=process_deferred_notification, 
-                        args=(pending_notification.copy(), current_config),
-                        daemon=True
-                    )
-                    notif_thread.start()
-                    
-                    # フラグとバッファをリセット
-                    detection_session_start = None
-                    session_notified = False
-                    pending_notification["frame"] = None
-
-            web_stream.latest_processed_frame = frame
+            if all(p.finished for p in pipelines.values()):
+                print("[Main] Replay finished.")
+                break  # 全カメラのリプレイを最後まで処理した
 
             if current_config.get('use_gui', False):
                 try:
-                    cv2.imshow("Surveillance Camera", frame)
+                    if primary.latest_frame is not None:
+                        cv2.imshow("Surveillance Camera", primary.latest_frame)
                     if cv2.waitKey(1) & 0xFF == ord('q'): break
                 except cv2.error:
                     current_config['use_gui'] = False
             else:
-                time.sleep(0.01)
+                time.sleep(0.1)
 
     except KeyboardInterrupt:
         pass
     finally:
-        recorder.release()
-        cam.stop()
+        for pipeline in pipelines.values():
+            pipeline.stop()
+        inference.stop()
+        storage.stop()
+        notify_pool.shutdown(wait=False)
+        scheduler.stop()
+        notifier.stop()
         cv2.destroyAllWindows()
 
 if __name__ == "__main__":
     main()
-
-if __name__ == "__main__":
-    main()
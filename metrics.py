@@ -0,0 +1,187 @@
+"""
+処理段階ごとのレイテンシ計測と Prometheus テキスト形式での出力。
+各モジュールは `metrics.timer('invoke')` などで計測し、/api/metrics から参照する。
+"""
+import threading
+import time
+from collections import deque
+
+# ヒストグラムのバケット上限（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+QUANTILES = (0.5, 0.95, 0.99)
+WINDOW = 1024  # 分位点の算出に使う直近のサンプル数
+
+THERMAL_ZONE = '/sys/class/thermal/thermal_zone0/temp'
+
+# 計測対象の段階（出力順）
+STAGES = ('capture', 'decode', 'preprocess', 'invoke', 'postprocess', 'draw',
+          'recorder_enqueue', 'encode', 'stream')
+
+
+class LatencyHistogram:
+    """累積バケットと直近サンプルの分位点を保持するヒストグラム。"""
+    def __init__(self, buckets=LATENCY_BUCKETS, window=WINDOW):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.sum += seconds
+            self._recent.append(seconds)
+            for i, upper in enumerate(self.buckets):
+                if seconds <= upper:
+                    self.counts[i] += 1
+                    break
+
+    def snapshot(self):
+        """(累積バケット, 件数, 合計, {分位点: 値}) を返す。"""
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+            recent = sorted(self._recent)
+        cumulative, running = [], 0
+        for c in counts:
+            running += c
+            cumulative.append(running)
+        quantiles = {}
+        if recent:
+            for q in QUANTILES:
+                quantiles[q] = recent[min(len(recent) - 1, int(q * len(recent)))]
+        return cumulative, count, total, quantiles
+
+
+class _Timer:
+    __slots__ = ('_hist', '_start')
+
+    def __init__(self, hist):
+        self._hist = hist
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._hist.observe(time.perf_counter() - self._start)
+        return False
+
+
+class Metrics:
+    """
+    レイテンシ・カウンター・ゲージの登録簿。
+    ゲージは出力時に呼び出す関数として登録する（キュー長など）。
+    """
+    def __init__(self):
+        self._window = WINDOW
+        self._histograms = {stage: LatencyHistogram() for stage in STAGES}
+        self._counters = {}
+        self._gauges = {}  # (name, labels) -> (help, callable)
+        self._lock = threading.Lock()
+
+    def reset(self, window=WINDOW):
+        """計測値とカウンターを破棄する（ベンチマークで全サンプルを保持する場合は window を大きくする）。"""
+        with self._lock:
+            self._window = window
+            self._histograms = {stage: LatencyHistogram(window=window) for stage in STAGES}
+            self._counters = {}
+
+    def histogram(self, stage):
+        hist = self._histograms.get(stage)
+        if hist is None:
+            with self._lock:
+                hist = self._histograms.setdefault(stage, LatencyHistogram(window=self._window))
+        return hist
+
+    def timer(self, stage):
+        """with 文で囲んだ区間の所要時間を stage に記録する。"""
+        return _Timer(self.histogram(stage))
+
+    def observe(self, stage, seconds):
+        self.histogram(stage).observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def register_gauge(self, name, help_text, func, **labels):
+        self._gauges[(name, tuple(sorted(labels.items())))] = (help_text, func)
+
+    def quantiles(self):
+        """段階ごとの p50/p95/p99（ミリ秒）を返す。ステータス表示用。"""
+        result = {}
+        for stage, hist in list(self._histograms.items()):
+            qs = hist.snapshot()[3]
+            if qs:
+                result[stage] = {f"p{int(q * 100)}": round(v * 1000, 2) for q, v in qs.items()}
+        return result
+
+    def render(self):
+        """Prometheus テキスト形式 (version 0.0.4) の文字列を返す。"""
+        lines = [
+            '# HELP cam_stage_latency_seconds Processing latency per pipeline stage.',
+            '# TYPE cam_stage_latency_seconds histogram',
+        ]
+        quantile_lines = []
+        for stage, hist in list(self._histograms.items()):
+            cumulative, count, total, quantiles = hist.snapshot()
+            for upper, c in zip(hist.buckets, cumulative):
+                lines.append(f'cam_stage_latency_seconds_bucket{{stage="{stage}",le="{upper}"}} {c}')
+            lines.append(f'cam_stage_latency_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'cam_stage_latency_seconds_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'cam_stage_latency_seconds_count{{stage="{stage}"}} {count}')
+            for q, v in quantiles.items():
+                quantile_lines.append(
+                    f'cam_stage_latency_recent_seconds{{stage="{stage}",quantile="{q}"}} {v:.6f}')
+
+        lines += [
+            f'# HELP cam_stage_latency_recent_seconds Latency quantiles over the last {self._window} samples.',
+            '# TYPE cam_stage_latency_recent_seconds gauge',
+        ] + quantile_lines
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# TYPE cam_{name} counter')
+            label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f'cam_{name}{{{label_str}}} {value}' if label_str else f'cam_{name} {value}')
+
+        seen = set()
+        for (name, labels), (help_text, func) in sorted(self._gauges.items(), key=lambda item: item[0]):
+            try:
+                value = func()
+            except Exception:
+                value = None
+            if value is None:
+                continue
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# HELP cam_{name} {help_text}')
+                lines.append(f'# TYPE cam_{name} gauge')
+            label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f'cam_{name}{{{label_str}}} {value}' if label_str else f'cam_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def cpu_temperature():
+    """SoC 温度（℃）。取得できない環境では None。"""
+    try:
+        with open(THERMAL_ZONE, 'r') as f:
+            return int(f.read().strip()) / 1000.0
+    except (OSError, ValueError):
+        return None
+
+
+# プロセス全体で共有するインスタンス
+metrics = Metrics()
+metrics.register_gauge('cpu_temperature_celsius', 'SoC temperature.', cpu_temperature)
@@ -3,12 +3,41 @@ import time
 import cv2
 import numpy as np
 import json
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from flask import Blueprint, render_template_string, request, jsonify, current_app, send_from_directory
 from werkzeug.utils import secure_filename
 from detector import HumanDetector
 
 model_test_bp = Blueprint('model_test', __name__)
 
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+VIDEO_EXTS = ('.mp4', '.avi', '.mov', '.mkv')
+
+MODEL_CACHE_MAX_ENTRIES = 4                # 保持するインタープリターの最大数
+MODEL_CACHE_MAX_BYTES = 256 * 1024 ** 2    # 保持するインタープリターの推定メモリ使用量の上限
+RESULT_CACHE_MAX_ENTRIES = 64              # 保持する (モデル, メディア) ごとの検知結果の最大数
+RESULT_CACHE_MAX_BYTES = 64 * 1024 ** 2    # 保持する検知結果の合計サイズの上限
+RAW_THRESHOLD = 0.1  # キャッシュする検知結果の閾値（UI の下限。リクエストの閾値で絞り込む）
+HASH_CHUNK = 1024 * 1024
+
+JOB_WORKERS = 1        # 動画テストを同時に処理するワーカー数（監視用の推論と CPU を分け合うため 1）
+JOB_QUEUE_LIMIT = 4    # 待機中・処理中の動画テストの上限（超えた場合は 503）
+JOB_TTL = 3600         # 完了したジョブの状態を保持する秒数
+PROGRESS_EVERY = 10    # 進捗を更新するフレーム間隔
+
+
+class MediaError(Exception):
+    """アップロードされたメディアを読み込めない（400 を返す）。"""
+
+
+class JobCancelled(Exception):
+    """動画テストがキャンセルされた。"""
+
+
 # --- UI Template ---
 MODEL_TEST_TEMPLATE = """
 <!DOCTYPE html>
@@ -182,6 +211,7 @@ MODEL_TEST_TEMPLATE = """
                         <div class="loading-overlay" id="loader">
                             <div class="spinner"></div>
                             <p style="margin-top:15px; font-weight:600;" id="loading-text">画像処理中...</p>
+                            <button id="btn-cancel" class="btn-run" style="display:none; width:auto; margin-top:10px; padding:6px 18px;">キャンセル</button>
                         </div>
                     </div>
                 </div>
@@ -257,8 +287,9 @@ MODEL_TEST_TEMPLATE = """
                     body: formData
                 });
                 
-                const data = await response.json();
+                let data = await response.json();
                 if (!response.ok) throw new Error(data.error || '処理に失敗しました');
+                if (data.type === 'job') data = await waitForJob(data);
 
                 if (data.type === 'image') {
                     resImg.src = data.url + '?t=' + Date.now();
@@ -268,7 +299,7 @@ MODEL_TEST_TEMPLATE = """
                     resVid.style.display = 'block';
                 }
 
-                document.getElementById('stat-inference').textContent = data.inference_ms.toFixed(1) + ' ms';
+                document.getElementById('stat-inference').textContent = data.inference_ms.toFixed(1) + ' ms' + (data.cached ? ' (キャッシュ)' : '');
                 document.getElementById('stat-count').textContent = data.count;
                 
                 const classArea = document.getElementById('stat-classes');
@@ -289,6 +320,30 @@ MODEL_TEST_TEMPLATE = """
             } finally {
                 loader.style.display = 'none';
                 btn.disabled = false;
+                document.getElementById('loading-text').textContent = '画像処理中...';
+                document.getElementById('btn-cancel').style.display = 'none';
+            }
+        }
+
+        // 動画はバックグラウンドジョブとして処理されるため、完了まで進捗を表示しながら待つ
+        async function waitForJob(job) {
+            const text = document.getElementById('loading-text');
+            const cancel = document.getElementById('btn-cancel');
+            const phases = {inference: '推論中', render: '書き出し中'};
+            cancel.style.display = 'inline-block';
+            cancel.onclick = () => fetch('/api/test_jobs/' + job.job_id + '/cancel', {method: 'POST'});
+            while (true) {
+                await new Promise(r => setTimeout(r, 1000));
+                const st = await fetch(job.status_url).then(r => r.json());
+                if (st.state === 'done') return st.result;
+                if (st.state === 'error') throw new Error(st.error || '処理に失敗しました');
+                if (st.state === 'cancelled') throw new Error('キャンセルしました');
+                if (st.state === 'queued') {
+                    text.textContent = '順番待ち...';
+                } else {
+                    const pct = st.progress != null ? ' ' + Math.round(st.progress * 100) + '%' : '';
+                    text.textContent = (phases[st.phase] || '処理中') + pct + ' (' + st.done + (st.total ? '/' + st.total : '') + ' フレーム)';
+                }
             }
         }
     </script>
@@ -296,6 +351,269 @@ MODEL_TEST_TEMPLATE = """
 </html>
 """
 
+
+class _LRUCache:
+    """件数と合計サイズの上限を持つ LRU キャッシュ（最後の 1 件はサイズ超過でも保持する）。"""
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()  # key -> (value, nbytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, nbytes=0):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._items[key] = (value, nbytes)
+            self._bytes += nbytes
+            while len(self._items) > 1 and (
+                    len(self._items) > self.max_entries
+                    or (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                _, (_, size) = self._items.popitem(last=False)
+                self._bytes -= size
+
+
+# モデル内容の SHA-256 -> (HumanDetector, 推論用ロック)
+_detectors = _LRUCache(MODEL_CACHE_MAX_ENTRIES, MODEL_CACHE_MAX_BYTES)
+_detector_load_lock = threading.Lock()
+# (モデルの SHA-256, メディアの SHA-256) -> {"frames": [float32 配列 (N, 6), ...], "inference_ms": float}
+_results = _LRUCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_BYTES)
+
+
+def _save_hashed(storage, directory):
+    """アップロードを保存して (SHA-256, 保存パス) を返す。同じ内容のファイルは同じパスに保存される。"""
+    ext = os.path.splitext(secure_filename(storage.filename))[1].lower()
+    digest = hashlib.sha256()
+    tmp_path = os.path.join(directory, f".upload_{uuid.uuid4().hex}")
+    with open(tmp_path, 'wb') as f:
+        for chunk in iter(lambda: storage.stream.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    file_hash = digest.hexdigest()
+    path = os.path.join(directory, f"{file_hash[:16]}{ext}")
+    os.replace(tmp_path, path)
+    return file_hash, path
+
+
+def _detector_bytes(detector, model_path):
+    """インタープリターの推定メモリ使用量（モデルファイル + 全テンソル）。"""
+    size = os.path.getsize(model_path)
+    if detector.interpreter is not None:
+        for t in detector.interpreter.get_tensor_details():
+            size += int(np.prod(t['shape'])) * np.dtype(t['dtype']).itemsize
+    return size
+
+
+def _get_detector(model_hash, model_path):
+    """モデルの内容が同じであれば、読み込み済みのインタープリターを再利用する。"""
+    entry = _detectors.get(model_hash)
+    if entry is not None:
+        return entry
+    with _detector_load_lock:
+        entry = _detectors.get(model_hash)
+        if entry is None:
+            detector = HumanDetector(model_path=model_path, threshold=RAW_THRESHOLD)
+            entry = (detector, threading.Lock())
+            _detectors.put(model_hash, entry, _detector_bytes(detector, model_path))
+    return entry
+
+
+def _to_array(detections):
+    """検知結果を (N, 6) の float32 配列で保持する（長い動画でもキャッシュを小さく保つ）。"""
+    return np.asarray(detections, dtype=np.float32).reshape(-1, 6)
+
+
+def _filter(raw, threshold):
+    """キャッシュ済みの検知結果から閾値以上のものを描画用のタプルで返す。"""
+    return [(int(x), int(y), int(w), int(h), float(score), int(class_id))
+            for x, y, w, h, score, class_id in raw[raw[:, 4] >= threshold]]
+
+
+def _detect(detector, lock, frame):
+    """
+    1 フレーム分の推論。インタープリターは同時に 1 リクエストのみ使用するが、ロックはフレームごとに取るため
+    長い動画のジョブ中でも同じモデルの画像テストは待たされない。戻り値: ((N, 6) 配列, 推論秒数)
+    """
+    with lock:
+        detector.threshold = RAW_THRESHOLD
+        start_t = time.time()
+        detections = detector.detect(frame)
+        return _to_array(detections), time.time() - start_t
+
+
+def _raw_detections(model_hash, model_path, media_hash, media_path, kind, job=None):
+    """
+    閾値で絞り込む前の検知結果を返す。同じモデルとメディアの組み合わせは推論を再実行しない。
+    job を指定した場合は進捗を更新し、キャンセルされたら JobCancelled を送出する。
+    戻り値: (detector, {"frames": [...], "inference_ms": float}, キャッシュ済みか)
+    """
+    detector, lock = _get_detector(model_hash, model_path)
+    key = (model_hash, media_hash)
+    raw = _results.get(key)
+    if raw is not None:
+        return detector, raw, True
+
+    frames = []
+    total_inf = 0.0
+    if kind == 'image':
+        frame = cv2.imread(media_path)
+        if frame is None:
+            raise MediaError("Failed to load image")
+        detections, total_inf = _detect(detector, lock, frame)
+        frames.append(detections)
+    else:
+        cap = cv2.VideoCapture(media_path)
+        if not cap.isOpened():
+            raise MediaError("Failed to open video")
+        try:
+            if job is not None:
+                job.start_phase('inference', int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+            while True:
+                if job is not None and job.cancel_event.is_set():
+                    raise JobCancelled()
+                ret, frame = cap.read()
+                if not ret: break
+                detections, elapsed = _detect(detector, lock, frame)
+                frames.append(detections)
+                total_inf += elapsed
+                if job is not None and len(frames) % PROGRESS_EVERY == 0:
+                    job.done = len(frames)
+        finally:
+            cap.release()
+
+    raw = {"frames": frames, "inference_ms": total_inf / max(1, len(frames)) * 1000}
+    _results.put(key, raw, sum(a.nbytes for a in frames))
+    return detector, raw, False
+
+
+def _summary(detector, frames):
+    class_counts = {}
+    for detections in frames:
+        for d in detections:
+            name = detector.classes.get(d[5], f"ID:{d[5]}")
+            class_counts[name] = class_counts.get(name, 0) + 1
+    return class_counts
+
+
+def _render_video(detector, media_path, out_path, raw_frames, threshold, job=None):
+    """キャッシュ済みの検知結果を各フレームに描画して動画に書き出す（推論は行わない）。"""
+    cap = cv2.VideoCapture(media_path)
+    width  = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps    = cap.get(cv2.CAP_PROP_FPS) or 20
+    
+    # Using H264 for browser compatibility if possible, fallback to mp4v
+    fourcc = cv2.VideoWriter_fourcc(*'avc1')
+    out = cv2.VideoWriter(out_path, fourcc, fps, (width, height))
+    if not out.isOpened():
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        out = cv2.VideoWriter(out_path, fourcc, fps, (width, height))
+
+    if job is not None:
+        job.start_phase('render', len(raw_frames))
+    try:
+        for i, raw in enumerate(raw_frames):
+            if job is not None and job.cancel_event.is_set():
+                raise JobCancelled()
+            ret, frame = cap.read()
+            if not ret: break
+            out.write(detector.draw_detections(frame, _filter(raw, threshold)))
+            if job is not None and (i + 1) % PROGRESS_EVERY == 0:
+                job.done = i + 1
+    finally:
+        cap.release()
+        out.release()
+
+
+class _Job:
+    """動画テスト 1 件の状態（queued → running → done / error / cancelled）。"""
+    def __init__(self):
+        self.id = uuid.uuid4().hex[:12]
+        self.state = 'queued'
+        self.phase = None  # inference（推論）/ render（描画・書き出し）
+        self.done = 0
+        self.total = 0     # フレーム数（不明な場合は 0）
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.future = None
+        self.finished_at = None
+
+    def start_phase(self, phase, total):
+        self.phase, self.done, self.total = phase, 0, max(0, total)
+
+    def to_dict(self):
+        data = {"id": self.id, "state": self.state, "phase": self.phase,
+                "done": self.done, "total": self.total}
+        if self.total:
+            data["progress"] = round(min(1.0, self.done / self.total), 3)
+        if self.result is not None:
+            data["result"] = self.result
+        if self.error is not None:
+            data["error"] = self.error
+        return data
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='model-test')
+
+
+def _run_video_job(job, model_hash, model_path, media_hash, media_path, out_path, out_name, threshold):
+    job.state = 'running'
+    try:
+        if job.cancel_event.is_set():
+            raise JobCancelled()
+        detector, raw, cached = _raw_detections(model_hash, model_path, media_hash, media_path, 'video', job)
+        _render_video(detector, media_path, out_path, raw["frames"], threshold, job)
+        frames = [_filter(a, threshold) for a in raw["frames"]]
+        job.result = {
+            "type": "video",
+            "url": f"/tmp_test/{out_name}",
+            "inference_ms": raw["inference_ms"],
+            "count": len(frames),
+            "classes": _summary(detector, frames),
+            "note": f"Processed {len(frames)} frames",
+            "cached": cached
+        }
+        job.done = job.total
+        job.state = 'done'
+    except JobCancelled:
+        job.state = 'cancelled'
+        if os.path.exists(out_path):
+            os.remove(out_path)
+    except Exception as e:
+        job.error = str(e)
+        job.state = 'error'
+    finally:
+        job.finished_at = time.time()
+
+
+def _submit_video_job(*args):
+    """動画テストをワーカープールに投入する。上限に達している場合は None。"""
+    now = time.time()
+    with _jobs_lock:
+        for job_id in [j.id for j in _jobs.values()
+                       if j.finished_at is not None and now - j.finished_at > JOB_TTL]:
+            del _jobs[job_id]
+        if sum(1 for j in _jobs.values() if j.finished_at is None) >= JOB_QUEUE_LIMIT:
+            return None
+        job = _Job()
+        _jobs[job.id] = job
+    job.future = _job_pool.submit(_run_video_job, job, *args)
+    return job
+
+
 @model_test_bp.route('/model_test')
 def model_test_index():
     config = {}
@@ -307,110 +625,80 @@ def model_test_index():
 
 @model_test_bp.route('/api/test_process', methods=['POST'])
 def api_test_process():
+    """画像はその場で処理し、動画はジョブとして受け付けて 202 を返す（進捗は /api/test_jobs/<id>）。"""
     if 'model' not in request.files or 'media' not in request.files:
         return jsonify({"error": "No model or media file"}), 400
     
     model_file = request.files['model']
     media_file = request.files['media']
-    threshold = float(request.form.get('threshold', 0.5))
+    try:
+        threshold = float(request.form.get('threshold', 0.5))
+    except ValueError:
+        return jsonify({"error": "Invalid threshold"}), 400
+    # 検知結果は RAW_THRESHOLD 以上のみ保持しているため、それより低い閾値は受け付けない
+    if not RAW_THRESHOLD <= threshold <= 1.0:
+        return jsonify({"error": f"Threshold must be between {RAW_THRESHOLD} and 1.0"}), 400
     
     tmp_dir = current_app.config.get('TMP_TEST_FOLDER', 'tmp_test')
     os.makedirs(tmp_dir, exist_ok=True)
     
-    model_path = os.path.join(tmp_dir, secure_filename(model_file.filename))
-    media_path = os.path.join(tmp_dir, secure_filename(media_file.filename))
-    
-    model_file.save(model_path)
-    media_file.save(media_path)
-    
-    detector = None
     try:
-        detector = HumanDetector(model_path=model_path, threshold=threshold)
-        ext = os.path.splitext(media_path)[1].lower()
-        
-        if ext in ['.jpg', '.jpeg', '.png', '.bmp', '.webp']:
-            # Image Processing
-            frame = cv2.imread(media_path)
-            if frame is None:
-                return jsonify({"error": "Failed to load image"}), 400
-            
-            start_t = time.time()
-            detections = detector.detect(frame)
-            inf_time = (time.time() - start_t) * 1000
-            
-            res_frame = detector.draw_detections(frame, detections)
-            out_name = "res_" + secure_filename(media_file.filename)
-            out_path = os.path.join(tmp_dir, out_name)
-            cv2.imwrite(out_path, res_frame)
-            
-            class_counts = {}
-            for d in detections:
-                name = detector.classes.get(d[5], f"ID:{d[5]}")
-                class_counts[name] = class_counts.get(name, 0) + 1
-            
-            return jsonify({
-                "type": "image",
-                "url": f"/tmp_test/{out_name}",
-                "inference_ms": inf_time,
-                "count": len(detections),
-                "classes": class_counts
-            })
-            
-        elif ext in ['.mp4', '.avi', '.mov', '.mkv']:
-            # Video Processing (Simple version for testing)
-            cap = cv2.VideoCapture(media_path)
-            if not cap.isOpened():
-                return jsonify({"error": "Failed to open video"}), 400
-            
-            width  = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-            height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            fps    = cap.get(cv2.CAP_PROP_FPS) or 20
-            
-            out_name = "res_" + os.path.splitext(secure_filename(media_file.filename))[0] + ".mp4"
-            out_path = os.path.join(tmp_dir, out_name)
-            
-            # Using H264 for browser compatibility if possible, fallback to mp4v
-            fourcc = cv2.VideoWriter_fourcc(*'avc1')
-            out = cv2.VideoWriter(out_path, fourcc, fps, (width, height))
-            if not out.isOpened():
-                fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-                out = cv2.VideoWriter(out_path, fourcc, fps, (width, height))
-
-            total_inf = 0
-            frames = 0
-            class_counts = {}
-            
-            # Limit to first 60 frames for quick testing in web env
-            MAX_FRAMES = 60
-            while frames < MAX_FRAMES:
-                ret, frame = cap.read()
-                if not ret: break
-                
-                start_t = time.time()
-                detections = detector.detect(frame)
-                total_inf += (time.time() - start_t)
-                
-                for d in detections:
-                    name = detector.classes.get(d[5], f"ID:{d[5]}")
-                    class_counts[name] = class_counts.get(name, 0) + 1
-                
-                res_frame = detector.draw_detections(frame, detections)
-                out.write(res_frame)
-                frames += 1
-            
-            cap.release()
-            out.release()
-            
-            return jsonify({
-                "type": "video",
-                "url": f"/tmp_test/{out_name}",
-                "inference_ms": (total_inf / max(1, frames)) * 1000,
-                "count": frames,
-                "classes": class_counts,
-                "note": f"Processed first {frames} frames"
-            })
-        else:
+        ext = os.path.splitext(secure_filename(media_file.filename))[1].lower()
+        if ext not in IMAGE_EXTS and ext not in VIDEO_EXTS:
             return jsonify({"error": "Unsupported file format"}), 400
+        model_hash, model_path = _save_hashed(model_file, tmp_dir)
+        media_hash, media_path = _save_hashed(media_file, tmp_dir)
+
+        # モデル・メディア・閾値ごとに別ファイルとし、別のモデルや閾値で試した結果を上書きしない
+        out_stem = f"res_{model_hash[:12]}_{media_hash[:12]}_{int(round(threshold * 100))}"
+
+        if ext in VIDEO_EXTS:
+            out_name = out_stem + ".mp4"
+            job = _submit_video_job(model_hash, model_path, media_hash, media_path,
+                                    os.path.join(tmp_dir, out_name), out_name, threshold)
+            if job is None:
+                return jsonify({"error": "Too many video tests in progress"}), 503
+            return jsonify({"type": "job", "job_id": job.id,
+                            "status_url": f"/api/test_jobs/{job.id}"}), 202
+
+        detector, raw, cached = _raw_detections(model_hash, model_path, media_hash, media_path, 'image')
+        detections = _filter(raw["frames"][0], threshold)
+        frame = cv2.imread(media_path)
+        res_frame = detector.draw_detections(frame, detections)
+        out_name = out_stem + ext
+        cv2.imwrite(os.path.join(tmp_dir, out_name), res_frame)
+        
+        return jsonify({
+            "type": "image",
+            "url": f"/tmp_test/{out_name}",
+            "inference_ms": raw["inference_ms"],
+            "count": len(detections),
+            "classes": _summary(detector, [detections]),
+            "cached": cached
+        })
             
+    except MediaError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+@model_test_bp.route('/api/test_jobs/<job_id>')
+def api_test_job(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+@model_test_bp.route('/api/test_jobs/<job_id>/cancel', methods=['POST'])
+def api_test_job_cancel(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    job.cancel_event.set()
+    if job.future is not None and job.future.cancel():
+        # まだ開始していなかった
+        job.state = 'cancelled'
+        job.finished_at = time.time()
+    return jsonify(job.to_dict())
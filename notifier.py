@@ -1,61 +1,414 @@
 import requests
+from requests.adapters import HTTPAdapter
 import cv2
 import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from transcoder import fit_to_budget
+
+TELEGRAM_API_BASE = "https://api.telegram.org"
+QUEUE_DIR = 'notify_queue'   # 未送信ジョブの永続化先
+MAX_ATTEMPTS = 8             # 最大送信試行回数
+BACKOFF_BASE = 2.0           # 再送間隔の初期値（秒）。試行ごとに倍増
+BACKOFF_MAX = 600.0          # 再送間隔の上限（秒）
+MIN_SEND_INTERVAL = 1.0      # Bot API の制限（同一チャットへ概ね 1 通/秒）
+
+VIDEO_MAX_BYTES = 20 * 1024 * 1024  # 動画アップロードの容量上限 (Bot API の上限は 50MB)
+VIDEO_MAX_HEIGHT = 480              # 上限を超えた動画を再エンコードする際の最大高さ
+
+DIGEST_MAX_PHOTOS = 4        # ダイジェストのアルバムに含める最大枚数 (Bot API 上限は 10)
+
+TIMEOUTS = {"sendMessage": 10, "sendPhoto": 30, "sendVideo": 60, "sendMediaGroup": 60}
+
+
+class DeliveryQueue:
+    """
+    送信ジョブをディスクに永続化し、バックグラウンドで配信するキュー。
+    失敗時は指数バックオフで再送し、再起動後も未送信ジョブを引き継ぐ。
+    """
+    def __init__(self, sender, queue_dir=QUEUE_DIR):
+        self._sender = sender  # callable(method, data, files) -> (ok, retryable, retry_after)
+        self.queue_dir = queue_dir
+        self._jobs = []
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+        os.makedirs(queue_dir, exist_ok=True)
+        self._load()
+
+    def _job_path(self, job):
+        return os.path.join(self.queue_dir, f"{job['id']}.json")
+
+    def _load(self):
+        for name in sorted(os.listdir(self.queue_dir)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.queue_dir, name), 'r', encoding='utf-8') as f:
+                    self._jobs.append(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"[Telegram] Broken queue entry {name}: {e}")
+        if self._jobs:
+            print(f"[Telegram] Restored {len(self._jobs)} pending notification(s).")
+
+    def _save(self, job):
+        path = self._job_path(job)
+        # メモリ上の添付データ (_blobs) は _spill で書き出したファイルとして記録される
+        record = {k: v for k, v in job.items() if not k.startswith('_')}
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    def _discard(self, job):
+        for path in [self._job_path(job)] + job.get('owned', []):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def new_id(self):
+        # ファイル名順 = 投入順 になるよう時刻を先頭に付与
+        return f"{time.time_ns()}_{uuid.uuid4().hex[:8]}"
+
+    def put(self, method, data, files=None, owned=(), blobs=None):
+        """
+        送信ジョブを登録する。
+        files: {フィールド名: ファイルパス}、owned: 送信完了後に削除するファイル
+        blobs: {フィールド名: (ファイル名, bytes)} — 保存先ファイルのないデータのみ。登録時にキューディレクトリへ
+               書き出して永続化し、初回の送信はメモリ上のデータから行う（再送・再起動後はファイルから送信）。
+               保存済みのファイルは files で渡し、キューへ再度書き込まない
+        """
+        job = {
+            "id": self.new_id(),
+            "method": method,
+            "data": data,
+            "files": files or {},
+            "owned": list(owned),
+            "attempts": 0,
+            "next_try": 0.0,
+        }
+        if blobs:
+            job['_blobs'] = dict(blobs)
+            self._spill(job)
+        self._save(job)
+        with self._cond:
+            self._jobs.append(job)
+            self._cond.notify()
+        return job['id']
+
+    def pending(self):
+        with self._cond:
+            return len(self._jobs)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=3)
+
+    def _worker(self):
+        last_sent = 0.0
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                if not self._jobs:
+                    self._cond.wait()
+                    continue
+                job = min(self._jobs, key=lambda j: j['next_try'])
+                now = time.time()
+                wait = max(job['next_try'] - now, last_sent + MIN_SEND_INTERVAL - now)
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                self._jobs.remove(job)
+
+            ok, retryable, retry_after = self._deliver(job)
+            last_sent = time.time()
+
+            if ok or not retryable:
+                self._discard(job)
+                continue
+
+            job['attempts'] += 1
+            if job['attempts'] >= MAX_ATTEMPTS:
+                print(f"[Telegram] Giving up {job['method']} after {job['attempts']} attempts.")
+                self._discard(job)
+                continue
+
+            delay = retry_after or min(BACKOFF_MAX, BACKOFF_BASE * (2 ** (job['attempts'] - 1)))
+            job['next_try'] = time.time() + delay
+            print(f"[Telegram] Retry {job['method']} in {delay:.0f}s ({job['attempts']}/{MAX_ATTEMPTS})")
+            job.pop('_blobs', None)  # 再送はディスク上のコピーから行う
+            self._save(job)
+            with self._cond:
+                self._jobs.append(job)
+
+    def _spill(self, job):
+        """メモリ上の添付データをキューディレクトリへ書き出し、再起動後も再送できるようにする。"""
+        for field, (filename, data) in job['_blobs'].items():
+            path = os.path.join(self.queue_dir, f"{job['id']}_{field}{os.path.splitext(filename)[1]}")
+            with open(path, 'wb') as f:
+                f.write(data)
+            job['files'][field] = path
+            job['owned'].append(path)
+
+    def _deliver(self, job):
+        blobs = job.get('_blobs', {})
+        opened = {}
+        try:
+            for field, path in job['files'].items():
+                if field not in blobs:
+                    opened[field] = open(path, 'rb')
+        except OSError as e:
+            print(f"[Telegram] Attachment missing for {job['method']}: {e}")
+            for h in opened.values():
+                h.close()
+            return False, False, None
+        # メモリ上のデータは (ファイル名, bytes) のままストリーミング送信
+        files = dict(blobs, **opened)
+        try:
+            return self._sender(job['method'], job['data'], files)
+        finally:
+            for h in opened.values():
+                h.close()
+
 
 class TelegramNotifier:
-    def __init__(self, token, chat_id):
+    def __init__(self, token, chat_id, api_base=TELEGRAM_API_BASE, queue_dir=QUEUE_DIR,
+                 video_max_bytes=VIDEO_MAX_BYTES, video_max_height=VIDEO_MAX_HEIGHT):
+        self.api_base = api_base.rstrip('/')
+        self.configure(token, chat_id)
+        self.video_max_bytes = video_max_bytes
+        self.video_max_height = video_max_height
+        # 動画の容量調整（再エンコード）用ワーカー。CPU を占有しないよう 1 本に制限
+        self._video_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tg-video')
+
+        # 接続を使い回すためのセッション（Keep-Alive / コネクションプール）
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+
+        self.queue = DeliveryQueue(self._post, queue_dir=queue_dir)
+        self.queue.start()
+
+    def configure(self, token, chat_id):
+        """送信先を更新する。キュー内の未送信ジョブにも新しい設定が適用される。"""
         self.token = token
         self.chat_id = chat_id
-        self.api_url = f"https://api.telegram.org/bot{self.token}/"
+        self.api_url = f"{self.api_base}/bot{self.token}/"
 
-    def send_message(self, text):
-        url = self.api_url + "sendMessage"
-        payload = {"chat_id": self.chat_id, "text": text}
+    def _post(self, method, data, files):
+        """Bot API を呼び出す。戻り値: (成功, 再送可能, 再送までの秒数)"""
+        payload = dict(data, chat_id=self.chat_id)
         try:
-            r = requests.post(url, data=payload, timeout=10)
-            if not r.ok:
-                print(f"[Telegram] Error: {r.status_code} - {r.text}")
+            r = self.session.post(self.api_url + method, data=payload, files=files or None,
+                                  timeout=TIMEOUTS.get(method, 30))
+        except requests.RequestException as e:
+            print(f"[Telegram] Exception ({method}): {e}")
+            return False, True, None
+
+        if r.ok:
+            print(f"[Telegram] {method} sent successfully.")
+            return True, False, None
+
+        print(f"[Telegram] Error ({method}): {r.status_code} - {r.text}")
+        if r.status_code == 429:
+            try:
+                retry_after = float(r.json().get('parameters', {}).get('retry_after', 0)) or None
+            except ValueError:
+                retry_after = None
+            return False, True, retry_after
+        # 5xx は一時的な障害として再送、それ以外の 4xx は再送しても成功しない
+        return False, r.status_code >= 500, None
+
+    def send_message(self, text):
+        self.queue.put("sendMessage", {"text": text})
+
+    def send_photo(self, photo, caption=""):
+        """
+        写真をキューに登録する。photo には JPEG エンコード済みの bytes、
+        保存済みファイルのパス、またはフレーム (numpy 配列) を渡せる。
+        一時ファイルは作らず、メモリまたは既存ファイルから直接送信する。
+        """
+        if isinstance(photo, str):
+            if not os.path.exists(photo):
+                print(f"[Telegram] Photo file not found: {photo}")
+                return
+            self.queue.put("sendPhoto", {"caption": caption}, files={"photo": photo})
+            return
+
+        if not isinstance(photo, (bytes, bytearray, memoryview)):
+            ok, buf = cv2.imencode('.jpg', photo)
+            if not ok:
+                print("[Telegram] Failed to encode photo.")
+                return
+            photo = buf
+        self.queue.put("sendPhoto", {"caption": caption}, blobs={"photo": ("photo.jpg", bytes(photo))})
+
+    def send_media_group(self, photos, caption=""):
+        """
+        複数の写真を 1 つのアルバムとして送信する。キャプションは先頭の写真に付与。
+        photos の要素は保存済み JPEG のパス（ファイルから送信）または JPEG の bytes。
+        """
+        media, files, blobs = [], {}, {}
+        for data in photos[:10]:
+            field = f"photo{len(media)}"
+            if isinstance(data, str):
+                if not os.path.exists(data):
+                    print(f"[Telegram] Photo file not found: {data}")
+                    continue
+                files[field] = data
             else:
-                print(f"[Telegram] Message sent successfully.")
-        except Exception as e:
-            print(f"[Telegram] Exception sending message: {e}")
-
-    def send_photo(self, frame, caption=""):
-        """メモリ上のフレームを一時ファイル化して送信"""
-        photo_path = "tmp_notify_photo.jpg"
-        cv2.imwrite(photo_path, frame)
-        
-        url = self.api_url + "sendPhoto"
-        try:
-            with open(photo_path, "rb") as photo:
-                files = {"photo": photo}
-                payload = {"chat_id": self.chat_id, "caption": caption}
-                r = requests.post(url, data=payload, files=files, timeout=30)
-                if not r.ok:
-                    print(f"[Telegram] Error (Photo): {r.status_code} - {r.text}")
-                else:
-                    print(f"[Telegram] Photo sent successfully.")
-        except Exception as e:
-            print(f"[Telegram] Exception sending photo: {e}")
-        finally:
-            if os.path.exists(photo_path):
-                os.remove(photo_path)
+                blobs[field] = (f"{field}.jpg", bytes(data))
+            item = {"type": "photo", "media": f"attach://{field}"}
+            if not media and caption:
+                item["caption"] = caption
+            media.append(item)
+        if not media:
+            return
+        self.queue.put("sendMediaGroup", {"media": json.dumps(media, ensure_ascii=False)},
+                       files=files, blobs=blobs)
 
     def send_video(self, video_path, caption=""):
-        """保存済みの動画ファイルを送信"""
+        """保存済みの動画ファイルを容量上限に合わせて調整し、キューに登録（調整はバックグラウンド）"""
         if not os.path.exists(video_path):
             print(f"[Telegram] Video file not found: {video_path}")
             return
+        self._video_pool.submit(self._prepare_video, video_path, caption)
+
+    def _prepare_video(self, video_path, caption):
+        try:
+            stem = os.path.splitext(os.path.basename(video_path))[0]
+            upload_path = os.path.join(self.queue.queue_dir, f"{stem}_upload.mp4")
+            result = fit_to_budget(video_path, upload_path, self.video_max_bytes, self.video_max_height)
+        except Exception as e:
+            print(f"[Telegram] Video preparation error: {e}")
+            return
 
-        url = self.api_url + "sendVideo"
+        if result is None:
+            self.send_message(f"{caption}\n(動画が容量上限を超えるため送信できませんでした)")
+        elif result == video_path:
+            self.queue.put("sendVideo", {"caption": caption}, files={"video": video_path})
+        else:
+            # 調整済みの一時ファイルは送信完了後に削除
+            self.queue.put("sendVideo", {"caption": caption}, files={"video": result}, owned=[result])
+
+    def stop(self):
+        self._video_pool.shutdown(wait=False)
+        self.queue.stop()
+        self.session.close()
+
+
+class NotificationScheduler:
+    """
+    notify_interval 秒以内に発生した検知イベントをまとめ、1 回の通知（ダイジェスト）として送信する。
+    直前の通知から interval 秒以上経過していれば即時送信する。
+    """
+    def __init__(self, notifier, interval=60):
+        self.notifier = notifier
+        self.interval = float(interval)
+        self._events = []
+        self._mode = 'photo'
+        self._last_sent = 0.0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def submit(self, event, mode='photo'):
+        """
+        検知イベントを登録する。
+        event: {"photo": 保存済み JPEG のパス（または bytes）, "summary", "human_count", "max_score", "video_path", "time": datetime}
+        """
+        if mode == 'none':
+            return
+        with self._lock:
+            self._events.append(event)
+            self._mode = mode
+            if self._timer is not None:
+                return  # 送信待ちのダイジェストに合流
+            wait = self._last_sent + self.interval - time.time()
+            if wait > 0:
+                self._timer = threading.Timer(wait, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+            events, mode = self._take()
+        self._send(events, mode)
+
+    def pending(self):
+        """ダイジェスト送信待ちのイベント数。"""
+        with self._lock:
+            return len(self._events)
+
+    def _take(self):
+        events, self._events = self._events, []
+        self._last_sent = time.time()
+        return events, self._mode
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            events, mode = self._take()
+        self._send(events, mode)
+
+    def _send(self, events, mode):
+        if not events:
+            return
         try:
-            with open(video_path, "rb") as video:
-                files = {"video": video}
-                payload = {"chat_id": self.chat_id, "caption": caption}
-                r = requests.post(url, data=payload, files=files, timeout=60)
-                if not r.ok:
-                    print(f"[Telegram] Error (Video): {r.status_code} - {r.text}")
-                else:
-                    print(f"[Telegram] Video sent successfully.")
+            if len(events) == 1:
+                self._send_single(events[0], mode)
+            else:
+                self._send_digest(events, mode)
         except Exception as e:
-            print(f"[Telegram] Exception sending video: {e}")
+            print(f"[Telegram] Notification scheduling error: {e}")
+
+    def _send_single(self, ev, mode):
+        caption = f"⚠️ 検知通知\n対象: {ev['summary']}\n数: {ev['human_count']}\n時刻: {ev['time'].strftime('%H:%M:%S')}"
+        if mode in ["photo", "both"] and ev.get('photo'):
+            self.notifier.send_photo(ev['photo'], caption=caption)
+        if mode in ["video", "both"] and ev.get('video_path'):
+            self.notifier.send_video(ev['video_path'], caption=f"📹 録画ファイル: {ev['summary']}")
+
+    def _send_digest(self, events, mode):
+        ranked = sorted(events, key=lambda ev: ev['max_score'], reverse=True)
+        best = ranked[0]
+        labels = sorted({label.strip() for ev in events for label in ev['summary'].split(',') if label.strip()})
+        first = min(ev['time'] for ev in events).strftime('%H:%M:%S')
+        last  = max(ev['time'] for ev in events).strftime('%H:%M:%S')
+        caption = (f"⚠️ 検知ダイジェスト ({len(events)}件)\n対象: {', '.join(labels)}\n"
+                   f"最大数: {max(ev['human_count'] for ev in events)}\n期間: {first} 〜 {last}")
+
+        if mode in ["photo", "both"]:
+            photos = [ev['photo'] for ev in ranked[:DIGEST_MAX_PHOTOS] if ev.get('photo')]
+            if len(photos) > 1:
+                self.notifier.send_media_group(photos, caption=caption)
+            elif photos:
+                self.notifier.send_photo(photos[0], caption=caption)
+        else:
+            self.notifier.send_message(caption)
+
+        # 動画は最もスコアの高いイベントの 1 本のみ送信（回線の占有を避ける）
+        if mode in ["video", "both"]:
+            video = next((ev['video_path'] for ev in ranked if ev.get('video_path')), None)
+            if video:
+                self.notifier.send_video(video, caption=f"📹 録画ファイル (最大スコア): {best['summary']}")
+
+    def stop(self):
+        """送信待ちのダイジェストがあれば即時送信する。"""
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+            self._flush()
@@ -0,0 +1,244 @@
+import datetime
+import threading
+import time
+
+import cv2
+
+from camera import STATE_ONLINE, STATE_FINISHED
+from metrics import metrics
+
+INFERENCE_WAIT = 0.5  # 推論結果を待つ最大秒数（超えた場合は直前の検知結果で描画・録画を続ける）
+OFFLINE_POLL = 0.2    # カメラ切断中の状態確認間隔（秒）
+
+
+def no_signal_frame(frame):
+    """カメラ切断中に配信する画面（最後のフレームを暗くして表示）。"""
+    frame = cv2.convertScaleAbs(frame, alpha=0.3)
+    h, w = frame.shape[:2]
+    text = "NO SIGNAL - reconnecting"
+    (tw, th), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 1.0, 2)
+    cv2.putText(frame, text, ((w - tw) // 2, (h + th) // 2), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (80, 80, 255), 2)
+    return frame
+
+
+def new_status(stream_width=640, stream_height=480):
+    """カメラごとのステータスの初期値（1 台目は web_stream.system_status を使う）。"""
+    return {
+        "running": True,
+        "stream_width": stream_width,
+        "stream_height": stream_height,
+        "detections_total": 0,
+        "last_detected": "—",
+        "fps": 0,
+        "capture_latency_ms": 0,
+        "display_latency_ms": 0,
+        "human_count": 0,
+        "camera_state": "connecting",
+        "camera_reconnects": 0,
+        "camera_retry_in": None,
+    }
+
+
+class CameraPipeline:
+    """
+    1 台のカメラの処理ループ。
+    フレームを推論スケジューラーへ差し出し、結果に応じて検知枠の描画・録画・通知データの保持を行う。
+    """
+    def __init__(self, cam_id, name, camera, recorder, logger, scheduler, status, on_session_end):
+        self.id = cam_id
+        self.name = name
+        self.camera = camera
+        self.recorder = recorder
+        self.logger = logger
+        self.scheduler = scheduler
+        self.status = status
+        self.on_session_end = on_session_end  # on_session_end(pipeline, notif_data, clip, config)
+        self.config = {}
+        self.latest_frame = None  # 検知枠を描画済みの最新フレーム（配信用）
+        self.finished = False     # リプレイの最終フレームまで処理した
+
+        self._result = None
+        self._result_lock = threading.Lock()
+        self._result_ready = threading.Event()
+        self._last_detections = []
+        scheduler.register(cam_id, self._deliver)
+
+        self._running = False
+        self._thread = None
+
+    def _deliver(self, detections):
+        with self._result_lock:
+            self._result = detections
+        self._result_ready.set()
+
+    def _take_result(self):
+        with self._result_lock:
+            result, self._result = self._result, None
+        return result
+
+    def start(self):
+        self._running = True
+        self.camera.start()
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f'pipeline-{self.id}')
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=3)
+        self.recorder.release()
+        self.camera.stop()
+
+    def _run(self):
+        cam = self.camera
+        status = self.status
+        detection_session_start = None
+        last_target_time = 0
+        last_seq = None     # 直前に処理したカメラフレームの通し番号
+        prev_loop_time = time.time()
+        session_notified = False
+
+        # 遅延通知用バッファ
+        pending_notification = {
+            "frame": None,
+            "summary": "",
+            "max_score": 0.0,
+            "human_count": 0,
+            "clip": None  # Recorder.current_clip (録画確定時に完了する Future)
+        }
+
+        def end_session(current_config):
+            nonlocal detection_session_start, session_notified
+            notif_data = pending_notification.copy()
+            clip = notif_data.pop("clip")
+            self.on_session_end(self, notif_data, clip, current_config)
+
+            # フラグとバッファをリセット
+            detection_session_start = None
+            session_notified = False
+            pending_notification["frame"] = None
+            pending_notification["clip"] = None
+
+        offline = False
+        while self._running:
+            current_config = self.config
+            post_seconds = float(current_config.get('recorder_post_seconds', 5))
+
+            status.update(cam.health())
+            if cam.state not in (STATE_ONLINE, STATE_FINISHED):
+                # カメラ切断中: 録画を確定してセッションを終了し、再接続を待つ（配信は NO SIGNAL 表示）
+                if not offline:
+                    offline = True
+                    print(f"[Pipeline {self.id}] Camera offline. Waiting for reconnection...")
+                    if self.recorder.is_recording:
+                        self.recorder.schedule_stop(0)
+                    self.recorder.clear_buffer()
+                    if session_notified:
+                        end_session(current_config)
+                    status['fps'] = 0
+                    status['human_count'] = 0
+                    if self.latest_frame is not None:
+                        self.latest_frame = no_signal_frame(self.latest_frame)
+                time.sleep(OFFLINE_POLL)
+                continue
+            if offline:
+                offline = False
+                print(f"[Pipeline {self.id}] Camera back online.")
+
+            seq = cam.frame_seq
+            if cam.finished and seq == (last_seq or 0):
+                print(f"[Pipeline {self.id}] Replay finished.")
+                self.finished = True
+                break  # リプレイの最終フレームまで処理した
+            if seq == last_seq:
+                time.sleep(0.005)  # 新しいフレームを待つ（同じフレームを再推論しない）
+                continue
+            frame, seq, captured_at = cam.get_frame(meta=True)
+            if frame is None:
+                time.sleep(0.01)
+                continue
+
+            # パイプライン（検知ループ）の処理レートと取りこぼしたカメラフレーム数
+            now = time.time()
+            status['fps'] = round(1.0 / max(now - prev_loop_time, 1e-6), 1)
+            prev_loop_time = now
+            if last_seq is not None and seq - last_seq > 1:
+                metrics.inc('frames_dropped_total', seq - last_seq - 1, stage='pipeline', camera=self.id)
+            last_seq = seq
+
+            # 推論はスケジューラーのワーカーで実行（他カメラの処理中は順番を待つ）
+            self._result_ready.clear()
+            self.scheduler.offer(self.id, frame)
+            self._result_ready.wait(INFERENCE_WAIT)
+            all_detections = self._take_result()
+            fresh = all_detections is not None
+            if fresh:
+                self._last_detections = all_detections
+            else:
+                all_detections = self._last_detections
+
+            target_classes = current_config.get('target_classes', [1])
+            target_detections = [d for d in all_detections if d[5] in target_classes]
+
+            if target_detections:
+                with metrics.timer('draw'):
+                    frame = self.scheduler.detector.draw_detections(frame, all_detections if current_config.get('show_all_detections', True) else target_detections)
+
+            with metrics.timer('recorder_enqueue'):
+                self.recorder.update_buffer(frame)
+                self.recorder.write(frame)
+
+            self.latest_frame = frame
+            # 撮像から表示用フレーム（検知枠描画済み）が用意できるまでの遅延
+            if captured_at is not None:
+                latency = time.monotonic() - captured_at
+                metrics.observe('capture_to_display', latency)
+                status['display_latency_ms'] = round(latency * 1000, 1)
+                status['capture_latency_ms'] = round(cam.capture_latency * 1000, 1)
+            if not fresh:
+                continue  # 検知状態の更新は新しい推論結果が届いたときのみ
+
+            if target_detections:
+                self.scheduler.mark_active(self.id)
+                last_target_time = time.time()
+                max_score = max((d[4] for d in target_detections), default=0.0)
+
+                status['human_count'] = len(target_detections)
+                if len(target_detections) > status.get('human_count_max', 0):
+                    status['human_count_max'] = len(target_detections)
+
+                status['detections_total'] += 1
+                status['last_detected'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+                if detection_session_start is None:
+                    detection_session_start = time.time()
+
+                elapsed_ms = (time.time() - detection_session_start) * 1000
+                delay_ms = current_config.get('recorder_start_delay_ms', 0)
+
+                if elapsed_ms >= delay_ms:
+                    self.recorder.start_recording(frame)
+
+                # 通知データの保持（セッション内で一度だけ、最良の瞬間のフレームを確保）
+                if not session_notified and elapsed_ms >= delay_ms:
+                    classes = self.scheduler.detector.classes
+                    label_names = [classes.get(d[5], f"ID:{d[5]}") for d in target_detections]
+                    target_summary = ", ".join(list(set(label_names)))
+
+                    # メモリにバッファリング
+                    pending_notification["frame"] = frame.copy() # コピーして保持
+                    pending_notification["summary"] = target_summary
+                    pending_notification["max_score"] = max_score
+                    pending_notification["human_count"] = len(target_detections)
+                    pending_notification["clip"] = self.recorder.current_clip # 録画完了の Future を保持
+
+                    session_notified = True
+                    print(f"[Pipeline {self.id}] Detection Buffered. Will notify after recording ends.")
+            else:
+                status['human_count'] = 0
+                if self.recorder.is_recording:
+                    self.recorder.schedule_stop(post_seconds)
+
+                # セッション終了（ポスト録画分が経過）
+                if session_notified and (time.time() - last_target_time > post_seconds):
+                    end_session(current_config)
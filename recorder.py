@@ -6,13 +6,18 @@ import time
 import queue
 import subprocess
 from collections import deque
+from concurrent.futures import Future
+
+from metrics import metrics
 
 class Recorder:
     """
     FFmpegパイプ、非同期書き込み、精密フレーム補完(FPS同期)、およびプリ録画に対応した録画モジュール。
     """
-    def __init__(self, save_directory='records', fps=20.0, resolution=(1280, 720), post_seconds=5, pre_frames=60):
+    def __init__(self, save_directory='records', fps=20.0, resolution=(1280, 720), post_seconds=5, pre_frames=60, storage=None, prefix=''):
         self.save_directory = save_directory
+        self.storage = storage # StorageManager (日付ディレクトリ分割)
+        self.prefix = prefix   # ファイル名の接頭辞（複数カメラ時のカメラ ID）
         self.fps = fps
         self.resolution = resolution
         self.post_seconds = post_seconds
@@ -24,7 +29,10 @@ class Recorder:
         self._stop_timer = None
         self.is_recording = False
         self._starting = False # 起動処理中フラグ
+        self._stopping = False # 終了処理中フラグ（FFmpeg の書き出し完了待ち）
         self.current_video_path = None
+        self._clip = None # 録画中クリップの完了通知用 Future
+        self._clip_listeners = []
         
         # 非同期処理用
         self._queue = queue.Queue(maxsize=2000) # 補完フレーム増を考慮して拡張
@@ -65,6 +73,36 @@ class Recorder:
             except queue.Empty:
                 continue
 
+    @property
+    def queue_depth(self):
+        """FFmpeg への書き込み待ちフレーム数。"""
+        return self._queue.qsize()
+
+    @property
+    def current_clip(self):
+        """
+        録画中（または直近）のクリップの Future。
+        ファイル確定時に {"path", "duration", "size", "frames"} を結果として返す。
+        """
+        return self._clip
+
+    def add_clip_listener(self, callback):
+        """クリップ確定ごとに呼ばれるコールバックを登録する。引数は current_clip の結果と同じ dict。"""
+        self._clip_listeners.append(callback)
+
+    def _finish_clip(self, clip, info=None, error=None):
+        if clip is None or clip.done():
+            return
+        if error is not None:
+            clip.set_exception(error)
+            return
+        clip.set_result(info)
+        for callback in self._clip_listeners:
+            try:
+                callback(info)
+            except Exception as e:
+                print(f"[Recorder] Clip listener error: {e}")
+
     def update_buffer(self, frame):
         """常時呼び出し。タイムスタンプと共にリングバッファを更新する。"""
         if frame is None: return
@@ -73,6 +111,11 @@ class Recorder:
         with self._lock:
             self._pre_buffer.append((now, resized))
 
+    def clear_buffer(self):
+        """プリ録画バッファを破棄する（カメラ切断時。再接続後の録画に切断前のフレームを含めない）。"""
+        with self._lock:
+            self._pre_buffer.clear()
+
     def start_recording(self, frame):
         """録画を開始する（非同期プロセス起動）。"""
         with self._lock:
@@ -81,20 +124,25 @@ class Recorder:
                 self._stop_timer = None
                 return
 
-            if self.is_recording or self._starting:
+            if self.is_recording or self._starting or self._stopping:
                 return
 
             self._starting = True
             self.is_recording = True
             self._total_frames_pushed = 0
+            self._clip = Future()
             
             # 非同期でFFmpegを起動
             threading.Thread(target=self._async_start_ffmpeg, daemon=True).start()
 
     def _async_start_ffmpeg(self):
         """FFmpegを別スレッドで起動し、バッファを同期的に流し込む。"""
-        ts = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-        filepath = os.path.join(self.save_directory, f"detected_{ts}.mp4")
+        now = datetime.datetime.now()
+        filename = f"{self.prefix}detected_{now.strftime('%Y%m%d_%H%M%S')}.mp4"
+        if self.storage is not None:
+            filepath = self.storage.path_for(filename, now)
+        else:
+            filepath = os.path.join(self.save_directory, filename)
         
         cmd = [
             'ffmpeg', '-y', '-f', 'rawvideo', '-vcodec', 'rawvideo',
@@ -102,6 +150,7 @@ class Recorder:
             '-pix_fmt', 'bgr24', '-r', str(self.fps),
             '-i', '-', '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
             '-preset', 'ultrafast', '-tune', 'zerolatency',
+            '-movflags', '+faststart', # moov atom を先頭に移動（ダウンロード完了前に再生開始可能）
             '-f', 'mp4', filepath
         ]
         
@@ -132,6 +181,8 @@ class Recorder:
             with self._lock:
                 self._starting = False
                 self.is_recording = False
+                clip = self._clip
+            self._finish_clip(clip, error=e)
 
     def write(self, frame):
         """実時間に基づいた精密補完を行いながらQueueに投入。"""
@@ -176,7 +227,7 @@ class Recorder:
         try:
             self._queue.put_nowait((None, frame))
         except queue.Full:
-            pass
+            metrics.inc('frames_dropped_total', stage='recorder')
 
     def schedule_stop(self, override_post_seconds=None):
         with self._lock:
@@ -200,20 +251,60 @@ class Recorder:
             retries -= 1
 
         with self._lock:
-            if self._process is not None:
-                self._queue.join()
-                try:
-                    if self._process.stdin:
-                        self._process.stdin.close()
-                    self._process.wait(timeout=5)
-                except Exception as e:
-                    print(f"[Recorder] FFmpeg termination error: {e}")
-                
-                self._process = None
+            proc = self._process
+            clip = self._clip
+            if proc is None:
+                if self._starting:
+                    # FFmpeg の起動が終わらない。クリップ待ちの通知が残らないよう失敗として確定する
+                    error = TimeoutError("FFmpeg did not start in time")
+                else:
+                    error = None
+                    clip = None
+            else:
+                # 以降のフレームは受け付けない（キューに残った分はワーカーが proc へ書き出す）
+                self._stopping = True
                 self.is_recording = False
+                path = self.current_video_path
+                frames = self._total_frames_pushed
                 self._last_frame = None
                 self._total_frames_pushed = 0
-                print(f"[Recorder] Saved (Synced): {self.current_video_path}")
+
+        if proc is None:
+            if clip is not None:
+                print(f"[Recorder] {error}")
+                self._finish_clip(clip, error=error)
+            return
+
+        # ffmpeg の終了待ちはロック外で行い、検知ループ (update_buffer / write) を止めない
+        info = error = None
+        try:
+            self._queue.join()
+            if proc.stdin:
+                proc.stdin.close()
+            # faststart の moov 移動を含めて書き出しが完了するまで待つ
+            returncode = proc.wait(timeout=30)
+            if returncode != 0:
+                error = RuntimeError(f"FFmpeg exited with code {returncode}")
+        except Exception as e:
+            print(f"[Recorder] FFmpeg termination error: {e}")
+            error = e
+
+        if error is None:
+            if self.storage is not None:
+                self.storage.mark_finalized(path)
+            info = {
+                "path": path,
+                "duration": frames / self.fps,
+                "size": os.path.getsize(path) if os.path.exists(path) else 0,
+                "frames": frames,
+            }
+        with self._lock:
+            self._process = None
+            self._stopping = False
+        print(f"[Recorder] Saved (Synced): {path}")
+
+        # ファイル確定後に通知（ロック外でコールバックを実行）
+        self._finish_clip(clip, info=info, error=error)
 
     def release(self):
         if self._stop_timer:
@@ -20,5 +20,26 @@ def download_model():
     except Exception as e:
         print(f"Error downloading model: {e}")
 
+HLS_JS_VERSION = "1.5.20"
+
+def download_hls_js():
+    # ダッシュボードの H.264 (HLS) 再生用。CDN から直接読み込まず static/ から配信する
+    url = f"https://cdn.jsdelivr.net/npm/hls.js@{HLS_JS_VERSION}/dist/hls.min.js"
+    static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+    path = os.path.join(static_dir, "hls.min.js")
+
+    print(f"Downloading hls.js {HLS_JS_VERSION}...")
+    try:
+        os.makedirs(static_dir, exist_ok=True)
+        req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
+        with urllib.request.urlopen(req) as response:
+            data = response.read()
+        with open(path, 'wb') as out_file:
+            out_file.write(data)
+        print(f"File saved as: {path}")
+    except Exception as e:
+        print(f"Error downloading hls.js: {e}")
+
 if __name__ == "__main__":
     download_model()
+    download_hls_js()
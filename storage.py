@@ -0,0 +1,199 @@
+import os
+import time
+import datetime
+import threading
+import subprocess
+
+MEDIA_EXTS = ('.jpg', '.mp4', '.avi')
+MIN_AGE_SECONDS = 60  # 書き込み中のファイルを誤って削除しないための猶予（秒）
+
+
+def iter_media(root):
+    """root 以下のメディアファイルを再帰的に列挙する。戻り値: (path, os.stat_result) のジェネレーター"""
+    for dirpath, _dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if not filename.lower().endswith(MEDIA_EXTS):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                yield path, os.stat(path)
+            except OSError:
+                continue  # 列挙中に削除された
+
+
+def media_relpath(root, path):
+    """root からの相対パスを URL 用の '/' 区切りで返す。"""
+    rel = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+    return rel.replace(os.sep, '/')
+
+
+def _lower_io_priority():
+    """呼び出し元スレッドの CPU / I/O 優先度を下げる（Linux 以外や権限不足時は何もしない）。"""
+    try:
+        tid = threading.get_native_id()
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+        subprocess.run(['ionice', '-c', '3', '-p', str(tid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    except (AttributeError, OSError):
+        pass
+
+
+class StorageManager:
+    """
+    保存ディレクトリを YYYY/MM/DD に分割し、保持期間・合計容量・空き容量に基づいて
+    古いファイルから順にバックグラウンドで削除するモジュール。
+    """
+    def __init__(self, root='records', retention_days=0, max_bytes=0, min_free_bytes=0, interval=600):
+        self.root = root
+        self.interval = interval
+        self.configure(retention_days, max_bytes, min_free_bytes)
+
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._finalized = set()  # この起動中に書き込みが完了したファイル（絶対パス）
+        self._started_at = time.time()
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+        os.makedirs(root, exist_ok=True)
+
+    def configure(self, retention_days=0, max_bytes=0, min_free_bytes=0):
+        """保持ポリシーを更新する（0 は無制限）。"""
+        self.retention_days = float(retention_days or 0)
+        self.max_bytes = int(max_bytes or 0)
+        self.min_free_bytes = int(min_free_bytes or 0)
+
+    def path_for(self, filename, when=None):
+        """日付ディレクトリ (root/YYYY/MM/DD) 内の保存パスを返し、ディレクトリを作成する。"""
+        when = when or datetime.datetime.now()
+        day_dir = os.path.join(self.root, when.strftime('%Y'), when.strftime('%m'), when.strftime('%d'))
+        os.makedirs(day_dir, exist_ok=True)
+        return os.path.join(day_dir, filename)
+
+    def mark_finalized(self, path):
+        """書き込みが完了し、以後内容が変わらないファイルとして登録する（録画の確定・静止画の保存後）。"""
+        with self._lock:
+            self._finalized.add(os.path.abspath(path))
+
+    def is_finalized(self, path):
+        """
+        内容が確定済みのファイルか。この起動中に完了を登録したもの、または起動前に書き込まれたもの
+        （このプロセスが書き込み中ではあり得ない）を確定済みとする。
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            if path in self._finalized:
+                return True
+        try:
+            return os.stat(path).st_mtime < self._started_at
+        except OSError:
+            return False
+
+    def relpath(self, path):
+        """root からの相対パスを URL 用の '/' 区切りで返す。"""
+        return media_relpath(self.root, path)
+
+    def add_listener(self, callback):
+        """削除完了時に削除したパスのリストを受け取るコールバックを登録する。"""
+        self._listeners.append(callback)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def request_cleanup(self):
+        """次の周期を待たずにクリーンアップを実行させる。"""
+        self._wake.set()
+
+    def _worker(self):
+        _lower_io_priority()
+        while self._running:
+            try:
+                self.enforce()
+            except Exception as e:
+                print(f"[Storage] Cleanup error: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def _free_bytes(self):
+        try:
+            st = os.statvfs(self.root)
+            return st.f_bavail * st.f_frsize
+        except (AttributeError, OSError):
+            return None
+
+    def enforce(self):
+        """保持ポリシーに従い古いファイルから削除する。戻り値: 削除したパスのリスト"""
+        if not (self.retention_days or self.max_bytes or self.min_free_bytes):
+            return []
+
+        with self._lock:
+            now = time.time()
+            files = sorted(iter_media(self.root), key=lambda item: item[1].st_mtime)
+            total = sum(st.st_size for _, st in files)
+            free = self._free_bytes() if self.min_free_bytes else None
+            cutoff = now - self.retention_days * 86400 if self.retention_days else None
+
+            deleted = []
+            for path, st in files:
+                if now - st.st_mtime < MIN_AGE_SECONDS:
+                    break
+                expired  = cutoff is not None and st.st_mtime < cutoff
+                over_cap = self.max_bytes and total > self.max_bytes
+                low_free = free is not None and free < self.min_free_bytes
+                # 古い順に見ているため、どの条件も満たさなくなった時点で終了
+                if not (expired or over_cap or low_free):
+                    break
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"[Storage] Failed to delete {path}: {e}")
+                    continue
+                total -= st.st_size
+                if free is not None:
+                    free += st.st_size
+                deleted.append(path)
+                self._finalized.discard(os.path.abspath(path))
+
+            self._prune_empty_dirs()
+
+        if deleted:
+            print(f"[Storage] Deleted {len(deleted)} old file(s).")
+            for callback in self._listeners:
+                try:
+                    callback(deleted)
+                except Exception as e:
+                    print(f"[Storage] Listener error: {e}")
+        return deleted
+
+    def _prune_empty_dirs(self):
+        """
+        空の日付ディレクトリを削除する。path_for() で作成した直後（ffmpeg がファイルを開く前）に
+        消さないよう、当日のディレクトリとその親、および作成・更新から MIN_AGE_SECONDS 未満のものは残す。
+        """
+        root = os.path.abspath(self.root)
+        now_dt = datetime.datetime.now()
+        today = os.path.join(root, now_dt.strftime('%Y'), now_dt.strftime('%m'), now_dt.strftime('%d'))
+        keep = {today, os.path.dirname(today), os.path.dirname(os.path.dirname(today))}
+        now = time.time()
+        emptied = set()  # この走査で子ディレクトリを削除した（mtime が更新された）ディレクトリ
+        for dirpath, _dirnames, _filenames in os.walk(root, topdown=False):
+            if dirpath == root or dirpath in keep:
+                continue
+            try:
+                if dirpath not in emptied and now - os.stat(dirpath).st_mtime < MIN_AGE_SECONDS:
+                    continue
+                os.rmdir(dirpath)  # 空でなければ OSError
+                emptied.add(os.path.dirname(dirpath))
+            except OSError:
+                pass
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=3)
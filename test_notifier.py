@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import notifier
+
+
+class _StubTelegram:
+    """Bot API の代わりに、用意した応答を順に返すローカル HTTP サーバー。"""
+    def __init__(self, responses):
+        self.responses = list(responses)  # [(status, body dict)]。使い切った後は 200
+        self.requests = []  # [(受信時刻, メソッド名)]
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                stub.requests.append((time.monotonic(), self.path.rsplit('/', 1)[-1]))
+                status, body = stub.responses.pop(0) if stub.responses else (200, {"ok": True})
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def wait_for(self, count, timeout=10):
+        deadline = time.monotonic() + timeout
+        while len(self.requests) < count and time.monotonic() < deadline:
+            time.sleep(0.02)
+        return len(self.requests) >= count
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(notifier, 'BACKOFF_BASE', 0.2)
+    monkeypatch.setattr(notifier, 'MIN_SEND_INTERVAL', 0.0)
+
+
+def _wait_drained(queue_dir, timeout=5):
+    deadline = time.monotonic() + timeout
+    while os.listdir(queue_dir) and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return not os.listdir(queue_dir)
+
+
+def test_retries_5xx_with_exponential_backoff(tmp_path, fast_backoff):
+    stub = _StubTelegram([(500, {"ok": False}), (502, {"ok": False})])
+    n = notifier.TelegramNotifier('token', 'chat', api_base=stub.url, queue_dir=str(tmp_path))
+    try:
+        n.send_message("hello")
+        assert stub.wait_for(3)
+        times = [t for t, _ in stub.requests]
+        assert times[1] - times[0] >= 0.2
+        assert times[2] - times[1] >= 0.4  # 2 回目の再送は間隔が倍になる
+        assert [m for _, m in stub.requests] == ['sendMessage'] * 3
+        assert _wait_drained(tmp_path)
+    finally:
+        n.stop()
+        stub.close()
+
+
+def test_429_waits_for_retry_after(tmp_path, fast_backoff):
+    stub = _StubTelegram([(429, {"ok": False, "parameters": {"retry_after": 1}})])
+    n = notifier.TelegramNotifier('token', 'chat', api_base=stub.url, queue_dir=str(tmp_path))
+    try:
+        n.send_message("hello")
+        assert stub.wait_for(2)
+        assert stub.requests[1][0] - stub.requests[0][0] >= 1.0
+        assert _wait_drained(tmp_path)
+    finally:
+        n.stop()
+        stub.close()
+
+
+def test_pending_jobs_are_delivered_after_restart(tmp_path, fast_backoff):
+    photo = tmp_path / "snap.jpg"
+    photo.write_bytes(b"\xff\xd8jpeg")
+    queue_dir = tmp_path / "queue"
+
+    # 送信前に停止した（再起動前の）インスタンス
+    offline = notifier.TelegramNotifier('token', 'chat', api_base='http://127.0.0.1:9',
+                                        queue_dir=str(queue_dir))
+    offline.queue.stop()
+    offline.send_message("pending text")
+    offline.send_photo(str(photo), caption="pending photo")
+    offline.send_photo(b"\xff\xd8in-memory", caption="pending blob")
+    offline.stop()
+    assert len([n for n in os.listdir(queue_dir) if n.endswith('.json')]) == 3
+
+    stub = _StubTelegram([])
+    n = notifier.TelegramNotifier('token', 'chat', api_base=stub.url, queue_dir=str(queue_dir))
+    try:
+        assert stub.wait_for(3)
+        assert [m for _, m in stub.requests] == ['sendMessage', 'sendPhoto', 'sendPhoto']
+        assert _wait_drained(queue_dir)
+        assert photo.exists()  # 保存済みのスナップショットは送信後も残す
+    finally:
+        n.stop()
+        stub.close()
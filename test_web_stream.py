@@ -0,0 +1,52 @@
+import os
+import time
+
+import web_stream
+
+
+def _client(monkeypatch, tmp_path):
+    monkeypatch.setattr(web_stream, 'records_root', str(tmp_path))
+    monkeypatch.setattr(web_stream, '_credentials',
+                        {"user": "admin", "hash": web_stream.hash_password("admin")})
+    client = web_stream.app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Basic YWRtaW46YWRtaW4='  # admin:admin
+    return client
+
+
+def test_finalized_record_is_private_and_immutable(monkeypatch, tmp_path):
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(b"\0" * 1024)
+    old = time.time() - web_stream.MIN_AGE_SECONDS - 60
+    os.utime(path, (old, old))
+
+    response = _client(monkeypatch, tmp_path).get('/records/clip.mp4')
+    assert response.status_code == 200
+    directives = [d.strip() for d in response.headers['Cache-Control'].split(',')]
+    assert sorted(directives) == sorted(
+        ['private', f'max-age={web_stream.RECORD_MAX_AGE}', 'immutable'])
+
+
+def test_recent_record_is_not_cached(monkeypatch, tmp_path):
+    (tmp_path / "live.mp4").write_bytes(b"\0" * 1024)
+
+    response = _client(monkeypatch, tmp_path).get('/records/live.mp4')
+    assert response.status_code == 200
+    assert 'no-cache' in response.headers['Cache-Control']
+    assert 'immutable' not in response.headers['Cache-Control']
+
+
+def test_record_is_immutable_only_after_storage_marks_it_finalized(monkeypatch, tmp_path):
+    from storage import StorageManager
+    storage = StorageManager(root=str(tmp_path))
+    monkeypatch.setattr(web_stream, 'storage_instance', storage)
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(b"\0" * 1024)
+    old = time.time() - web_stream.MIN_AGE_SECONDS - 60
+    os.utime(path, (old, old))  # 古い mtime でも、この起動中に書かれたものは確定登録まではキャッシュさせない
+    storage._started_at = old - 1
+    client = _client(monkeypatch, tmp_path)
+
+    assert 'no-cache' in client.get('/records/clip.mp4').headers['Cache-Control']
+
+    storage.mark_finalized(str(path))
+    assert 'immutable' in client.get('/records/clip.mp4').headers['Cache-Control']
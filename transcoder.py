@@ -0,0 +1,74 @@
+import os
+import subprocess
+
+MIN_VIDEO_BITRATE = 150_000  # これ未満の画質になる場合は再エンコードではなくトリミングする (bps)
+BUDGET_MARGIN = 0.9          # コンテナのオーバーヘッド・レート制御の誤差を見込んだ係数
+SUMMARY_FPS = 2              # キーフレーム要約動画の再生速度 (fps)
+
+
+def probe_duration(path):
+    """ffprobe で動画の長さ（秒）を取得する。取得できなければ None。"""
+    cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+           '-of', 'default=noprint_wrappers=1:nokey=1', path]
+    try:
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             timeout=15, check=True).stdout
+        return float(out.strip()) or None
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None
+
+
+def _run_ffmpeg(cmd, output_path, max_bytes):
+    """ffmpeg を実行し、出力が容量内に収まれば True。"""
+    try:
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       timeout=600, check=True)
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"[Transcoder] FFmpeg failed: {e}")
+        return False
+    return os.path.exists(output_path) and os.path.getsize(output_path) <= max_bytes
+
+
+def fit_to_budget(input_path, output_path, max_bytes, max_height=480):
+    """
+    動画を指定バイト数以内に収める。
+    1. 既に収まっていれば入力パスをそのまま返す
+    2. 目標ビットレートで再エンコード（解像度は max_height 以下に縮小）
+       ビットレートが下限を下回る長さの場合は先頭からトリミング
+    3. それでも収まらなければキーフレームのみの要約動画を作成
+    戻り値: 送信するファイルのパス（入力と異なる場合は呼び出し側で削除する）。失敗時は None
+    """
+    if os.path.getsize(input_path) <= max_bytes:
+        return input_path
+
+    scale = f"scale=-2:'min({int(max_height)},ih)'"
+    base = ['ffmpeg', '-y', '-loglevel', 'error']
+    encode = ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+              '-an', '-movflags', '+faststart', output_path]
+
+    duration = probe_duration(input_path)
+    if duration:
+        budget_bits = max_bytes * 8 * BUDGET_MARGIN
+        bitrate = int(budget_bits / duration)
+        trim = []
+        if bitrate < MIN_VIDEO_BITRATE:
+            bitrate = MIN_VIDEO_BITRATE
+            trim = ['-t', f"{budget_bits / MIN_VIDEO_BITRATE:.2f}"]
+            print(f"[Transcoder] Trimming {input_path} to {trim[1]}s to fit budget.")
+        cmd = (base + ['-i', input_path] + trim +
+               ['-vf', scale, '-b:v', str(bitrate), '-maxrate', str(bitrate),
+                '-bufsize', str(bitrate * 2)] + encode)
+        if _run_ffmpeg(cmd, output_path, max_bytes):
+            return output_path
+
+    # フォールバック: キーフレームのみを抜き出した要約動画
+    print(f"[Transcoder] Falling back to keyframe summary for {input_path}")
+    cmd = (base + ['-skip_frame', 'nokey', '-i', input_path,
+                   '-vf', f"{scale},setpts=N/({SUMMARY_FPS}*TB)", '-r', str(SUMMARY_FPS),
+                   '-crf', '32'] + encode)
+    if _run_ffmpeg(cmd, output_path, max_bytes):
+        return output_path
+
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    return None
@@ -0,0 +1,385 @@
+"""
+asyncio (Starlette + uvicorn) による Web サーバー。
+MJPEG ストリーミングとステータス API はイベントループ上で配信し、
+それ以外のルート（管理画面・設定 API・Blueprint）は WSGI として Flask アプリへ委譲する。
+"""
+import asyncio
+import base64
+import contextlib
+import json
+import threading
+import time
+
+try:
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.responses import Response, JSONResponse, StreamingResponse
+    from starlette.routing import Route, Mount
+    from starlette.concurrency import run_in_threadpool
+    try:
+        from a2wsgi import WSGIMiddleware
+    except ImportError:
+        from starlette.middleware.wsgi import WSGIMiddleware
+except ImportError:
+    uvicorn = None
+
+import web_stream
+from metrics import metrics
+
+STATUS_CHECK_INTERVAL = 0.5  # system_status の変化を確認する間隔（秒）
+VOLATILE_STATUS_INTERVAL = 2.0  # 毎フレーム変化する項目（FPS・遅延など）を送る最短間隔（秒）
+VOLATILE_STATUS_KEYS = ('fps', 'stream_fps', 'capture_latency_ms', 'display_latency_ms', 'camera_retry_in')
+SSE_KEEPALIVE = 20.0         # 無通信時に送るコメント行の間隔（秒）
+SSE_QUEUE_SIZE = 100         # クライアントごとの未送信イベント上限
+
+# クライアントごとの適応制御
+SEND_LAG_ALPHA = 0.3     # 送信待ち時間の指数移動平均の係数
+SLOW_SEND_RATIO = 1.5    # 平均送信待ちがフレーム間隔のこの倍率を超えたら 1 段階下げる
+FAST_SEND_RATIO = 0.25   # 平均送信待ちがフレーム間隔のこの倍率を下回る状態で
+RECOVER_AFTER = 60       # これだけのフレームを送信できたら 1 段階戻す
+ADAPT_MIN_FRAMES = 3     # 設定変更後、次の判定までに送るフレーム数
+MIN_CLIENT_FPS = 2
+MIN_CLIENT_QUALITY = 30
+QUALITY_STEP = 15
+
+
+def available():
+    return uvicorn is not None
+
+
+class _Variant:
+    """解像度・JPEG 品質の組み合わせごとの最新エンコード結果。"""
+    def __init__(self):
+        self.jpeg = None
+        self.event = asyncio.Event()
+        self.viewers = 0
+
+
+class FrameBroadcaster:
+    """
+    最新フレームを 1 つのスレッドでエンコードし、視聴者へ共有配信する。
+    同じ解像度・品質を選んだ視聴者は 1 つのエンコード結果を共有し、
+    解像度ごとのリサイズ・OSD 描画も 1 回のみ行う。視聴者がいない間はエンコードを停止する。
+    """
+    def __init__(self, loop, cam_id=None, max_fps=web_stream.MAX_STREAM_FPS):
+        self._loop = loop
+        self.cam_id = cam_id  # None の場合は 1 台目のカメラ
+        self.max_fps = max_fps
+        self._variants = {}  # (size, quality) -> _Variant（イベントループ上でのみ更新）
+        self._wanted = ()    # エンコードスレッドが参照するキーの一覧
+        self._active = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        prev_time = time.time()
+        last_source = None
+        while True:
+            self._active.wait()
+            start = time.time()
+            frame = web_stream.current_stream_source(self.cam_id)
+            wanted = self._wanted
+            # 同一フレームの再エンコードは行わない
+            if frame is not None and frame is not last_source and wanted:
+                last_source = frame
+                status = web_stream.camera_status(self.cam_id)
+                status['stream_fps'] = round(1.0 / max(start - prev_time, 1e-6), 1)
+                prev_time = start
+                composed = {}
+                results = {}
+                with metrics.timer('encode'):
+                    for size, quality in wanted:
+                        if size not in composed:
+                            composed[size] = web_stream.compose_stream_frame(frame, size, status)
+                        jpeg = web_stream.encode_jpeg(composed[size], quality)
+                        if jpeg is not None:
+                            results[(size, quality)] = jpeg
+                if results:
+                    self._loop.call_soon_threadsafe(self._publish, results)
+            time.sleep(max(0.01, 1.0 / self.max_fps - (time.time() - start)))
+
+    def _publish(self, results):
+        for key, jpeg in results.items():
+            variant = self._variants.get(key)
+            if variant is None:
+                continue  # エンコード中に視聴者がいなくなった
+            variant.jpeg = jpeg
+            event, variant.event = variant.event, asyncio.Event()
+            event.set()
+
+    def _acquire(self, key):
+        variant = self._variants.get(key)
+        if variant is None:
+            variant = self._variants[key] = _Variant()
+            self._wanted = tuple(self._variants)
+        variant.viewers += 1
+        self._active.set()
+        return variant
+
+    def _release(self, key):
+        variant = self._variants[key]
+        variant.viewers -= 1
+        if variant.viewers == 0:
+            del self._variants[key]
+            self._wanted = tuple(self._variants)
+            if not self._variants:
+                self._active.clear()
+
+    async def frames(self, size, quality=web_stream.DEFAULT_JPEG_QUALITY, fps=web_stream.MAX_STREAM_FPS):
+        """
+        新しいフレームが届くたびに JPEG を返す非同期ジェネレーター。
+        yield から再開までの時間（= 送信待ち）の平均がフレーム間隔を上回る場合、
+        この視聴者のみ FPS を半減し、下限に達したら JPEG 品質を下げる。回復時は逆順に戻す。
+        """
+        min_quality = min(quality, MIN_CLIENT_QUALITY)
+        min_fps = min(fps, MIN_CLIENT_FPS)
+        cur_quality, cur_fps = quality, fps
+        lag = 0.0
+        sent = 0  # 直近の設定変更以降に送信したフレーム数
+        key = (size, cur_quality)
+        variant = self._acquire(key)
+        last_sent = 0.0
+        try:
+            while True:
+                interval = 1.0 / cur_fps
+                wait = last_sent + interval - self._loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                event = variant.event
+                await event.wait()
+
+                last_sent = self._loop.time()
+                yield variant.jpeg
+                elapsed = self._loop.time() - last_sent
+                metrics.observe('stream', elapsed)
+
+                # 送信バッファが空くと次の書き込みは即座に終わるため、単発ではなく平均で判定する
+                lag += SEND_LAG_ALPHA * (elapsed - lag)
+                sent += 1
+
+                new_fps, new_quality = cur_fps, cur_quality
+                if sent >= ADAPT_MIN_FRAMES and lag > interval * SLOW_SEND_RATIO:
+                    if cur_fps > min_fps:
+                        new_fps = max(min_fps, cur_fps // 2)
+                    elif cur_quality > min_quality:
+                        new_quality = max(min_quality, cur_quality - QUALITY_STEP)
+                elif sent >= RECOVER_AFTER and lag < interval * FAST_SEND_RATIO:
+                    if cur_quality < quality:
+                        new_quality = min(quality, cur_quality + QUALITY_STEP)
+                    elif cur_fps < fps:
+                        new_fps = min(fps, cur_fps * 2)
+
+                if (new_fps, new_quality) != (cur_fps, cur_quality):
+                    sent = 0
+                    print(f"[Stream] Client {size[0]}x{size[1]}: "
+                          f"{cur_fps}fps/q{cur_quality} -> {new_fps}fps/q{new_quality}")
+                    cur_fps = new_fps
+                if new_quality != cur_quality:
+                    cur_quality = new_quality
+                    self._release(key)
+                    key = (size, cur_quality)
+                    variant = self._acquire(key)
+        finally:
+            # クライアント切断時は Starlette がジェネレーターをキャンセルする
+            self._release(key)
+
+
+class EventHub:
+    """
+    ダッシュボードへのプッシュ配信 (Server-Sent Events) を管理する。
+    system_status は変化したキーのみを送り、ログ・メディアのイベントはそのまま中継する。
+    """
+    def __init__(self, loop):
+        self._loop = loop
+        self._queues = set()
+        self._last_status = dict(web_stream.system_status)
+        web_stream.subscribe_events(self.publish_threadsafe)
+        self._task = loop.create_task(self._watch_status())
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        self._queues.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._queues.discard(queue)
+
+    def publish_threadsafe(self, kind, data):
+        self._loop.call_soon_threadsafe(self._publish, kind, data)
+
+    def _publish(self, kind, data):
+        for queue in self._queues:
+            try:
+                queue.put_nowait((kind, data))
+            except asyncio.QueueFull:
+                pass  # 受信が滞っているクライアントの分は破棄
+
+    async def _watch_status(self):
+        last_volatile = 0.0
+        while True:
+            await asyncio.sleep(STATUS_CHECK_INTERVAL)
+            current = dict(web_stream.system_status)
+            delta = {k: v for k, v in current.items() if self._last_status.get(k) != v}
+            # FPS・遅延はほぼ毎フレーム変わるため、VOLATILE_STATUS_INTERVAL ごとにまとめて送る
+            now = time.monotonic()
+            if now - last_volatile >= VOLATILE_STATUS_INTERVAL:
+                if any(k in delta for k in VOLATILE_STATUS_KEYS):
+                    last_volatile = now
+            else:
+                for k in VOLATILE_STATUS_KEYS:
+                    if k in delta:
+                        del delta[k]
+                        current[k] = self._last_status.get(k)  # 次回、最後に送った値と比較する
+            self._last_status = current
+            if delta:
+                self._publish('status', delta)
+
+
+def _sse(kind, data):
+    return f"event: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8')
+
+
+async def _basic_auth_ok(request):
+    scheme, _, value = request.headers.get('authorization', '').partition(' ')
+    if scheme.lower() != 'basic':
+        return False
+    try:
+        username, _, password = base64.b64decode(value).decode('utf-8').partition(':')
+    except (ValueError, UnicodeDecodeError):
+        return False
+    # 初回のパスワード検証 (PBKDF2) はイベントループを止めないようスレッドで実行
+    return await run_in_threadpool(web_stream.check_auth, username, password)
+
+
+def _authenticate():
+    return Response('認証が必要です。', status_code=401,
+                    headers={'WWW-Authenticate': 'Basic realm="Monitoring Camera"'})
+
+
+def requires_auth(endpoint):
+    async def decorated(request):
+        # セッション Cookie があれば Basic 認証の検証を省略
+        if web_stream.verify_session_token(request.cookies.get(web_stream.SESSION_COOKIE)):
+            return await endpoint(request)
+        if not await _basic_auth_ok(request):
+            return _authenticate()
+        response = await endpoint(request)
+        response.set_cookie(web_stream.SESSION_COOKIE, web_stream.issue_session_token(),
+                            max_age=web_stream.SESSION_TTL, httponly=True, samesite='strict',
+                            secure=request.url.scheme == 'https')
+        return response
+    return decorated
+
+
+def _broadcaster(app, cam_id):
+    """カメラごとの FrameBroadcaster（初回の視聴時に作成）。"""
+    broadcasters = app.state.broadcasters
+    if cam_id not in broadcasters:
+        broadcasters[cam_id] = FrameBroadcaster(asyncio.get_running_loop(), cam_id)
+    return broadcasters[cam_id]
+
+
+async def raw_frames(cam_id, fps):
+    """MJPEG パススルー中のカメラの JPEG をそのまま返す（エンコードスレッドを経由しない）。"""
+    status = web_stream.camera_status(cam_id)
+    loop = asyncio.get_running_loop()
+    last_seq = None
+    prev_time = loop.time()
+    while True:
+        start = loop.time()
+        source = web_stream.raw_jpeg_source(cam_id)
+        if source is not None and source[0] != last_seq:
+            last_seq, jpeg = source
+            status['stream_fps'] = round(1.0 / max(start - prev_time, 1e-6), 1)
+            prev_time = start
+            yield jpeg
+            metrics.observe('stream', loop.time() - start)
+        await asyncio.sleep(max(0.01, 1.0 / fps - (loop.time() - start)))
+
+
+def _mjpeg_response(request, cam_id):
+    size, quality, fps = web_stream.parse_stream_params(request.query_params)
+    if web_stream.wants_raw(request.query_params) and web_stream.raw_jpeg_source(cam_id) is not None:
+        frames = raw_frames(cam_id, fps)
+    else:
+        frames = _broadcaster(request.app, cam_id).frames(size, quality, fps)
+
+    async def stream():
+        async for jpeg in frames:
+            yield web_stream.mjpeg_part(jpeg)
+
+    return StreamingResponse(stream(), media_type='multipart/x-mixed-replace; boundary=frame')
+
+
+@requires_auth
+async def video_feed(request):
+    return _mjpeg_response(request, None)
+
+
+@requires_auth
+async def camera_video_feed(request):
+    cam_id = request.path_params['cam_id']
+    if cam_id not in web_stream.cameras:
+        return Response('Not Found', status_code=404)
+    return _mjpeg_response(request, cam_id)
+
+
+@requires_auth
+async def api_status(request):
+    return JSONResponse(web_stream.system_status)
+
+
+@requires_auth
+async def camera_api_status(request):
+    pipeline = web_stream.cameras.get(request.path_params['cam_id'])
+    if pipeline is None:
+        return Response('Not Found', status_code=404)
+    return JSONResponse(pipeline.status)
+
+
+@requires_auth
+async def api_events(request):
+    hub = request.app.state.events
+
+    async def stream():
+        queue = hub.subscribe()
+        try:
+            # 接続直後は全項目を送信し、以降は差分のみ
+            yield _sse('status', dict(web_stream.system_status))
+            while True:
+                try:
+                    kind, data = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield b': keepalive\n\n'
+                    continue
+                yield _sse(kind, data)
+        finally:
+            hub.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    app.state.broadcasters = {}
+    app.state.events = EventHub(asyncio.get_running_loop())
+    yield
+
+
+def create_app():
+    return Starlette(
+        routes=[
+            Route('/video_feed', video_feed),
+            Route('/api/status', api_status),
+            Route('/cam/{cam_id}/video_feed', camera_video_feed),
+            Route('/cam/{cam_id}/api/status', camera_api_status),
+            Route('/api/events', api_events),
+            Mount('/', app=WSGIMiddleware(web_stream.app)),
+        ],
+        lifespan=lifespan)
+
+
+def serve(host='0.0.0.0', port=5000):
+    config = uvicorn.Config(create_app(), host=host, port=port, log_level='warning')
+    uvicorn.Server(config).run()
@@ -1,20 +1,32 @@
-from flask import Flask, Response, render_template_string, request, jsonify, redirect, url_for, send_from_directory
+from flask import Flask, Response, render_template_string, request, jsonify, redirect, url_for, send_from_directory, send_file, abort, make_response
 from functools import wraps
 import cv2
+import numpy as np
 import json
 import os
+import hmac
+import hashlib
+import secrets
 import datetime
 import threading
 import shutil
 import time
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 from detector import HumanDetector
 from model_test_web import model_test_bp
+from storage import iter_media, media_relpath, MIN_AGE_SECONDS
+from live_stream import LiveStreamer, PLAYLIST
+from metrics import metrics
 
 app = Flask(__name__)
 camera_instance = None
 logger_instance = None
 detector_instance = None  # HumanDetector をここで保持
+storage_instance = None   # StorageManager (保存先の日付分割・自動削除)
+records_root = os.path.abspath('records')  # 録画保存先 (run_server で config から確定)
+live_instance = None      # LiveStreamer (H.264 / HLS 低帯域ライブ配信)
+cameras = {}              # カメラ ID -> CameraPipeline（1 台目が既定のカメラ）
 
 app.register_blueprint(model_test_bp)
 
@@ -22,12 +34,19 @@ system_status = {
     "running": True,
     "detections_total": 0,
     "last_detected": "—",
-    "fps": 0,
+    "fps": 0,          # 検知パイプラインの処理レート
+    "stream_fps": 0,   # 配信用エンコードのレート
+    "capture_latency_ms": 0,  # 撮像からデコード完了まで
+    "display_latency_ms": 0,  # 撮像から検知枠描画済みフレームの用意まで
     "human_count": 0,
+    "camera_state": "connecting",  # connecting / online / reconnecting / finished
+    "camera_reconnects": 0,
+    "camera_retry_in": None,       # 次の再接続試行までの秒数
     "stream_width": 640,
     "stream_height": 480,
 }
 latest_processed_frame = None  # 加工済みフレームの共有用 (JSONシリアライズ対象外)
+_event_listeners = []          # プッシュ配信 (SSE) 用のイベント購読者
 
 UPLOAD_FOLDER = 'Uploads'
 TMP_TEST_FOLDER = 'tmp_test'
@@ -38,6 +57,11 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['TMP_TEST_FOLDER'] = TMP_TEST_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024 # 100MB limit
 
+RECORD_MAX_AGE = 365 * 24 * 3600  # 確定済み録画ファイルのキャッシュ期間（秒）
+
+DEFAULT_JPEG_QUALITY = 95  # OpenCV の既定値
+MAX_STREAM_FPS = 15        # 配信用エンコードの上限 FPS
+
 # ============================================================
 # HTML テンプレート
 # ============================================================
@@ -210,9 +234,17 @@ TEMPLATE = """
 
       <!-- ライブ映像 -->
       <div class="card">
-        <div class="card-header">📡 ライブ映像</div>
+        <div class="card-header" style="display:flex; align-items:center;">📡 ライブ映像
+          {% if cameras|length > 1 %}
+          <select id="cam-select" onchange="selectCamera(this.value)" style="margin-left:auto; width:auto;">
+            {% for cam in cameras %}<option value="{{ cam.id }}">{{ cam.name }}</option>{% endfor %}
+          </select>
+          {% endif %}
+        </div>
         <img id="stream-img" src="{{ url_for('video_feed') }}" alt="camera stream">
+        <video id="stream-video" muted autoplay playsinline style="display:none; width:100%;"></video>
         <div class="badge-row">
+          <button class="badge" id="btn-stream-mode" style="cursor:pointer;" onclick="toggleStreamMode()">MJPEG</button>
           <span class="badge" id="badge-fps">FPS: —</span>
           <span class="badge" id="badge-res">解像度: —</span>
           <span class="badge" id="badge-count">累計検知: —</span>
@@ -229,7 +261,9 @@ TEMPLATE = """
           <div class="stat"><span class="stat-label">フレーム内の人数</span><span class="stat-value blue" id="st-humans">0</span></div>
           <div class="stat"><span class="stat-label">累計検知回数</span><span class="stat-value" id="st-total">0</span></div>
           <div class="stat"><span class="stat-label">最終検知日時</span><span class="stat-value" id="st-last">—</span></div>
+          <div class="stat"><span class="stat-label">カメラ</span><span class="stat-value" id="st-camera">—</span></div>
           <div class="stat"><span class="stat-label">FPS</span><span class="stat-value" id="st-fps">—</span></div>
+          <div class="stat"><span class="stat-label">遅延 (取得 / 表示)</span><span class="stat-value" id="st-latency">—</span></div>
           <div class="stat"><span class="stat-label">ストリーム解像度</span><span class="stat-value" id="st-res">—</span></div>
         </div>
       </div>
@@ -421,6 +455,23 @@ TEMPLATE = """
           </select>
         </div>
 
+        <div class="section-title">保存容量管理</div>
+        <div style="font-size:0.7rem; color:var(--muted); margin-bottom:8px;">
+          古いファイルから自動削除します（0 で無制限）。
+        </div>
+        <div class="form-group">
+          <label>保持期間（日）</label>
+          <input type="number" name="storage_retention_days" value="{{ config.get('storage_retention_days', 0) }}" min="0" max="365">
+        </div>
+        <div class="form-group">
+          <label>最大使用容量（GB）</label>
+          <input type="number" name="storage_max_gb" value="{{ config.get('storage_max_gb', 0) }}" min="0" step="0.5">
+        </div>
+        <div class="form-group">
+          <label>最低空き容量（MB）</label>
+          <input type="number" name="storage_min_free_mb" value="{{ config.get('storage_min_free_mb', 0) }}" min="0" step="100">
+        </div>
+
         <button type="button" class="btn primary" onclick="saveForm('form-recorder', 'msg-recorder')">保存</button>
         <div id="msg-recorder" class="success-msg">✅ 保存しました</div>
       </form>
@@ -474,7 +525,7 @@ TEMPLATE = """
         </div>
         <div class="form-group">
           <label>パスワード</label>
-          <input type="text" name="web_pass" value="{{ config.get('web_pass','admin') }}">
+          <input type="password" name="web_pass" value="" placeholder="変更する場合のみ入力" autocomplete="new-password">
         </div>
         <button type="button" class="btn primary" onclick="saveForm('form-auth','msg-auth')">保存</button>
         <div id="msg-auth" class="success-msg">✅ 保存しました</div>
@@ -542,26 +593,59 @@ TEMPLATE = """
     // --------------------------------------------------------
     // ポーリング & バックエンド通信
     // --------------------------------------------------------
+    // 2 台目以降のカメラを選択中は /cam/<id>/ 配下の API を使う（null = 1 台目）
+    let currentCam = null;
+    const camUrl = (path) => currentCam ? `/cam/${currentCam}${path}` : path;
+
+    let camStatusTimer = null;
+    function selectCamera(id) {
+      const first = document.querySelector('#cam-select option');
+      currentCam = (first && first.value === id) ? null : id;
+      for (const k in statusState) delete statusState[k];
+      const img = document.getElementById('stream-img');
+      if (img.style.display !== 'none') img.src = camUrl('/video_feed');
+      // 1 台目のステータスはプッシュ配信、それ以外はポーリングで取得
+      clearInterval(camStatusTimer);
+      if (currentCam) camStatusTimer = setInterval(pollStatus, 2000);
+      pollStatus(); pollLogs();
+    }
+
+    const statusState = {};
+    function applyStatus(delta) {
+      // プッシュ配信では変化した項目のみ届くため、保持している状態にマージする
+      Object.assign(statusState, delta);
+      const d = statusState;
+      const el = (id) => document.getElementById(id);
+      if(el('badge-fps')) el('badge-fps').textContent = 'FPS: ' + d.fps;
+      if(el('badge-res')) el('badge-res').textContent = d.stream_width + 'x' + d.stream_height;
+      if(el('badge-count')) el('badge-count').textContent = '累計: ' + d.detections_total;
+      if(el('badge-last')) el('badge-last').textContent = '最終: ' + d.last_detected;
+      if(el('st-running')) el('st-running').textContent = d.running ? '稼働中' : '停止中';
+      if(el('st-humans')) el('st-humans').textContent = d.human_count;
+      if(el('st-total')) el('st-total').textContent = d.detections_total;
+      if(el('st-last')) el('st-last').textContent = d.last_detected;
+      if(el('st-fps')) el('st-fps').textContent = d.fps;
+      if(el('st-camera')) {
+        const states = {online: '接続中', connecting: '接続待ち', reconnecting: '再接続中', finished: '再生終了'};
+        let text = states[d.camera_state] || '—';
+        if (d.camera_state === 'reconnecting' && d.camera_retry_in != null) text += ' (' + d.camera_retry_in + '秒後)';
+        if (d.camera_reconnects) text += ' / 再接続 ' + d.camera_reconnects + '回';
+        el('st-camera').textContent = text;
+        el('st-camera').className = 'stat-value ' + (d.camera_state === 'online' ? 'green' : 'red');
+      }
+      if(el('st-latency')) el('st-latency').textContent = d.capture_latency_ms + ' / ' + d.display_latency_ms + ' ms';
+      if(el('st-res')) el('st-res').textContent = d.stream_width + 'x' + d.stream_height;
+      
+      const alertBadge = el('badge-alert');
+      if(alertBadge) {
+        alertBadge.style.display = d.human_count > 0 ? 'inline-block' : 'none';
+        alertBadge.className = d.human_count > 0 ? 'badge alert' : 'badge';
+      }
+    }
+
     async function pollStatus() {
       try {
-        const d = await fetch('/api/status').then(r => r.json());
-        const el = (id) => document.getElementById(id);
-        if(el('badge-fps')) el('badge-fps').textContent = 'FPS: ' + d.fps;
-        if(el('badge-res')) el('badge-res').textContent = d.stream_width + 'x' + d.stream_height;
-        if(el('badge-count')) el('badge-count').textContent = '累計: ' + d.detections_total;
-        if(el('badge-last')) el('badge-last').textContent = '最終: ' + d.last_detected;
-        if(el('st-running')) el('st-running').textContent = d.running ? '稼働中' : '停止中';
-        if(el('st-humans')) el('st-humans').textContent = d.human_count;
-        if(el('st-total')) el('st-total').textContent = d.detections_total;
-        if(el('st-last')) el('st-last').textContent = d.last_detected;
-        if(el('st-fps')) el('st-fps').textContent = d.fps;
-        if(el('st-res')) el('st-res').textContent = d.stream_width + 'x' + d.stream_height;
-        
-        const alertBadge = el('badge-alert');
-        if(alertBadge) {
-          alertBadge.style.display = d.human_count > 0 ? 'inline-block' : 'none';
-          alertBadge.className = d.human_count > 0 ? 'badge alert' : 'badge';
-        }
+        applyStatus(await fetch(camUrl('/api/status')).then(r => r.json()));
       } catch(e) {}
     }
 
@@ -579,15 +663,14 @@ TEMPLATE = """
       try {
         const target = document.getElementById('log-body');
         if(!target) return;
-        const rows = await fetch(`/api/logs?date=${currentLogDate}`).then(r => r.json());
+        const rows = await fetch(camUrl(`/api/logs?date=${currentLogDate}`)).then(r => r.json());
         if (!rows || !rows.length) {
           target.innerHTML = '<tr><td colspan="4" style="text-align:center;color:var(--muted);padding:14px">データなし</td></tr>';
           return;
         }
         target.innerHTML = rows.map(r => {
-          const getFilename = (p) => p ? p.split(/[\\/]/).pop() : null;
-          const snapFile = getFilename(r.snapshot_path);
-          const videoFile = getFilename(r.video_path);
+          const snapFile = r.snapshot_url || null;
+          const videoFile = r.video_url || null;
           const snapLink = snapFile ? `<a href="/records/${snapFile}" target="_blank">📷</a>` : '—';
           let videoLink = '—';
           if (videoFile) {
@@ -668,14 +751,92 @@ TEMPLATE = """
       } catch(e) { alert("接続エラー"); }
     }
 
+    // --------------------------------------------------------
+    // ライブ映像の切替 (MJPEG / H.264 HLS)
+    // --------------------------------------------------------
+    let hlsPlayer = null;
+    let hlsLoading = null;
+    // hls.js は H.264 に切り替えたときだけ static/ から読み込む（Safari 等のネイティブ HLS では不要）
+    function loadHls() {
+      if (window.Hls) return Promise.resolve();
+      if (!hlsLoading) {
+        hlsLoading = new Promise((resolve, reject) => {
+          const s = document.createElement('script');
+          s.src = '/static/hls.min.js';
+          s.onload = resolve;
+          s.onerror = () => { hlsLoading = null; reject(); };
+          document.head.appendChild(s);
+        });
+      }
+      return hlsLoading;
+    }
+    async function toggleStreamMode() {
+      const img = document.getElementById('stream-img');
+      const video = document.getElementById('stream-video');
+      const btn = document.getElementById('btn-stream-mode');
+      const toH264 = video.style.display === 'none';
+      if (toH264 && currentCam) {
+        alert('H.264 配信は 1 台目のカメラのみ対応しています');
+        return;
+      }
+      if (toH264) {
+        img.src = '';  // MJPEG の接続を切断
+        const url = '/live/index.m3u8';
+        const nativeHls = video.canPlayType('application/vnd.apple.mpegurl');
+        if (!nativeHls) {
+          try { await loadHls(); } catch(e) {}
+        }
+        if (nativeHls) {
+          video.src = url;
+        } else if (window.Hls && Hls.isSupported()) {
+          hlsPlayer = new Hls({ liveSyncDurationCount: 2 });
+          hlsPlayer.loadSource(url);
+          hlsPlayer.attachMedia(video);
+        } else {
+          alert('このブラウザは H.264 ライブ配信に対応していません');
+          img.src = camUrl('/video_feed');
+          return;
+        }
+        video.style.display = 'block'; img.style.display = 'none';
+        btn.textContent = 'H.264';
+      } else {
+        if (hlsPlayer) { hlsPlayer.destroy(); hlsPlayer = null; }
+        video.removeAttribute('src'); video.load();
+        video.style.display = 'none'; img.style.display = 'block';
+        img.src = camUrl('/video_feed');
+        btn.textContent = 'MJPEG';
+      }
+    }
+
     // --------------------------------------------------------
     // ループ開始
     // --------------------------------------------------------
+    let pollingStarted = false;
+    function startPolling() {
+      if (pollingStarted) return;
+      pollingStarted = true;
+      setInterval(pollStatus, 2000); pollStatus();
+      setInterval(pollLogs, 5000); pollLogs();
+    }
+
+    // Server-Sent Events で変化があった時のみ更新（非対応環境ではポーリング）
+    function startPush() {
+      if (!window.EventSource) return false;
+      const es = new EventSource('/api/events');
+      es.addEventListener('status', e => { if (!currentCam) applyStatus(JSON.parse(e.data)); });
+      es.addEventListener('log', e => {
+        const r = JSON.parse(e.data);
+        if (r.timestamp && r.timestamp.startsWith(currentLogDate)) pollLogs();
+      });
+      es.onerror = () => { if (es.readyState === EventSource.CLOSED) startPolling(); };
+      return true;
+    }
+
     window.onload = () => {
       const display = document.getElementById('log-date-display');
       if(display) display.textContent = '[' + currentLogDate + ']';
-      setInterval(pollStatus, 2000); pollStatus();
-      setInterval(pollLogs, 5000); pollLogs();
+      pollLogs();
+      if (!startPush()) startPolling();
     };
   </script>
 </body>
@@ -765,13 +926,13 @@ MEDIA_TEMPLATE = """
         listArea.innerHTML = files.map(f => {
           const isVideo = f.name.match(/\.(mp4|avi)$/i);
           const icon = isVideo ? '🎬' : '📷';
-          const thumbSrc = isVideo ? '' : `/records/${f.name}`;
+          const thumbSrc = isVideo ? '' : `/records/${f.path}`;
           const thumbHtml = isVideo 
             ? `<div class="media-thumb" style="display:flex;align-items:center;justify-content:center;color:var(--muted);font-size:2rem;">${icon}</div>`
             : `<img class="media-thumb" src="${thumbSrc}" loading="lazy">`;
           
           return `
-            <div class="media-card" onclick="openViewer('${f.name}', ${!!isVideo})">
+            <div class="media-card" onclick="openViewer('${f.path}', ${!!isVideo})">
               ${thumbHtml}
               <div class="media-info">
                 <div class="media-name">${f.name}</div>
@@ -788,14 +949,14 @@ MEDIA_TEMPLATE = """
       }
     }
 
-    function openViewer(name, isVideo) {
+    function openViewer(path, isVideo) {
       const viewer = document.getElementById('viewer');
       const main = document.getElementById('viewer-main');
       const title = document.getElementById('viewer-title');
       const dl = document.getElementById('download-link');
       
-      const fileUrl = `/records/${name}`;
-      title.textContent = name;
+      const fileUrl = `/records/${path}`;
+      title.textContent = path;
       dl.href = fileUrl;
       
       if (isVideo) {
@@ -814,6 +975,16 @@ MEDIA_TEMPLATE = """
     }
 
     loadMedia();
+
+    // 新しい録画・削除をプッシュ通知で反映
+    if (window.EventSource) {
+      const es = new EventSource('/api/events');
+      let timer = null;
+      const refresh = () => { clearTimeout(timer); timer = setTimeout(loadMedia, 500); };
+      es.addEventListener('media', refresh);
+      es.addEventListener('media_removed', refresh);
+      es.onerror = () => { if (es.readyState === EventSource.CLOSED) es.close(); };
+    }
   </script>
 </body>
 </html>
@@ -822,10 +993,75 @@ MEDIA_TEMPLATE = """
 # ============================================================
 # Basic 認証ヘルパー
 # ============================================================
-def check_auth(username, password):
+PBKDF2_ITERATIONS = 100_000
+SESSION_COOKIE = 'cam_session'
+SESSION_TTL = 12 * 3600  # セッション Cookie の有効期間（秒）
+
+_AUTH_SECRET = secrets.token_bytes(32)  # プロセスごとの署名鍵（再起動でセッションは失効）
+_credentials = None      # {"user", "hash"} — config.json から一度だけ読み込んで保持
+_verified_cache = set()  # 検証済み資格情報の HMAC（PBKDF2 の再計算を避ける）
+_auth_lock = threading.Lock()
+
+def hash_password(password, salt=None, iterations=PBKDF2_ITERATIONS):
+    """パスワードをソルト付き PBKDF2-SHA256 でハッシュ化する。"""
+    salt = salt or secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${digest.hex()}"
+
+def _verify_password(password, encoded):
+    try:
+        algo, iterations, salt, expected = encoded.split('$')
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), bytes.fromhex(salt), int(iterations))
+    except ValueError:
+        return False
+    return algo == 'pbkdf2_sha256' and hmac.compare_digest(digest.hex(), expected)
+
+def _load_credentials():
+    """資格情報をメモリに読み込む。平文の web_pass が残っていればハッシュに置き換えて保存する。"""
+    global _credentials
     config = load_config()
-    return (username == config.get('web_user', 'admin') and
-            password == config.get('web_pass', 'admin'))
+    if 'web_pass' in config or not config.get('web_pass_hash'):
+        config['web_pass_hash'] = hash_password(str(config.pop('web_pass', 'admin')))
+        _write_config(config)
+    with _auth_lock:
+        _credentials = {"user": config.get('web_user', 'admin'), "hash": config['web_pass_hash']}
+        _verified_cache.clear()
+    return _credentials
+
+def check_auth(username, password):
+    creds = _credentials or _load_credentials()
+    key = hmac.new(_AUTH_SECRET, f"{username}\0{password}".encode('utf-8'), 'sha256').digest()
+    with _auth_lock:
+        if key in _verified_cache:
+            return True
+
+    # ユーザー名・パスワードとも定数時間で比較（短絡評価しない）
+    user_ok = hmac.compare_digest(username.encode('utf-8'), creds['user'].encode('utf-8'))
+    pass_ok = _verify_password(password, creds['hash'])
+    if user_ok and pass_ok:
+        with _auth_lock:
+            if len(_verified_cache) > 16:
+                _verified_cache.clear()
+            _verified_cache.add(key)
+    return user_ok and pass_ok
+
+def _session_sig(expires):
+    creds = _credentials or _load_credentials()
+    # 資格情報を署名に含め、ユーザー名・パスワード変更時に既存セッションを無効化する
+    msg = f"{expires}:{creds['user']}:{creds['hash']}".encode('utf-8')
+    return hmac.new(_AUTH_SECRET, msg, 'sha256').hexdigest()
+
+def issue_session_token():
+    expires = int(time.time()) + SESSION_TTL
+    return f"{expires}.{_session_sig(expires)}"
+
+def verify_session_token(token):
+    try:
+        expires_str, sig = token.split('.', 1)
+        expires = int(expires_str)
+    except (AttributeError, ValueError):
+        return False
+    return expires > time.time() and hmac.compare_digest(sig, _session_sig(expires))
 
 def authenticate():
     return Response(
@@ -835,10 +1071,16 @@ def authenticate():
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
+        # セッション Cookie があれば Basic 認証の検証を省略
+        if verify_session_token(request.cookies.get(SESSION_COOKIE)):
+            return f(*args, **kwargs)
         auth = request.authorization
-        if not auth or not check_auth(auth.username, auth.password):
+        if not auth or not check_auth(auth.username or '', auth.password or ''):
             return authenticate()
-        return f(*args, **kwargs)
+        response = make_response(f(*args, **kwargs))
+        response.set_cookie(SESSION_COOKIE, issue_session_token(), max_age=SESSION_TTL,
+                            httponly=True, samesite='Strict', secure=request.is_secure)
+        return response
     return decorated
 
 # ============================================================
@@ -850,11 +1092,22 @@ def load_config():
     with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
         return json.load(f)
 
+def _write_config(config):
+    with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+
 def save_config(new_values: dict):
     config = load_config()
+    new_values = dict(new_values)
+    # パスワードは平文で保存せずハッシュのみ保持（空欄は変更なし）
+    password = new_values.pop('web_pass', None)
+    if password:
+        config['web_pass_hash'] = hash_password(str(password))
+        config.pop('web_pass', None)
     config.update(new_values)
-    with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
-        json.dump(config, f, ensure_ascii=False, indent=4)
+    _write_config(config)
+    if password or 'web_user' in new_values:
+        _load_credentials()
     return config
 
 # ============================================================
@@ -864,13 +1117,20 @@ def save_config(new_values: dict):
 @requires_auth
 def index():
     config = load_config()
-    return render_template_string(TEMPLATE, config=config)
+    camera_list = [{"id": cam_id, "name": p.name} for cam_id, p in cameras.items()]
+    return render_template_string(TEMPLATE, config=config, cameras=camera_list)
 
 @app.route('/api/status')
 @requires_auth
 def api_status():
     return jsonify(system_status)
 
+@app.route('/api/metrics')
+@requires_auth
+def api_metrics():
+    """処理段階ごとのレイテンシ・キュー長・取りこぼし数・CPU 温度 (Prometheus テキスト形式)。"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/logs')
 @requires_auth
 def api_logs():
@@ -881,7 +1141,7 @@ def api_logs():
     rows = []
     if logger_instance:
         rows = logger_instance.read_by_date(date_str)
-    return jsonify(rows)
+    return jsonify([_with_record_urls(row) for row in rows])
 
 @app.route('/api/notify_test', methods=['POST'])
 @requires_auth
@@ -890,13 +1150,11 @@ def api_notify_test():
         return jsonify({"ok": False, "message": "Notifier not initialized"})
     
     config = load_config()
-    # 最新の設定で送り直すためにインスタンスを一時的に更新（または config から直接送るNotifier側の機能が必要だが、今はインスタンスの値を更新する）
-    notifier_instance.token = config.get('telegram_token')
-    notifier_instance.chat_id = config.get('telegram_chat_id')
-    notifier_instance.api_url = f"https://api.telegram.org/bot{notifier_instance.token}/"
+    # 最新の設定で送り直す（キュー内の未送信ジョブにも適用される）
+    notifier_instance.configure(config.get('telegram_token'), config.get('telegram_chat_id'))
     
     notifier_instance.send_message("🔔 これは監視カメラシステムからのテスト通知です。")
-    return jsonify({"ok": True, "message": "テスト通知を送信しました。コンソールログを確認してください。"})
+    return jsonify({"ok": True, "message": "テスト通知を送信キューに登録しました。コンソールログを確認してください。"})
 
 @app.route('/api/model')
 @requires_auth
@@ -918,8 +1176,11 @@ def api_classes():
         with open(json_path, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=4)
         
-        # Detector 側のキャッシュも更新
-        if detector_instance:
+        # Detector 側のキャッシュも更新（共有スケジューラーの全ワーカー・推論プロセスを含む）
+        schedulers = {id(p.scheduler): p.scheduler for p in cameras.values()}
+        for scheduler in schedulers.values():
+            scheduler.refresh_classes()
+        if detector_instance and not schedulers:
             detector_instance.refresh_classes()
             
         return jsonify({"status": "success"})
@@ -943,20 +1204,27 @@ def api_config():
             'recorder_post_seconds', 'recorder_start_delay_ms',
             'recorder_width', 'recorder_height', 'recorder_pre_frames',
             'snapshot_width', 'snapshot_height', 'snapshot_mode',
-            'telegram_notify_mode'
+            'telegram_notify_mode',
+            'storage_retention_days', 'storage_max_gb', 'storage_min_free_mb'
         }
         filtered = {k: v for k, v in data.items() if k in allowed_keys}
         save_config(filtered)
+
+        if storage_instance and any(k.startswith('storage_') for k in filtered):
+            storage_instance.request_cleanup()
         
-        if 'stream_width' in filtered:
-            system_status['stream_width'] = filtered['stream_width']
-        if 'stream_height' in filtered:
-            system_status['stream_height'] = filtered['stream_height']
+        for status in [system_status] + [p.status for p in cameras.values()]:
+            if 'stream_width' in filtered:
+                status['stream_width'] = filtered['stream_width']
+            if 'stream_height' in filtered:
+                status['stream_height'] = filtered['stream_height']
             
         return jsonify({"ok": True})
     
-    # GET の場合は現在の設定を返す
-    return jsonify(load_config())
+    # GET の場合は現在の設定を返す（パスワードハッシュは除く）
+    config = load_config()
+    config.pop('web_pass_hash', None)
+    return jsonify(config)
 
 # ============================================================
 # メディア配信 API
@@ -965,35 +1233,140 @@ def api_config():
 @app.route('/records/<path:filename>')
 @requires_auth
 def serve_record(filename):
-    config = load_config()
-    save_dir = config.get('save_directory', 'records')
-    # 絶対パスを構築
-    abs_save_dir = os.path.abspath(save_dir)
-    return send_from_directory(abs_save_dir, filename)
-
-def _draw_osd(frame):
-    """フレームに検知状態・FPS・日時を重畳する。"""
-    import datetime
+    path = safe_join(records_root, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    st = os.stat(path)
+    # 書き込み中・未確定のファイルはキャッシュさせない（確定は録画の完了・静止画の保存時に StorageManager へ登録される）
+    if storage_instance is not None:
+        finalized = storage_instance.is_finalized(path)
+    else:
+        finalized = time.time() - st.st_mtime >= MIN_AGE_SECONDS
+    if not finalized:
+        response = send_file(path, conditional=True, etag=True, max_age=0)
+        response.cache_control.no_cache = True
+        return response
+
+    # 確定済みファイルは内容が変わらないため、強い ETag と長期キャッシュを付与
+    # (Range / If-None-Match / If-Range は send_file(conditional=True) が処理する)
+    etag = f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+    response = send_file(path, conditional=True, etag=etag, max_age=RECORD_MAX_AGE)
+    # send_file は public を付けるため、認証付きの内容として private に置き換える
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+def _record_relpath(path):
+    """保存ディレクトリからの相対パス ('/' 区切り) を返す。"""
+    if storage_instance is not None:
+        return storage_instance.relpath(path)
+    return media_relpath(records_root, path)
+
+def _with_record_urls(row):
+    """ログ行に /records/ 配下の URL 用の相対パス (snapshot_url / video_url) を付与する。"""
+    for key in ('snapshot_path', 'video_path'):
+        path = row.get(key)
+        row[key.replace('_path', '_url')] = _record_relpath(path) if path else ''
+    return row
+
+def _media_entry(path, stat):
+    return {
+        "name": os.path.basename(path),
+        "path": _record_relpath(path),
+        "size": f"{stat.st_size / (1024*1024):.1f} MB" if stat.st_size > 1024*1024 else f"{stat.st_size / 1024:.0f} KB",
+        "mtime": stat.st_mtime,
+        "date": datetime.datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M')
+    }
+
+# ============================================================
+# プッシュ配信用イベント
+# ============================================================
+def subscribe_events(callback):
+    """callback(kind, data) を登録する。kind: 'log' / 'media' / 'media_removed'"""
+    _event_listeners.append(callback)
+
+def publish_event(kind, data):
+    for callback in list(_event_listeners):
+        try:
+            callback(kind, data)
+        except Exception as e:
+            print(f"[Web] Event listener error: {e}")
+
+def _on_log_row(row):
+    publish_event('log', _with_record_urls(row))
+    for key in ('snapshot_path', 'video_path'):
+        path = row.get(key)
+        if path and os.path.exists(path):
+            publish_event('media', _media_entry(path, os.stat(path)))
+
+def _on_media_deleted(paths):
+    publish_event('media_removed', [_record_relpath(p) for p in paths])
+
+OSD_FONT = cv2.FONT_HERSHEY_SIMPLEX
+OSD_TOP_BAR = 40     # 上部バーの高さ (px)
+OSD_BOTTOM_BAR = 38  # 下部バーの高さ (px)
+OSD_TEXT_COLOR = (180, 200, 255)
+OSD_SPRITE_LIMIT = 256  # 文字スプライトのキャッシュ上限（時刻表示で毎秒 1 つずつ増える）
+
+_osd_sprites = {}
+
+def _text_sprite(text, scale, thickness):
+    """
+    文字列の描画画素をキャッシュから返す（内容が変わったときのみ putText を実行）。
+    戻り値: (マスク, 描画画素の座標 (ys, xs), 文字幅, 基準点からマスク左上までのオフセット (x, y))
+    """
+    key = (text, scale, thickness)
+    sprite = _osd_sprites.get(key)
+    if sprite is None:
+        (tw, th), baseline = cv2.getTextSize(text, OSD_FONT, scale, thickness)
+        pad = thickness + 2
+        mask = np.zeros((th + baseline + pad * 2, tw + pad * 2), np.uint8)
+        cv2.putText(mask, text, (pad, th + pad), OSD_FONT, scale, 255, thickness)
+        sprite = (mask, np.nonzero(mask), tw, (pad, th + pad))
+        if len(_osd_sprites) >= OSD_SPRITE_LIMIT:
+            _osd_sprites.clear()
+        _osd_sprites[key] = sprite
+    return sprite
+
+def _blit_text(frame, text, org, scale, color, thickness=1, right=False):
+    """キャッシュした文字スプライトを org（right=True の場合は右端）に合わせて重ねる。"""
+    mask, (ys, xs), tw, (ox, oy) = _text_sprite(text, scale, thickness)
+    x0 = (org[0] - tw if right else org[0]) - ox
+    y0 = org[1] - oy
+    h, w = frame.shape[:2]
+    mh, mw = mask.shape
+    if x0 >= 0 and y0 >= 0 and x0 + mw <= w and y0 + mh <= h:
+        frame[ys + y0, xs + x0] = color
+        return
+    # フレーム外にはみ出す場合は切り詰める
+    mx0, my0 = max(0, -x0), max(0, -y0)
+    mx1, my1 = min(mw, w - x0), min(mh, h - y0)
+    if mx1 > mx0 and my1 > my0:
+        roi = frame[y0 + my0:y0 + my1, x0 + mx0:x0 + mx1]
+        roi[mask[my0:my1, mx0:mx1] > 0] = color
+
+def _darken(strip, alpha):
+    """黒との半透明合成。オーバーレイが黒一色のため帯状領域の輝度スケールのみで済む。"""
+    if strip.size:
+        cv2.convertScaleAbs(strip, dst=strip, alpha=alpha)
+
+def _draw_osd(frame, status=None):
+    """フレームに検知状態・FPS・日時を重畳する（frame を直接書き換える）。"""
+    status = system_status if status is None else status
     h, w = frame.shape[:2]
-    human_count = system_status.get('human_count', 0)
-    fps          = system_status.get('fps', 0)
+    human_count = status.get('human_count', 0)
+    fps          = status.get('fps', 0)
     now_str      = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-    # 上部バー（半透明）
-    overlay = frame.copy()
-    cv2.rectangle(overlay, (0, 0), (w, 40), (0, 0, 0), -1)
-    frame = cv2.addWeighted(overlay, 0.5, frame, 0.5, 0)
-
-    # FPS と日時
-    cv2.putText(frame, f"FPS: {fps}", (8, 26),
-                cv2.FONT_HERSHEY_SIMPLEX, 0.6, (180, 200, 255), 1)
-    cv2.putText(frame, now_str, (w - 8 - cv2.getTextSize(now_str, cv2.FONT_HERSHEY_SIMPLEX, 0.55, 1)[0][0], 26),
-                cv2.FONT_HERSHEY_SIMPLEX, 0.55, (180, 200, 255), 1)
+    # 上部バー（半透明）と FPS・日時
+    _darken(frame[:OSD_TOP_BAR + 1], 0.5)  # 従来の矩形描画と同じく境界行を含める
+    _blit_text(frame, f"FPS: {fps}", (8, 26), 0.6, OSD_TEXT_COLOR)
+    _blit_text(frame, now_str, (w - 8, 26), 0.55, OSD_TEXT_COLOR, right=True)
 
     # 下部ステータスバー
-    overlay2 = frame.copy()
-    cv2.rectangle(overlay2, (0, h - 38), (w, h), (0, 0, 0), -1)
-    frame = cv2.addWeighted(overlay2, 0.55, frame, 0.45, 0)
+    _darken(frame[max(0, h - OSD_BOTTOM_BAR):], 0.45)
 
     if human_count > 0:
         status_text  = f"DETECTED: {human_count}"
@@ -1004,50 +1377,188 @@ def _draw_osd(frame):
         status_text  = "Monitoring..."
         status_color = (80, 220, 80)   # 緑
 
-    cv2.putText(frame, status_text, (10, h - 12),
-                cv2.FONT_HERSHEY_SIMPLEX, 0.65, status_color, 2)
+    _blit_text(frame, status_text, (10, h - 12), 0.65, status_color, 2)
+
+    last = status.get('last_detected', '—')
+    _blit_text(frame, f"Last: {last}", (w - 8, h - 12), 0.5, OSD_TEXT_COLOR, right=True)
 
-    last = system_status.get('last_detected', '—')
-    last_str = f"Last: {last}"
-    cv2.putText(frame, last_str,
-                (w - 8 - cv2.getTextSize(last_str, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)[0][0], h - 12),
-                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (180, 200, 255), 1)
+    return frame
 
+def camera_status(cam_id=None):
+    """カメラのステータス（省略時・1 台目は system_status）。"""
+    pipeline = cameras.get(cam_id)
+    return pipeline.status if pipeline is not None else system_status
+
+def current_stream_source(cam_id=None):
+    """配信元フレームを返す（検知枠を描画済みのフレームを優先し、なければカメラから直接取得）。"""
+    pipeline = cameras.get(cam_id) if cam_id is not None else next(iter(cameras.values()), None)
+    if pipeline is not None:
+        frame = pipeline.latest_frame
+        return frame if frame is not None else pipeline.camera.get_frame()
+    frame = latest_processed_frame
+    if frame is None and camera_instance:
+        frame = camera_instance.get_frame()
     return frame
 
-def generate_frames():
-    import time
+def raw_jpeg_source(cam_id=None):
+    """MJPEG パススルー中のカメラの (通し番号, JPEG) を返す（パススルーでない場合は None）。"""
+    pipeline = cameras.get(cam_id) if cam_id is not None else next(iter(cameras.values()), None)
+    cam = pipeline.camera if pipeline is not None else camera_instance
+    return cam.get_jpeg() if getattr(cam, 'passthrough', False) else None
+
+def wants_raw(args):
+    """?raw=1 — カメラの JPEG をそのまま配信する（パススルー時のみ有効）。"""
+    return str(args.get('raw', '')).lower() in ('1', 'true', 'yes')
+
+def compose_stream_frame(frame, size=None, status=None):
+    """配信解像度（省略時は stream_width x stream_height）へのリサイズと OSD 描画を行ったフレームを返す。"""
+    if size is None:
+        size = (system_status.get('stream_width', 640), system_status.get('stream_height', 480))
+    display = cv2.resize(frame, size)
+
+    # OSD 描画
+    return _draw_osd(display, status)
+
+def encode_jpeg(image, quality=DEFAULT_JPEG_QUALITY):
+    ret, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    return buffer.tobytes() if ret else None
+
+def render_stream_frame(frame, size=None, quality=DEFAULT_JPEG_QUALITY, status=None):
+    """配信用にリサイズ・OSD 描画・JPEG エンコードしたバイト列を返す。"""
+    return encode_jpeg(compose_stream_frame(frame, size, status), quality)
+
+def parse_stream_params(args):
+    """
+    クライアントごとの配信設定 (?w=&q=&fps=) を解釈する。
+    高さは配信設定の縦横比から求める。戻り値: ((w, h), quality, fps)
+    """
+    base_w = system_status.get('stream_width', 640)
+    base_h = system_status.get('stream_height', 480)
+
+    def _num(key, default, lo, hi):
+        try:
+            return min(hi, max(lo, int(float(args.get(key, default)))))
+        except (TypeError, ValueError):
+            return default
+
+    w = _num('w', base_w, 160, 1920)
+    h = max(2, int(round(w * base_h / base_w / 2)) * 2)
+    quality = _num('q', DEFAULT_JPEG_QUALITY, 20, 95)
+    fps = _num('fps', MAX_STREAM_FPS, 1, MAX_STREAM_FPS)
+    return (w, h), quality, fps
+
+def _live_source():
+    frame = current_stream_source()
+    return compose_stream_frame(frame) if frame is not None else None
+
+def mjpeg_part(jpeg):
+    return (b'--frame\r\n'
+            b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n')
+
+def generate_frames(size=None, quality=DEFAULT_JPEG_QUALITY, fps=MAX_STREAM_FPS, cam_id=None):
+    status = camera_status(cam_id)
     prev_time = time.time()
     while True:
-        # main.py で加工されたフレームがあればそれを優先
-        frame = latest_processed_frame
-        
-        # なければカメラから直接取得（フォールバック）
-        if frame is None and camera_instance:
-            frame = camera_instance.get_frame()
+        frame = current_stream_source(cam_id)
 
         if frame is not None:
             now = time.time()
-            system_status['fps'] = round(1.0 / max(now - prev_time, 1e-6), 1)
+            status['stream_fps'] = round(1.0 / max(now - prev_time, 1e-6), 1)
             prev_time = now
 
-            w = system_status.get('stream_width', 640)
-            h = system_status.get('stream_height', 480)
-            display = cv2.resize(frame, (w, h))
-
-            # OSD 描画
-            display = _draw_osd(display)
-
-            ret, buffer = cv2.imencode('.jpg', display)
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
+            with metrics.timer('encode'):
+                jpeg = render_stream_frame(frame, size, quality, status)
+            if jpeg is not None:
+                sent = time.perf_counter()
+                yield mjpeg_part(jpeg)
+                metrics.observe('stream', time.perf_counter() - sent)
         
-        time.sleep(0.01) # 少し待機してループ
+        time.sleep(max(0.01, 1.0 / fps - (time.time() - prev_time))) # 指定 FPS まで待機
+
+def generate_raw_frames(fps=MAX_STREAM_FPS, cam_id=None):
+    """カメラの MJPEG をデコード・再エンコードせずに配信する（OSD・検知枠は描画されない）。"""
+    status = camera_status(cam_id)
+    last_seq = None
+    prev_time = time.time()
+    while True:
+        start = time.time()
+        source = raw_jpeg_source(cam_id)
+        if source is not None and source[0] != last_seq:
+            last_seq, jpeg = source
+            status['stream_fps'] = round(1.0 / max(start - prev_time, 1e-6), 1)
+            prev_time = start
+            sent = time.perf_counter()
+            yield mjpeg_part(jpeg)
+            metrics.observe('stream', time.perf_counter() - sent)
+        time.sleep(max(0.01, 1.0 / fps - (time.time() - start)))
+
+def _stream_response(args, cam_id=None):
+    size, quality, fps = parse_stream_params(args)
+    if wants_raw(args) and raw_jpeg_source(cam_id) is not None:
+        frames = generate_raw_frames(fps, cam_id)
+    else:
+        frames = generate_frames(size, quality, fps, cam_id)
+    return Response(frames, mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/video_feed')
 @requires_auth
 def video_feed():
-    return Response(generate_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return _stream_response(request.args)
+
+def _pipeline_or_404(cam_id):
+    pipeline = cameras.get(cam_id)
+    if pipeline is None:
+        abort(404)
+    return pipeline
+
+@app.route('/api/cameras')
+@requires_auth
+def api_cameras():
+    """カメラ一覧と推論の割り当て状況（重み・動き量・推論回数）。"""
+    stats = {}
+    if cameras:
+        stats = next(iter(cameras.values())).scheduler.stats()
+    return jsonify([{"id": cam_id, "name": p.name, "status": p.status, "inference": stats.get(cam_id, {})}
+                    for cam_id, p in cameras.items()])
+
+@app.route('/cam/<cam_id>/video_feed')
+@requires_auth
+def camera_video_feed(cam_id):
+    _pipeline_or_404(cam_id)
+    return _stream_response(request.args, cam_id)
+
+@app.route('/cam/<cam_id>/api/status')
+@requires_auth
+def camera_api_status(cam_id):
+    return jsonify(_pipeline_or_404(cam_id).status)
+
+@app.route('/cam/<cam_id>/api/logs')
+@requires_auth
+def camera_api_logs(cam_id):
+    pipeline = _pipeline_or_404(cam_id)
+    date_str = request.args.get('date') or datetime.datetime.now().strftime('%Y-%m-%d')
+    return jsonify([_with_record_urls(row) for row in pipeline.logger.read_by_date(date_str)])
+
+@app.route('/live/<path:filename>')
+@requires_auth
+def live_hls(filename):
+    """H.264 (HLS / fMP4) ライブ配信。プレイリストの取得が続く間だけエンコードを行う。"""
+    if live_instance is None:
+        abort(404)
+    if filename == PLAYLIST:
+        live_instance.touch()
+        if not live_instance.wait_ready():
+            abort(503)
+    path = live_instance.resolve(filename)
+    if path is None:
+        abort(404)
+
+    mimetype = 'application/vnd.apple.mpegurl' if filename.endswith('.m3u8') else 'video/mp4'
+    response = send_file(path, mimetype=mimetype, conditional=True, max_age=0)
+    if filename.endswith('.m3u8'):
+        response.cache_control.no_cache = True
+        response.cache_control.no_store = True
+    return response
 
 @app.route('/media')
 @requires_auth
@@ -1057,22 +1568,14 @@ def media_browser():
 @app.route('/api/media_list')
 @requires_auth
 def api_media_list():
-    config = load_config()
-    save_dir = config.get('save_directory', 'records')
+    save_dir = records_root
     if not os.path.exists(save_dir):
         return jsonify([])
     
+    # YYYY/MM/DD に分割された保存先を再帰的に走査
     files = []
-    for filename in os.listdir(save_dir):
-        if filename.lower().endswith(('.jpg', '.mp4', '.avi')):
-            path = os.path.join(save_dir, filename)
-            stat = os.stat(path)
-            files.append({
-                "name": filename,
-                "size": f"{stat.st_size / (1024*1024):.1f} MB" if stat.st_size > 1024*1024 else f"{stat.st_size / 1024:.0f} KB",
-                "mtime": stat.st_mtime,
-                "date": datetime.datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M')
-            })
+    for path, stat in iter_media(save_dir):
+        files.append(_media_entry(path, stat))
     
     # 日付の降順でソート
     files.sort(key=lambda x: x['mtime'], reverse=True)
@@ -1083,13 +1586,43 @@ def api_media_list():
 def serve_tmp_test(filename):
     return send_from_directory(app.config.get('TMP_TEST_FOLDER', 'tmp_test'), filename)
 
-def run_server(cam, logger=None, detector=None, notifier=None):
-    global camera_instance, logger_instance, detector_instance, notifier_instance
+def run_server(cam, logger=None, detector=None, notifier=None, storage=None, pipelines=None):
+    global camera_instance, logger_instance, detector_instance, notifier_instance, storage_instance, records_root
+    global live_instance
     camera_instance = cam
     logger_instance = logger
     detector_instance = detector
     notifier_instance = notifier
+    storage_instance = storage
+    cameras.update(pipelines or {})
+    _load_credentials()
+    if logger is not None:
+        logger.add_listener(_on_log_row)
+    for pipeline in cameras.values():
+        if pipeline.logger is not logger:
+            pipeline.logger.add_listener(lambda row, c=pipeline.id: _on_log_row(dict(row, camera=c)))
+    if storage is not None:
+        storage.add_listener(_on_media_deleted)
     config = load_config()
+    records_root = os.path.abspath(config.get('save_directory', 'records'))
+    # リバースプロキシ (nginx 等) 配下ではファイル送出を X-Sendfile でゼロコピー化
+    app.config['USE_X_SENDFILE'] = bool(config.get('web_use_x_sendfile', False))
     system_status['stream_width'] = config.get('stream_width', 640)
     system_status['stream_height'] = config.get('stream_height', 480)
+
+    if config.get('live_h264', True):
+        live_instance = LiveStreamer(
+            frame_source=_live_source,
+            resolution=(system_status['stream_width'], system_status['stream_height']),
+            fps=config.get('live_fps', 10),
+            bitrate_kbps=config.get('live_bitrate_kbps', 600),
+            encoder=config.get('live_encoder', 'libx264'))
+
+    # ストリーミング・ステータスは asyncio サーバーで配信（未インストール時は Flask 開発サーバー）
+    if config.get('web_server', 'asgi') == 'asgi':
+        import web_async
+        if web_async.available():
+            web_async.serve(host='0.0.0.0', port=5000)
+            return
+        print("[Web] starlette / uvicorn が見つかりません。Flask 開発サーバーで起動します。")
     app.run(host='0.0.0.0', port=5000, threaded=True)